@@ -0,0 +1,276 @@
+# ================================================================
+#  Офлайн-бенчмарки сканера (без бирж и без Telegram)
+#    python bench.py spread   [--venues 5] [--repeat 5]
+#    python bench.py scan     [--exchanges 5] [--symbols 1000] [--scans 20] [--record DIR] [--shards N] ...
+#    python bench.py init     [--exchanges 5] [--symbols 1000]
+#    python bench.py autoscan [--exchanges 5] [--symbols 1000] [--chats 10]
+#    python bench.py stream   [--venues 5] [--symbols 1000] [--updates 20]
+# ================================================================
+
+import argparse
+import asyncio
+import functools
+import random
+import resource
+import statistics
+import tempfile
+import time
+from typing import Dict, Any, List, Tuple, Callable
+
+import numpy as np
+
+import scanner
+from mock_exchange import FakeApp, mock_exchange_class
+
+# ================== SYNTHETIC DATA ==================
+def synthetic_snapshot(n_symbols: int, n_venues: int, seed: int = 42) -> Tuple[Dict[str, Dict[str, Tuple[float, float, float]]], List[str]]:
+    rnd = random.Random(seed)
+    symbols = [f"C{i}/USDT" for i in range(n_symbols)]
+    snapshot: Dict[str, Dict[str, Tuple[float, float, float]]] = {}
+    base = {s: rnd.uniform(0.01, 1000.0) for s in symbols}
+    for v in range(n_venues):
+        snap = {}
+        for s in symbols:
+            if rnd.random() < 0.15:  # пары нет на бирже
+                continue
+            # обычно котировки почти совпадают, изредка — перекос в несколько %
+            shift = rnd.uniform(0.02, 0.05) if rnd.random() < 0.01 else rnd.gauss(0, 0.001)
+            mid = base[s] * (1 + shift)
+            half = mid * rnd.uniform(0.0001, 0.002)
+            snap[s] = (mid - half, mid + half, rnd.uniform(1e5, 5e7))
+        snapshot[f"ex{v}"] = snap
+    return snapshot, symbols
+
+# ================== LEGACY (dict loop) ==================
+def legacy_loop(snapshot: Dict[str, Dict[str, Tuple[float, float, float]]], symbols: List[str]) -> List[Dict[str, Any]]:
+    """Прежний расчёт scan_all_pairs: dict-циклы по символам, глобальные min/max по mid."""
+    FEES = {name: scanner.TAKER_FEE_DEFAULT for name in snapshot.keys()}
+    results = []
+    for symbol in symbols:
+        prices: Dict[str, float] = {}
+        vols: Dict[str, float] = {}
+        for name, snap in snapshot.items():
+            q = snap.get(symbol)
+            if not q:
+                continue
+            bid, ask, qv = q
+            if bid and ask:
+                prices[name] = (bid + ask) / 2.0
+                vols[name] = qv
+        if len(prices) < 2:
+            continue
+        min_p = min(prices.values())
+        max_p = max(prices.values())
+        if (max_p - min_p) / min_p * 100.0 < scanner.MIN_SPREAD:
+            continue
+        min_vol = min(vols.values())
+        if min_vol < scanner.MIN_VOLUME_1H:
+            continue
+        cheap = min(prices, key=prices.get)
+        expensive = max(prices, key=prices.get)
+        net = (max_p / min_p - 1.0) * 100.0 - (FEES[cheap] + FEES[expensive]) * 100.0
+        if net < scanner.MIN_SPREAD:
+            continue
+        results.append({"symbol": symbol, "cheap": cheap, "expensive": expensive, "spread": round(net, 2)})
+    results.sort(key=lambda x: x["spread"], reverse=True)
+    return results
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+# ================== SUITES ==================
+def bench_spread(args):
+    print(f"{'symbols':>8} | {'loop, ms':>9} | {'build, ms':>9} | {'vector, ms':>10} | {'speedup':>7}")
+    for n in (100, 1_000, 5_000):
+        snapshot, symbols = synthetic_snapshot(n, args.venues)
+        now = time.time()
+        compact = {name: scanner.VenueQuotes.from_quotes(q, now) for name, q in snapshot.items()}
+        ids = np.array(sorted(scanner.symbol_table.intern(s) for s in symbols), dtype=np.int32)
+        m = scanner.build_matrix(compact, ids)
+        fees = scanner.fee_matrix(m)
+        t_loop = best_of(lambda: legacy_loop(snapshot, symbols), args.repeat)
+        t_build = best_of(lambda: scanner.build_matrix(compact, ids), args.repeat)
+        t_vec = best_of(lambda: scanner.compute_signals(m, fees), args.repeat)
+        print(f"{n:>8} | {t_loop:>9.2f} | {t_build:>9.2f} | {t_vec:>10.2f} | {t_loop / t_vec:>6.1f}x")
+
+def mock_candidates(args) -> Dict[str, Tuple[type, Dict[str, Any]]]:
+    opts = {"n_symbols": args.symbols, "latency": args.latency, "jitter": args.latency / 4,
+            "error_rate": args.error_rate, "rate_limit": args.rate_limit, "skew": args.skew,
+            "n_cross": args.cross}
+    return {f"mock{i}": (mock_exchange_class(f"mock{i}", **opts), {"apiKey": "k", "secret": "s"})
+            for i in range(args.exchanges)}
+
+def reset_state():
+    scanner.LAST_RESULT = None
+    scanner.evaluator = None
+    scanner.tracker = None
+    scanner._book_cache.clear()
+    scanner.snapshot_history.clear()
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # Linux: KB
+
+def pct(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+def report(title: str, latencies: List[float], calls: List[int]):
+    total = sum(latencies)
+    print(title)
+    print(f"  runs:        {len(latencies)}")
+    print(f"  runs/sec:    {len(latencies) / total:.2f}")
+    print(f"  p50 latency: {pct(latencies, 50) * 1000:.1f} ms")
+    print(f"  p99 latency: {pct(latencies, 99) * 1000:.1f} ms")
+    if calls:
+        print(f"  HTTP/run:    {statistics.mean(calls):.1f}")
+    print(f"  peak RSS:    {peak_rss_mb():.1f} MB")
+
+async def _init(args):
+    scanner.MARKETS_CACHE_DIR = tempfile.mkdtemp(prefix="bench-markets-")
+    await scanner.init_exchanges(mock_candidates(args))
+
+async def _scan(args):
+    await _init(args)
+    reset_state()
+    if args.record:
+        scanner.recorder = scanner.TickRecorder(args.record)
+    if args.shards:
+        scanner.shard_pool = scanner.ShardPool(args.shards)
+        await scanner.shard_pool.start(functools.partial(mock_candidates, args), list(scanner.exchanges))
+    latencies, calls = [], []
+    for _ in range(args.scans):
+        t0 = time.perf_counter()
+        await scanner.scan_all_pairs()
+        latencies.append(time.perf_counter() - t0)
+        calls.append(scanner.LAST_SCAN_STATS["http_calls"])
+    if scanner.recorder is not None:
+        await scanner.recorder.flush()
+        scanner.recorder = None
+    if scanner.shard_pool is not None:
+        await scanner.shard_pool.stop()
+        scanner.shard_pool = None
+    shards = f", {args.shards} шард(ов)" if args.shards else ""
+    report(f"scan_all_pairs: {args.exchanges} бирж × {args.symbols} символов{shards}", latencies, calls)
+
+async def _init_bench(args):
+    latencies, calls = [], []
+    for _ in range(args.scans):
+        t0 = time.perf_counter()
+        await _init(args)
+        latencies.append(time.perf_counter() - t0)
+        calls.append(sum(ex.calls.get("load_markets", 0) for ex in scanner.exchanges.values()))
+    report(f"init_exchanges: {args.exchanges} бирж × {args.symbols} символов (холодный старт)", latencies, calls)
+
+async def _autoscan(args):
+    await _init(args)
+    reset_state()
+    scanner.app = FakeApp(args.chats, latency=args.tg_latency, flood_interval=args.tg_flood)
+    for chat_id in scanner.app.chat_ids:
+        scanner.state.set_chat(chat_id, autoscan=True)
+    latencies, calls = [], []
+    for _ in range(args.scans):
+        t0 = time.perf_counter()
+        await scanner.autoscan_tick()
+        latencies.append(time.perf_counter() - t0)
+        calls.append(scanner.LAST_SCAN_STATS["http_calls"])
+    t0 = time.perf_counter()
+    await scanner.outbox.drain()
+    drain = time.perf_counter() - t0
+    report(f"autoscan_tick: {args.exchanges} бирж × {args.symbols} символов, {args.chats} чатов", latencies, calls)
+    print(f"  Telegram:    {len(scanner.app.bot.sent)} сообщений, RetryAfter: {scanner.app.bot.flood_errors}, "
+          f"дослали после сканов за {drain:.2f} c")
+
+async def _until(cond: Callable[[], bool], what: str, timeout: float = 5.0) -> float:
+    t0 = time.perf_counter()
+    while not cond():
+        if time.perf_counter() - t0 > timeout:
+            raise SystemExit(f"FAIL: за {timeout:.0f} c не дождались — {what}")
+        await asyncio.sleep(0.005)
+    return time.perf_counter() - t0
+
+async def _stream(args):
+    """MarketStream на QueueTransport: перекос цены даёт сигнал, возврат цены — снимает его."""
+    snapshot, symbols = synthetic_snapshot(args.symbols, args.venues)
+    transport = scanner.QueueTransport()
+    stream = scanner.MarketStream({name: None for name in snapshot}, lambda name, ex: transport)
+    await stream.start()
+    for name, quotes in snapshot.items():
+        transport.push(name, quotes)
+    await _until(lambda: all(stream.book[name] for name in snapshot), "первые снимки в стриме")
+
+    live = lambda symbol: any(sig["symbol"] == symbol for sig in stream.current_signals())
+    cheap = next(iter(snapshot))
+    appear, clear = [], []
+    for k in range(args.updates):
+        symbol = symbols[k % len(symbols)]
+        price = 1.0 + k
+        flat = (price * 0.9995, price * 1.0005, 5e7)
+        for name in snapshot:
+            transport.push(name, {symbol: flat})
+        await _until(lambda: not live(symbol), f"{symbol}: ровные котировки без сигнала")
+        transport.push(cheap, {symbol: (price * 0.9695, price * 0.9705, 5e7)})  # на cheap дешевле на 3%
+        appear.append(await _until(lambda: live(symbol), f"{symbol}: сигнал после перекоса"))
+        transport.push(cheap, {symbol: flat})
+        clear.append(await _until(lambda: not live(symbol), f"{symbol}: сигнал снят после возврата цены"))
+    await stream.stop()
+    report(f"MarketStream/QueueTransport: {args.venues} бирж × {args.symbols} символов, сигнал появился", appear, [])
+    report("  … и снят после возврата цены", clear, [])
+    print("OK: сигналы появляются и снимаются")
+
+def bench_scan(args):
+    asyncio.run(_scan(args))
+
+def bench_init(args):
+    asyncio.run(_init_bench(args))
+
+def bench_autoscan(args):
+    asyncio.run(_autoscan(args))
+
+def bench_stream(args):
+    asyncio.run(_stream(args))
+
+def main():
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарки arbitrage-scanner")
+    sub = p.add_subparsers(dest="suite", required=True)
+    sp = sub.add_parser("spread", help="векторный расчёт спредов vs прежний dict-цикл")
+    sp.add_argument("--venues", type=int, default=5)
+    sp.add_argument("--repeat", type=int, default=5)
+    sp.set_defaults(func=bench_spread)
+
+    sp = sub.add_parser("stream", help="MarketStream на QueueTransport: сигнал появляется и снимается")
+    sp.add_argument("--venues", type=int, default=5)
+    sp.add_argument("--symbols", type=int, default=1000)
+    sp.add_argument("--updates", type=int, default=20)
+    sp.set_defaults(func=bench_stream)
+
+    for name, func, help_ in (
+        ("scan", bench_scan, "scan_all_pairs против N фейковых бирж × M символов"),
+        ("init", bench_init, "init_exchanges (холодный старт) против фейковых бирж"),
+        ("autoscan", bench_autoscan, "autoscan_tick: скан + рассылка в фейковые чаты"),
+    ):
+        sp = sub.add_parser(name, help=help_)
+        sp.add_argument("--exchanges", type=int, default=5)
+        sp.add_argument("--symbols", type=int, default=1000)
+        sp.add_argument("--scans", type=int, default=20)
+        sp.add_argument("--latency", type=float, default=0.05, help="сек на запрос к фейковой бирже")
+        sp.add_argument("--skew", type=float, default=0.005, help="разброс цен между биржами (доля)")
+        sp.add_argument("--error-rate", type=float, default=0.0)
+        sp.add_argument("--cross", type=int, default=50, help="кросс-пар Ci/C0 на биржу (мульти-хоп циклы)")
+        sp.add_argument("--rate-limit", type=float, default=0.0, help="запросов/сек на биржу (0 = без лимита)")
+        sp.add_argument("--chats", type=int, default=10)
+        sp.add_argument("--tg-latency", type=float, default=0.0, help="сек на send_message")
+        sp.add_argument("--tg-flood", type=float, default=0.0, help="мин. интервал сообщений в чат, иначе RetryAfter (сек)")
+        sp.add_argument("--record", default="", help="каталог записи снимков для replay.py")
+        sp.add_argument("--shards", type=int, default=0, help="процессов-воркеров для снимков (SHARD_WORKERS)")
+        sp.set_defaults(func=func)
+
+    args = p.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# ================================================================
+#  Офлайн-фейк ccxt-совместимой биржи для бенчмарков и тестов
+#  Синтетические тикеры / стаканы / балансы, настраиваемые
+#  латентность, доля ошибок и rate limit. Сеть не нужна.
+# ================================================================
+
+import asyncio
+import random
+import time
+from typing import Dict, Any, List
+
+import ccxt.async_support as ccxt
+from telegram.error import RetryAfter
+
+
+class MockExchange:
+    """
+    Подмножество интерфейса ccxt.async_support.Exchange, которое использует scanner.py.
+    Настройки (класс-атрибуты или ключи конфига): n_symbols, latency, jitter,
+    error_rate, rate_limit (запросов/сек; сверх — RateLimitExceeded), seed, skew,
+    n_cross (кросс-пары Ci/C0 — котируются не в USDT, для мульти-хоп циклов).
+    """
+    id = "mock"
+    n_symbols = 500
+    latency = 0.05
+    jitter = 0.02
+    error_rate = 0.0
+    rate_limit = 0.0      # 0 = без лимита
+    seed = 0
+    skew = 0.001          # разброс цен между биржами (доля)
+    n_cross = 0           # кросс-пар Ci/C0
+
+    def __init__(self, config: Dict[str, Any] | None = None):
+        config = dict(config or {})
+        for key in ("id", "n_symbols", "latency", "jitter", "error_rate", "rate_limit", "seed", "skew", "n_cross"):
+            if key in config:
+                setattr(self, key, config[key])
+        self.config = config
+        self.rnd = random.Random(f"{self.id}:{self.seed}")
+        universe = random.Random(self.seed)  # общий для всех бирж — цены совпадают с точностью до skew
+        self.symbols = [f"C{i}/USDT" for i in range(self.n_symbols)]
+        self.base_price = {s: universe.uniform(0.01, 1000.0) for s in self.symbols}
+        self.base_volume = {s: universe.uniform(1e4, 5e7) for s in self.symbols}
+        # кросс-пары: цена — отношение USDT-цен, объём — в C0
+        anchor = self.symbols[0] if self.symbols else None
+        for i in range(1, min(self.n_cross + 1, self.n_symbols)):
+            s = f"C{i}/C0"
+            self.symbols.append(s)
+            self.base_price[s] = self.base_price[f"C{i}/USDT"] / self.base_price[anchor]
+            self.base_volume[s] = self.base_volume[f"C{i}/USDT"] / self.base_price[anchor]
+        self.offset = {s: self.rnd.gauss(0, self.skew) for s in self.symbols}
+        self.markets: Dict[str, Dict[str, Any]] = {}
+        self.currencies: Dict[str, Dict[str, Any]] = {}
+        self.fees = {"trading": {"taker": 0.001, "maker": 0.0008}}
+        self.has = {"fetchTickers": True, "fetchOrderBook": True, "fetchOHLCV": True, "watchTickers": False}
+        self.calls: Dict[str, int] = {}
+        self._window: List[float] = []
+        self.balance: Dict[str, Dict[str, float]] = {"USDT": {"free": 10_000.0, "used": 0.0, "total": 10_000.0}}
+
+    # ---------- инфраструктура ----------
+    async def _request(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.rnd.uniform(-self.jitter, self.jitter)))
+        if self.rate_limit:
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.rate_limit:
+                raise ccxt.RateLimitExceeded(f"{self.id} 429 Too Many Requests")
+            self._window.append(now)
+        if self.error_rate and self.rnd.random() < self.error_rate:
+            raise ccxt.RequestTimeout(f"{self.id} request timed out")
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _mid(self, symbol: str) -> float:
+        # лёгкое случайное блуждание — между сканами котировки двигаются
+        self.offset[symbol] += self.rnd.gauss(0, self.skew / 10)
+        return self.base_price[symbol] * (1 + self.offset[symbol])
+
+    def _ticker(self, symbol: str) -> Dict[str, Any]:
+        mid = self._mid(symbol)
+        half = mid * 0.0005
+        return {"symbol": symbol, "bid": mid - half, "ask": mid + half, "last": mid,
+                "quoteVolume": self.base_volume[symbol], "timestamp": int(time.time() * 1000), "info": {}}
+
+    # ---------- ccxt API ----------
+    async def load_markets(self, reload: bool = False):
+        if self.markets and not reload:
+            return self.markets
+        await self._request("load_markets")
+        self.set_markets({
+            s: {"id": s.replace("/", ""), "symbol": s, "base": s.split("/")[0], "quote": s.split("/")[1],
+                "baseId": s.split("/")[0], "quoteId": s.split("/")[1], "type": "spot", "spot": True, "active": True,
+                "taker": 0.001, "maker": 0.0008, "precision": {"amount": 4, "price": 8}, "limits": {}}
+            for s in self.symbols
+        }, {s.split("/")[0]: {"id": s.split("/")[0], "code": s.split("/")[0]} for s in self.symbols})
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.markets = dict(markets)
+        self.currencies = dict(currencies or {})
+
+    async def fetch_tickers(self, symbols=None, params={}):
+        await self._request("fetch_tickers")
+        return {s: self._ticker(s) for s in (symbols or self.symbols)}
+
+    async def fetch_ticker(self, symbol, params={}):
+        await self._request("fetch_ticker")
+        return self._ticker(symbol)
+
+    async def fetch_ohlcv(self, symbol, timeframe="1m", since=None, limit=None, params={}):
+        await self._request("fetch_ohlcv")
+        now_minute = int(time.time() // 60)
+        first = since // 60_000 if since is not None else now_minute - (limit or 100) + 1
+        last = min(now_minute, first + (limit or 100) - 1)
+        mid = self._mid(symbol)
+        per_minute = self.base_volume[symbol] / 1440 / mid  # объём в базовой монете
+        return [[m * 60_000, mid, mid, mid, mid, per_minute * self.rnd.uniform(0.2, 1.8)]
+                for m in range(first, last + 1)]
+
+    async def fetch_order_book(self, symbol, limit=None, params={}):
+        await self._request("fetch_order_book")
+        t = self._ticker(symbol)
+        levels = limit or 50
+        size = self.base_volume[symbol] / t["last"] / 2000
+        return {
+            "symbol": symbol,
+            "bids": [[t["bid"] * (1 - 0.0005 * i), size] for i in range(levels)],
+            "asks": [[t["ask"] * (1 + 0.0005 * i), size] for i in range(levels)],
+            "timestamp": int(time.time() * 1000),
+        }
+
+    async def fetch_balance(self, params={}):
+        await self._request("fetch_balance")
+        return {k: dict(v) for k, v in self.balance.items()}
+
+    async def create_order(self, symbol, type, side, amount, price=None, params={}):
+        await self._request("create_order")
+        t = self._ticker(symbol)
+        fill = t["ask"] if side == "buy" else t["bid"]
+        return {"id": str(self.rnd.getrandbits(32)), "symbol": symbol, "side": side, "type": type,
+                "amount": amount, "filled": amount, "average": fill, "status": "closed"}
+
+    def amount_to_precision(self, symbol, amount):
+        return f"{amount:.4f}"
+
+    async def close(self):
+        pass
+
+
+def mock_exchange_class(name: str, **opts) -> type:
+    """Класс фейковой биржи с заданными настройками — подставляется в init_exchanges(candidates=...)."""
+    return type(f"Mock_{name}", (MockExchange,), {"id": name, **opts})
+
+
+# ================== TELEGRAM FAKES ==================
+class FakeBot:
+    """send_message с латентностью; flood_interval — мин. пауза между сообщениями в чат, иначе RetryAfter."""
+    def __init__(self, latency: float = 0.0, flood_interval: float = 0.0):
+        self.latency = latency
+        self.flood_interval = flood_interval
+        self.sent: List[Dict[str, Any]] = []
+        self.flood_errors = 0
+        self._last: Dict[Any, float] = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if self.flood_interval and now - self._last.get(chat_id, -1e9) < self.flood_interval:
+            self.flood_errors += 1
+            raise RetryAfter(1)
+        self._last[chat_id] = now
+        self.sent.append({"chat_id": chat_id, "text": text, **kwargs})
+
+
+class FakeApp:
+    """Минимум Application, который трогает autoscan_tick: bot; chat_ids подписывают в scanner.state."""
+    def __init__(self, n_chats: int, latency: float = 0.0, flood_interval: float = 0.0):
+        self.bot = FakeBot(latency, flood_interval)
+        self.chat_ids = list(range(1, n_chats + 1))
@@ -0,0 +1,131 @@
+# ================================================================
+#  Replay записанных снимков (RECORD_DIR) через ту же логику сигналов
+#    python replay.py info  DIR
+#    python replay.py sweep DIR [--spread 0.8,1.2,2] [--volume 100000,500000] [--topn 40,80]
+#                               [--from 2025-01-01T00:00] [--to 2025-01-02T00:00]
+#  Без бирж и без Telegram: быстрее реального времени, для подбора порогов.
+# ================================================================
+
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+
+import scanner
+
+# ================== ENGINE ==================
+def replay_fees(fees: Dict[str, float], m: scanner.QuoteMatrix) -> np.ndarray:
+    """Taker-комиссии бирж на момент записи → матрица (S, E) для compute_signals."""
+    per_venue = np.array([fees.get(v, scanner.TAKER_FEE_DEFAULT) for v in m.venues], dtype=float)
+    return np.broadcast_to(per_venue, (len(m.symbols), len(m.venues)))
+
+def sweep(path: str, spreads: List[float], volumes: List[float], topns: List[int],
+          start: float | None = None, end: float | None = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Прогон записи по сетке порогов. Матрицу строим один раз на (скан, topN), сигналы — один раз
+    на (скан, topN, объём) с минимальным порогом спреда: лучшая пара символа от порога не зависит,
+    поэтому более строгие пороги — просто фильтр.
+    """
+    floor = min(spreads)
+    stats = {(n, v, s): {"signals": 0, "opened": 0, "spreads": [], "prev": set()}
+             for n in topns for v in volumes for s in spreads}
+    scans, t_first, t_last = 0, None, None
+    t0 = time.perf_counter()
+    for ts, snap, fees in scanner.read_ticks(path, start, end):
+        scans += 1
+        t_first = ts if t_first is None else t_first
+        t_last = ts
+        for n in topns:
+            m = scanner.build_matrix(snap, scanner.get_top_symbols(snap, n))
+            fm = replay_fees(fees, m)
+            for v in volumes:
+                base = scanner.compute_signals(m, fm, floor, v)
+                for s in spreads:
+                    st = stats[(n, v, s)]
+                    keys = set()
+                    for sig in base:
+                        if sig["spread"] < s:
+                            break  # base отсортирован по спреду
+                        keys.add((sig["symbol"], sig["cheap"], sig["expensive"]))
+                        st["spreads"].append(sig["spread"])
+                    st["signals"] += len(keys)
+                    st["opened"] += len(keys - st["prev"])
+                    st["prev"] = keys
+    elapsed = time.perf_counter() - t0
+
+    rows = []
+    for (n, v, s), st in stats.items():
+        sp = st["spreads"]
+        rows.append({
+            "topn": n, "min_volume": v, "min_spread": s,
+            "signals_per_scan": st["signals"] / scans if scans else 0.0,
+            "opened": st["opened"],
+            "median_spread": float(np.median(sp)) if sp else 0.0,
+            "max_spread": max(sp) if sp else 0.0,
+        })
+    span = (t_last - t_first) if scans else 0.0
+    meta = {"scans": scans, "elapsed": elapsed, "span": span, "t_first": t_first, "t_last": t_last}
+    return rows, meta
+
+# ================== CLI ==================
+def parse_list(raw: str, cast=float) -> List:
+    return [cast(x) for x in raw.split(",") if x.strip()]
+
+def parse_time(raw: str | None) -> float | None:
+    return datetime.fromisoformat(raw).timestamp() if raw else None
+
+def fmt_ts(ts: float | None) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "—"
+
+def cmd_info(args):
+    index = scanner.read_index(args.dir)
+    if not index:
+        print("Запись пуста.")
+        return
+    rows = sum(e["rows"] for e in index)
+    size = os.path.getsize(os.path.join(args.dir, "ticks.bin"))
+    raw = rows * sum(np.dtype(dt).itemsize for _, dt in scanner._TICK_COLUMNS)
+    print(f"  чанков:  {len(index)}")
+    print(f"  сканов:  {sum(e['scans'] for e in index)}")
+    print(f"  строк:   {rows}")
+    print(f"  период:  {fmt_ts(index[0]['t0'])} → {fmt_ts(index[-1]['t1'])}")
+    print(f"  размер:  {size / 1024 / 1024:.2f} MB (сжатие {raw / max(size, 1):.1f}x)")
+
+def cmd_sweep(args):
+    rows, meta = sweep(args.dir, parse_list(args.spread), parse_list(args.volume), parse_list(args.topn, int),
+                       parse_time(getattr(args, "from")), parse_time(args.to))
+    if not meta["scans"]:
+        print("Нет сканов в заданном периоде.")
+        return
+    speed = meta["span"] / meta["elapsed"] if meta["elapsed"] > 0 else 0.0
+    print(f"Сканов: {meta['scans']} | {fmt_ts(meta['t_first'])} → {fmt_ts(meta['t_last'])} | "
+          f"прогон {meta['elapsed']:.2f} c ({speed:.0f}x реального времени)")
+    print(f"{'topN':>5} | {'min vol':>9} | {'min %':>6} | {'sig/scan':>8} | {'opened':>6} | {'med %':>6} | {'max %':>6}")
+    for r in sorted(rows, key=lambda r: (r["topn"], r["min_volume"], r["min_spread"])):
+        print(f"{r['topn']:>5} | {r['min_volume']:>9.0f} | {r['min_spread']:>6.2f} | {r['signals_per_scan']:>8.2f} | "
+              f"{r['opened']:>6} | {r['median_spread']:>6.2f} | {r['max_spread']:>6.2f}")
+
+def main():
+    p = argparse.ArgumentParser(description="Replay записанных снимков arbitrage-scanner")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    sp = sub.add_parser("info", help="сводка по записи")
+    sp.add_argument("dir")
+    sp.set_defaults(func=cmd_info)
+
+    sp = sub.add_parser("sweep", help="прогон сетки порогов по записи")
+    sp.add_argument("dir")
+    sp.add_argument("--spread", default=f"0.5,0.8,{scanner.MIN_SPREAD},2", help="MIN_SPREAD, %% через запятую")
+    sp.add_argument("--volume", default=f"100000,{scanner.MIN_VOLUME_1H}", help="MIN_VOLUME_1H, $ через запятую")
+    sp.add_argument("--topn", default=f"40,{scanner.TOPN_PER_EXCHANGE},200", help="TOPN_PER_EXCHANGE через запятую")
+    sp.add_argument("--from", default=None, help="начало периода (ISO)")
+    sp.add_argument("--to", default=None, help="конец периода (ISO)")
+    sp.set_defaults(func=cmd_sweep)
+
+    args = p.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,191 @@
 # ================================================================
 #  ARBITRAGE SCANNER v6.1-STABLE (Render + Telegram Webhook)
 #  Multi-Exchange Spot Arbitrage (REAL ORDERS + AUTOSCAN)
-#  Exchanges enabled by default: MEXC, BITGET, BIGONE, OKX, KUCOIN
-#  Others left as examples and can be enabled by uncommenting.
+#  Exchanges: EXCHANGES env or EXCHANGES_CONFIG file (default MEXC, BITGET, BIGONE, GATE)
+#  Known venues and their credential env names: EXCHANGE_REGISTRY.
 #  PTB 21.6 | CCXT async_support | Python 3.13 compatible
 # ================================================================
 
 import os
+import json
+import sqlite3
+import time
+IMPORT_T0 = time.perf_counter()  # отсчёт старта процесса — до тяжёлых импортов (ccxt, telegram)
+import resource
+import socket
+import ssl
 import asyncio
+import multiprocessing as mp
+import struct
+import threading
+import warnings
+import zlib
 import nest_asyncio
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import Dict, Any, List, Tuple, Set
-
+from contextlib import contextmanager, asynccontextmanager
+from types import MappingProxyType
+from typing import Dict, Any, List, Tuple, Set, Mapping, AsyncIterator, Callable, Iterator
+
+import numpy as np
+import aiohttp
+import certifi
+from aiohttp import web
 import ccxt.async_support as ccxt
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, TimedOut, NetworkError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+IMPORT_SEC = time.perf_counter() - IMPORT_T0
 
 # ================== CONFIG ==================
 MIN_SPREAD = 1.2            # мин. чистый профит в %
-MIN_VOLUME_1H = 500_000     # мин. объём/1ч ($) по худшей из двух бирж
+MIN_VOLUME_1H = 500_000     # мин. объём/1ч ($) по худшей из двух бирж (префильтр — по 24ч-объёму тикера)
 SCAN_INTERVAL = 120         # автоскан каждые N сек
 TOPN_PER_EXCHANGE = 80      # максимальное кол-во ликвидных пар на биржу
+RECHECK_TOP_K = 0           # точечная перепроверка fetch_ticker для топ-K кандидатов (0 = выкл)
+SCAN_DEADLINE = 60          # сек на скан (меньше SCAN_INTERVAL); не успевшие биржи → частичный результат
+SCAN_CACHE_MAX_AGE = 30     # /scan отдаёт готовый результат, если он не старше N сек
+QUOTE_FRESH_SEC = 10        # котировка сигнала считается свежей N сек — без повторного fetch_ticker
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"  # стриминг котировок вместо bulk-опроса
+STREAM_POLL_INTERVAL = 5    # фолбэк-опрос fetch_tickers (сек) для бирж без стриминга
+STREAM_DEBOUNCE = 0.2       # пачкуем обновления перед пересчётом (сек)
+STREAM_ALERT_INTERVAL = 2   # изменения стрим-сигналов уходят подписчикам не чаще раза в N сек
+VOLUME_TOP_K = 10           # по скольким лучшим кандидатам считаем реальный объём 1ч по свечам (0 = выкл)
+VOLUME_WINDOW_MIN = 60      # окно объёма (минутных бакетов)
+VOLUME_REFRESH_SEC = 60     # минутные свечи рынка догружаем не чаще (сек)
+DEPTH_TOP_K = 5             # по скольким лучшим кандидатам смотрим стаканы (0 = выкл)
+DEPTH_LIMIT = 50            # глубина стакана (уровней)
+DEPTH_NOTIONAL_USDT = 100   # размер сделки для VWAP/профита в сигнале
+MIN_DEPTH_USDT = 10         # сигнал отбрасываем, если прибыльный объём меньше
+OPP_TRACK_MAX = 512         # сколько возможностей держим в трекере жизни (LRU)
+SNAPSHOT_HISTORY = 3        # сколько прошлых компактных снимков держим в памяти
+STABLE_QUOTES = ("USDT", "USDC", "FDUSD")  # котируемые активы, сводимые к BASE/USDT (по приоритету)
+STABLE_DEPEG = 0.02         # курс стейблкоина к USDT дальше от 1 — его рынки не используем
+COLLISION_RATIO = 1.5       # цена тикера расходится с другими биржами сильнее — другая монета
+COLLISION_TTL = 900         # исключение по коллизии держим N сек, потом проверяем инструмент заново
+CYCLE_MAX_HOPS = 5          # макс. рёбер в цикле (сделки + переходы между биржами); 0 = выкл
+CYCLE_MIN_PROFIT = 0.5      # мин. чистый профит цикла в %
+CYCLE_MOVE_COST = 0.0       # цена перехода актива между биржами (доля; инвентарь разложен заранее)
+CYCLE_TOP_K = 5             # сколько лучших циклов отдаём за скан
+SIGNAL_CHANGE_PCT = 0.3     # повторно шлём сигнал, если спред сдвинулся на ≥ N п.п.
 VERSION = "v6.1-stable"
 
 TAKER_FEE_DEFAULT = 0.001   # 0.10% как грубая оценка
 MAKER_FEE_DEFAULT = 0.0008
 
+EX_CONCURRENCY = 4          # одновременных REST-запросов на биржу
+EX_RATE = 10.0              # запросов/сек на биржу (token bucket)
+EX_BURST = 20               # размер «ведра» токенов
+CALL_TIMEOUT = 15           # сек на один REST-вызов
+BACKOFF_MAX = 30            # потолок бэкоффа после 429/таймаутов (сек)
+BREAKER_FAILS = 5           # ошибок подряд до размыкания (биржа → 🟡)
+BREAKER_COOLDOWN = 60       # сек пропускаем деградировавшую биржу, потом пробуем снова
+BALANCE_REFRESH_SEC = 30    # фоновое обновление балансов (сек)
+BALANCE_MAX_AGE = 90        # балансы старше — перед сделкой обновляем синхронно
+INVENTORY_MODE = os.getenv("INVENTORY_MODE", "flag")  # сигналы без инвентаря: off / flag (пометить) / drop
+INVENTORY_MIN_USDT = 10     # меньше — считаем, что инвентаря под ногу нет ($)
+BALANCE_DUST_USDT = 1.0     # в /balance не показываем активы дешевле ($)
+INIT_DEADLINE = 20          # сек на старт одной биржи (load_markets), дальше — ❌
+MARKETS_CACHE_DIR = os.getenv("MARKETS_CACHE_DIR", ".cache/markets")
+MARKETS_CACHE_TTL = 3600    # кэш рынков старше N сек обновляем в фоне
+MARKETS_CACHE_MAX_AGE = 7 * 86400  # старше — кэш не используем вовсе
+RECORD_DIR = os.getenv("RECORD_DIR", "")  # запись снимков для replay.py (пусто = выкл)
+RECORD_CHUNK_SCANS = 30     # сканов в одном сжатом чанке записи
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Prometheus-эндпоинт /metrics (0 = выкл)
+LOOP_LAG_INTERVAL = 0.5     # период замера задержки event loop (сек)
+HOT_SYMBOLS = 20            # горячих символов: точечный перезапрос каждые HOT_INTERVAL сек (0 = выкл)
+HOT_INTERVAL = 5            # период точечного опроса горячих символов (сек)
+WARM_SYMBOLS = 60           # тёплых символов: точечный перезапрос каждые WARM_INTERVAL сек
+WARM_INTERVAL = 30          # период точечного опроса тёплых символов (сек)
+TIER_DECAY = 0.7            # вес прошлого в скоринге символа (EWMA по замерам)
+TIER_SIGNAL_BONUS = 1.0     # прибавка к скорингу, если символ дал сигнал (п.п.)
+HOT_CHECK_K = 3             # кандидатов точечного опроса, проверяемых по объёму 1ч и стаканам
+TIER_RATE_SHARE = 0.3       # доля лимита биржи на поштучный fetch_ticker горячих/тёплых символов
+# ccxt-id бирж, где fetch_tickers(symbols) фильтрует на сервере; у остальных (mexc, gate, bitget, …)
+# он качает весь список тикеров — точечный опрос там идёт поштучным fetch_ticker
+TICKERS_FILTER_SERVER = {"binance"}
+HTTP_POOL_LIMIT = 8         # соединений в keep-alive пуле на биржу (лимит сокетов)
+HTTP_KEEPALIVE = 60         # сек держим простаивающее соединение открытым
+HTTP_DNS_TTL = 600          # кэш DNS (сек)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))  # процессов для сбора снимков (0 = всё в одном процессе)
+SHARD_RATE_SHARE = 0.5      # доля лимита запросов биржи, отдаваемая её шарду (остальное — главному процессу)
+STATE_DB = os.getenv("STATE_DB", ".cache/state.db")  # SQLite с подписками/сделками (на Render — на persistent disk)
+STATE_FLUSH_SEC = 1.0       # период пакетной записи состояния (сек)
+PENDING_TTL = 900           # незавершённая сделка (ввод суммы/подтверждение) живёт N сек
+TG_GLOBAL_RATE = 25         # сообщений/сек на бота (лимит Telegram ~30)
+TG_CHAT_RATE = 1.0          # сообщений/сек в один чат
+TG_CHAT_BURST = 3           # запас «ведра» на чат
+TG_QUEUE_MAX = 50           # очередь на чат; переполнение — выкидываем самые старые
+TG_RETRIES = 5              # попыток доставки (RetryAfter / сеть)
+TG_IDLE_SEC = 60            # воркер чата без сообщений столько сек — завершаем
+TG_MAX_LEN = 4096           # лимит длины сообщения Telegram
+
+# ================== EXCHANGE REGISTRY ==================
+# биржа -> класс ccxt (имя в ccxt.async_support) и {параметр ccxt: переменная окружения с ключом}.
+# Включены биржи из EXCHANGES (через запятую) или из JSON-файла EXCHANGES_CONFIG:
+#   {"enabled": ["mexc", "okx"], "exchanges": {"okx": {"class": "okx", "credentials": {"apiKey": "OKX_API_KEY", ...}}}}
+# (записи из файла дополняют/переопределяют реестр).
+ENABLED_EXCHANGES = os.getenv("EXCHANGES", "mexc,bitget,bigone,gate")
+EXCHANGES_CONFIG = os.getenv("EXCHANGES_CONFIG", "")
+EXCHANGE_REGISTRY: Dict[str, Dict[str, Any]] = {
+    "mexc": {"class": "mexc", "credentials": {"apiKey": "MEXC_API_KEY", "secret": "MEXC_API_SECRET"}},
+    "bitget": {"class": "bitget", "credentials": {"apiKey": "BITGET_API_KEY", "secret": "BITGET_API_SECRET",
+                                                  "password": "BITGET_API_PASSPHRASE"}},
+    "bigone": {"class": "bigone", "credentials": {"apiKey": "BIGONE_API_KEY", "secret": "BIGONE_API_SECRET"}},
+    "gate": {"class": "gate", "credentials": {"apiKey": "GATE_API_KEY", "secret": "GATE_API_SECRET"}},
+    "kucoin": {"class": "kucoin", "credentials": {"apiKey": "KUCOIN_API_KEY", "secret": "KUCOIN_API_SECRET",
+                                                  "password": "KUCOIN_PASSWORD"}},
+    "okx": {"class": "okx", "credentials": {"apiKey": "OKX_API_KEY", "secret": "OKX_API_SECRET",
+                                            "password": "OKX_API_PASSPHRASE"}},
+    "binance": {"class": "binance", "credentials": {"apiKey": "BINANCE_API_KEY", "secret": "BINANCE_API_SECRET"}},
+    "htx": {"class": "htx", "credentials": {"apiKey": "HTX_API_KEY", "secret": "HTX_API_SECRET"}},
+    "kraken": {"class": "kraken", "credentials": {"apiKey": "KRAKEN_API_KEY", "secret": "KRAKEN_API_SECRET"}},
+    "crypto": {"class": "cryptocom", "credentials": {"apiKey": "CRYPTO_API_KEY", "secret": "CRYPTO_API_SECRET"}},
+    "bybit": {"class": "bybit", "credentials": {"apiKey": "BYBIT_API_KEY", "secret": "BYBIT_API_SECRET"}},  # 403 CloudFront с Render
+}
+
 # ================== ENV ==================
 env = {
-    "MEXC_API_KEY": os.getenv("MEXC_API_KEY"),
-    "MEXC_API_SECRET": os.getenv("MEXC_API_SECRET"),
-
-    "BITGET_API_KEY": os.getenv("BITGET_API_KEY"),
-    "BITGET_API_SECRET": os.getenv("BITGET_API_SECRET"),
-    "BITGET_API_PASSPHRASE": os.getenv("BITGET_API_PASSPHRASE"),
-
-    "BIGONE_API_KEY": os.getenv("BIGONE_API_KEY"),
-    "BIGONE_API_SECRET": os.getenv("BIGONE_API_SECRET"),
-
-    #"KUCOIN_API_KEY": os.getenv("KUCOIN_API_KEY"),
-    #"KUCOIN_API_SECRET": os.getenv("KUCOIN_API_SECRET"),
-    #"KUCOIN_PASSWORD": os.getenv("KUCOIN_PASSWORD"),
-    
-    #"BINANCE_API_KEY": os.getenv("BINANCE_API_KEY"),
-    #"BINANCE_API_SECRET": os.getenv("BINANCE_API_SECRET"),
-
-    #"OKX_API_KEY": os.getenv("OKX_API_KEY"),
-    #"OKX_API_SECRET": os.getenv("OKX_API_SECRET"),
-    #"OKX_API_PASSPHRASE": os.getenv("OKX_API_PASSPHRASE"),
-    
-    # BYBIT отключён (403 CloudFront с Render)
-    # "BYBIT_API_KEY": os.getenv("BYBIT_API_KEY"),
-    # "BYBIT_API_SECRET": os.getenv("BYBIT_API_SECRET"),
-
-    "GATE_API_KEY": os.getenv("GATE_API_KEY"),
-    "GATE_API_SECRET": os.getenv("GATE_API_SECRET"),
-
-    #"HTX_API_KEY": os.getenv("HTX_API_KEY"),
-    #"HTX_API_SECRET": os.getenv("HTX_API_SECRET"),
-
-    #"KRAKEN_API_KEY": os.getenv("KRAKEN_API_KEY"),
-    #"KRAKEN_API_SECRET": os.getenv("KRAKEN_API_SECRET"),
-
-    #"CRYPTO_API_KEY": os.getenv("CRYPTO_API_KEY"),
-    #"CRYPTO_API_SECRET": os.getenv("CRYPTO_API_SECRET"),
-
     "TELEGRAM_BOT_TOKEN": os.getenv("TELEGRAM_BOT_TOKEN"),
     "CHAT_ID": os.getenv("CHAT_ID"),
 }
 BOT_TOKEN = env["TELEGRAM_BOT_TOKEN"]
-if not BOT_TOKEN:
-    raise SystemExit("❌ Нет TELEGRAM_BOT_TOKEN")
 
 # ================== PREP ==================
 nest_asyncio.apply()
 START_TIME = datetime.now()
 LAST_SCAN_AT: datetime | None = None  # время последнего успешного скана
+LAST_SCAN_STATS: Dict[str, Any] = {}  # длительность скана, кол-во HTTP-запросов и т.п.
+HTTP_CALLS = 0                        # счётчик REST-запросов к биржам (за всё время)
+STARTUP: Dict[str, float] = {"import": IMPORT_SEC}  # разбивка времени старта по этапам (сек)
 
 # ================== GLOBALS ==================
 app: Application | None = None
+ccxtpro: Any = None                             # ccxt.pro — импорт по первому требованию (STREAM_MODE)
 exchanges: Dict[str, ccxt.Exchange] = {}
 exchange_status: Dict[str, Dict[str, Any]] = {}
-scanlog_enabled: Set[int] = set()
-pending_trades: Dict[int, Dict[str, Any]] = {}  # chat_id -> {cheap, expensive, symbol, usdt?}
+_fee_cache: Dict[str, Tuple[Dict[str, float], float]] = {}  # биржа -> ({symbol: taker}, taker по умолчанию)
+_fee_vec: Dict[str, np.ndarray] = {}            # биржа -> taker по id символа (граф циклов)
+_book_cache: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}  # (биржа, symbol) -> (ts, стакан)
+_bg_tasks: Set[asyncio.Task] = set()            # фоновые задачи (держим ссылки от GC)
+schedulers: Dict[int, "ExchangeScheduler"] = {}  # id(ex) -> планировщик запросов биржи
+balances: "BalanceCache | None" = None          # тёплый кэш балансов для сделок
+execution_log: deque = deque(maxlen=100)        # последние исполнения (латентность/филлы по ногам)
+LAST_RESULT: "ScanResult | None" = None         # общий снимок результатов для всех чатов
+_scan_task: asyncio.Task | None = None          # текущий скан (single-flight)
+live_stream: "MarketStream | None" = None       # стриминг котировок (STREAM_MODE)
+evaluator: "IncrementalEvaluator | None" = None  # диф bulk-снимков между сканами
+tracker: "OpportunityTracker | None" = None     # время жизни возможностей
+poller: "TieredPoller | None" = None            # точечный опрос горячих символов (bulk-режим)
+shard_pool: "ShardPool | None" = None          # процессы-воркеры снимков (SHARD_WORKERS)
+recorder: "TickRecorder | None" = None          # запись снимков (RECORD_DIR)
+snapshot_history: deque = deque(maxlen=SNAPSHOT_HISTORY)  # последние компактные снимки {биржа: VenueQuotes}
 
 # ================== UTILS ==================
 def log(msg: str):
@@ -112,87 +211,391 @@ def last_scan_str() -> str:
         return "—"
     return LAST_SCAN_AT.strftime("%Y-%m-%d %H:%M:%S")
 
+def scan_stats_str() -> str:
+    if not LAST_SCAN_STATS:
+        return "—"
+    st = LAST_SCAN_STATS
+    return f"{st['duration']:.2f} c, HTTP-запросов: {st['http_calls']}"
+
+# ================== METRICS ==================
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+class Histogram:
+    """Кумулятивная гистограмма в стиле Prometheus + последние значения для /perf."""
+    __slots__ = ("bounds", "counts", "sum", "count", "last", "max")
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины (для +Inf — максимум)."""
+        if not self.count:
+            return 0.0
+        rank, acc = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def prometheus(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        tail = f"{{{labels}}}" if labels else ""
+        lines, acc = [], 0
+        for bound, c in zip(self.bounds + (float("inf"),), self.counts):
+            acc += c
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {acc}')
+        lines.append(f"{name}_sum{tail} {self.sum:.6f}")
+        lines.append(f"{name}_count{tail} {self.count}")
+        return lines
+
+class Metrics:
+    """
+    Метрики горячего пути: латентность REST по биржам и методам, ошибки/таймауты,
+    фазы скана, очередь к биржам, задержка event loop. Отдаются в /perf и /metrics.
+    """
+    def __init__(self):
+        self.calls: Dict[Tuple[str, str], Histogram] = {}  # (биржа, метод)
+        self.errors: Dict[Tuple[str, str], int] = {}       # (биржа, вид ошибки)
+        self.phases: Dict[str, Histogram] = {}
+        self.loop_lag = Histogram((0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+    def observe_call(self, venue: str, method: str, sec: float):
+        h = self.calls.get((venue, method))
+        if h is None:
+            h = self.calls[(venue, method)] = Histogram()
+        h.observe(sec)
+
+    def count_error(self, venue: str, kind: str):
+        self.errors[(venue, kind)] = self.errors.get((venue, kind), 0) + 1
+
+    def observe_phase(self, phase: str, sec: float):
+        h = self.phases.get(phase)
+        if h is None:
+            h = self.phases[phase] = Histogram()
+        h.observe(sec)
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(name, time.perf_counter() - t0)
+
+    def venue_calls(self, venue: str) -> Histogram:
+        """Все методы биржи одной гистограммой."""
+        total = Histogram()
+        for (v, _), h in self.calls.items():
+            if v != venue:
+                continue
+            total.counts = [a + b for a, b in zip(total.counts, h.counts)]
+            total.sum += h.sum
+            total.count += h.count
+            total.max = max(total.max, h.max)
+        return total
+
+    async def watch_loop(self, interval: float = LOOP_LAG_INTERVAL):
+        """Насколько позже положенного просыпается sleep — блокировки event loop."""
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, time.monotonic() - t0 - interval))
+
+    def prometheus(self) -> str:
+        out = ["# TYPE scanner_call_duration_seconds histogram"]
+        for (venue, method), h in sorted(self.calls.items()):
+            out += h.prometheus("scanner_call_duration_seconds", f'venue="{venue}",method="{method}"')
+        out.append("# TYPE scanner_call_errors_total counter")
+        for (venue, kind), n in sorted(self.errors.items()):
+            out.append(f'scanner_call_errors_total{{venue="{venue}",kind="{kind}"}} {n}')
+        out.append("# TYPE scanner_phase_duration_seconds histogram")
+        for phase, h in sorted(self.phases.items()):
+            out += h.prometheus("scanner_phase_duration_seconds", f'phase="{phase}"')
+        out.append("# TYPE scanner_queue_depth gauge")
+        out.append("# TYPE scanner_inflight_requests gauge")
+        for sch in schedulers.values():
+            out.append(f'scanner_queue_depth{{venue="{sch.name}"}} {sch.waiting}')
+            out.append(f'scanner_inflight_requests{{venue="{sch.name}"}} {sch.inflight}')
+        out.append("# TYPE scanner_exchange_up gauge")
+        for name, st in exchange_status.items():
+            up = {"✅": 1, "🟡": 0.5}.get(st["status"], 0)
+            out.append(f'scanner_exchange_up{{venue="{name}"}} {up}')
+        out.append("# TYPE scanner_event_loop_lag_seconds histogram")
+        out += self.loop_lag.prometheus("scanner_event_loop_lag_seconds", "")
+        out.append("# TYPE scanner_outbox_pending gauge")
+        out.append(f"scanner_outbox_pending {outbox.pending}")
+        out.append("# TYPE scanner_outbox_messages_total counter")
+        for kind in ("sent", "retries", "dropped", "failed"):
+            out.append(f'scanner_outbox_messages_total{{state="{kind}"}} {getattr(outbox, kind)}')
+        out.append("# TYPE scanner_http_connections_total counter")
+        for venue in sorted(set(http_pool.opened) | set(http_pool.reused)):
+            out.append(f'scanner_http_connections_total{{venue="{venue}",kind="opened"}} {http_pool.opened.get(venue, 0)}')
+            out.append(f'scanner_http_connections_total{{venue="{venue}",kind="reused"}} {http_pool.reused.get(venue, 0)}')
+        out.append("# TYPE scanner_http_dns_misses_total counter")
+        for venue in sorted(http_pool.dns_misses):
+            out.append(f'scanner_http_dns_misses_total{{venue="{venue}"}} {http_pool.dns_misses[venue]}')
+        out.append("# TYPE scanner_http_calls_total counter")
+        out.append(f"scanner_http_calls_total {HTTP_CALLS}")
+        out.append("# TYPE scanner_ohlcv_candles_total counter")
+        out.append(f"scanner_ohlcv_candles_total {volume_store.candles}")
+        out.append("# TYPE scanner_state_writes_total counter")
+        out.append(f"scanner_state_writes_total {state.writes}")
+        out.append("# TYPE scanner_uptime_seconds gauge")
+        out.append(f"scanner_uptime_seconds {(datetime.now() - START_TIME).total_seconds():.0f}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+async def start_metrics_server(port: int = METRICS_PORT) -> web.AppRunner | None:
+    """Prometheus text-эндпоинт /metrics рядом с webhook-сервером (отдельный порт)."""
+    if not port:
+        return None
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.prometheus(), content_type="text/plain", charset="utf-8")
+    server = web.Application()
+    server.router.add_get("/metrics", handle)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    log(f"📈 Метрики: 0.0.0.0:{port}/metrics")
+    return runner
+
+# ================== MARKETS CACHE ==================
+def _markets_cache_path(name: str, cache_dir: str | None = None) -> str:
+    return os.path.join(cache_dir or MARKETS_CACHE_DIR, f"{name}.json")
+
+def _read_markets_cache(name: str, cache_dir: str | None = None) -> Dict[str, Any] | None:
+    try:
+        with open(_markets_cache_path(name, cache_dir), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - safe_float(data.get("ts")) > MARKETS_CACHE_MAX_AGE or not data.get("markets"):
+        return None
+    return data
+
+def _write_markets_cache(name: str, ex: ccxt.Exchange):
+    os.makedirs(MARKETS_CACHE_DIR, exist_ok=True)
+    path = _markets_cache_path(name)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ts": time.time(), "markets": ex.markets, "currencies": ex.currencies}, f, default=str)
+    os.replace(tmp, path)
+
+async def save_markets_cache(name: str, ex: ccxt.Exchange):
+    try:
+        await asyncio.to_thread(_write_markets_cache, name, ex)
+    except Exception as e:
+        log(f"{name.upper()} кэш рынков не сохранён: {e}")
+
+async def refresh_markets(name: str, ex: ccxt.Exchange):
+    """Фоновое обновление рынков после старта из кэша."""
+    t0 = time.perf_counter()
+    try:
+        await ex.load_markets(reload=True)
+    except Exception as e:
+        log(f"{name.upper()} фоновое обновление рынков ❌ {str(e).split(chr(10))[0][:200]}")
+        return
+    _fee_cache.pop(name, None)
+    _fee_vec.pop(name, None)
+    instrument_index.rebuild(name, ex.markets)
+    await save_markets_cache(name, ex)
+    log(f"{name.upper()} рынки обновлены в фоне ({time.perf_counter() - t0:.2f} c)")
+
+async def markets_refresh_loop():
+    """Рынки всех бирж перечитываем раз в MARKETS_CACHE_TTL — индекс инструментов пересобирается."""
+    while True:
+        await asyncio.sleep(MARKETS_CACHE_TTL)
+        for name, ex in list(exchanges.items()):
+            await refresh_markets(name, ex)  # по очереди — не толкаемся со сканом за лимиты
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
+# ================== HTTP SESSIONS ==================
+class HttpPool:
+    """
+    Свои aiohttp-сессии для ccxt-инстансов (ccxt получает session в конфиге и не владеет ею):
+    на биржу — постоянный keep-alive пул с явными лимитами (HTTP_POOL_LIMIT) и кэшем DNS
+    (HTTP_DNS_TTL) и TLS-контекстом на certifi, как у ccxt со своей сессией. Через TraceConfig
+    считаем новые и переиспользованные соединения и промахи DNS-кэша.
+    Закрывает close_all_exchanges.
+    """
+    def __init__(self):
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        self.opened: Dict[str, int] = {}
+        self.reused: Dict[str, int] = {}
+        self.dns_misses: Dict[str, int] = {}
+        self._ssl: ssl.SSLContext | None = None
+
+    def _trace(self, name: str) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(session, ctx, params):
+            self.opened[name] = self.opened.get(name, 0) + 1
+
+        async def on_reuse(session, ctx, params):
+            self.reused[name] = self.reused.get(name, 0) + 1
+
+        async def on_dns_miss(session, ctx, params):
+            self.dns_misses[name] = self.dns_misses.get(name, 0) + 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_dns_cache_miss.append(on_dns_miss)
+        return trace
+
+    def session(self, name: str) -> aiohttp.ClientSession:
+        """Сессия биржи (создаём при первом обращении, внутри event loop)."""
+        session = self.sessions.get(name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT,
+                ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=HTTP_KEEPALIVE,
+                enable_cleanup_closed=True, family=socket.AF_UNSPEC, happy_eyeballs_delay=0,
+                ssl=self.ssl_context(),
+            )
+            session = self.sessions[name] = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace(name)])
+        return session
+
+    def ssl_context(self) -> ssl.SSLContext:
+        """Один TLS-контекст на все сессии (загрузка CA-бандла недешёвая)."""
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context(cafile=certifi.where())
+        return self._ssl
+
+    async def close(self, name: str | None = None):
+        names = list(self.sessions) if name is None else [name]
+        for n in names:
+            session = self.sessions.pop(n, None)
+            if session is not None and not session.closed:
+                await session.close()
+
+http_pool = HttpPool()
+
 # ================== EXCH INIT/CLOSE ==================
-async def init_exchanges():
+def load_registry() -> Dict[str, Dict[str, Any]]:
+    """Включённые биржи {name: {"class", "credentials"}}: из EXCHANGES_CONFIG, если задан, иначе по EXCHANGES."""
+    registry = dict(EXCHANGE_REGISTRY)
+    enabled = [n.strip().lower() for n in ENABLED_EXCHANGES.split(",") if n.strip()]
+    if EXCHANGES_CONFIG:
+        with open(EXCHANGES_CONFIG, encoding="utf-8") as f:
+            cfg = json.load(f)
+        registry.update(cfg.get("exchanges") or {})
+        enabled = cfg.get("enabled", enabled)
+    unknown = [n for n in enabled if n not in registry]
+    if unknown:
+        log(f"⚠️ Нет в реестре бирж: {', '.join(unknown)}")
+    return {n: registry[n] for n in enabled if n in registry}
+
+def exchange_candidates() -> Dict[str, Tuple[type, Dict[str, Any]]]:
+    """
+    Биржи-кандидаты {name: (класс ccxt, параметры)} по реестру: класс берём по имени только для
+    включённых бирж, ключи — из переменных окружения, названных в реестре.
+    """
+    out = {}
+    for name, spec in load_registry().items():
+        cls = getattr(ccxt, spec.get("class", name), None)
+        if cls is None:
+            log(f"{name.upper()} ❌ в ccxt нет класса {spec.get('class', name)!r}")
+            continue
+        out[name] = (cls, {param: os.getenv(var) for param, var in (spec.get("credentials") or {}).items()})
+    return out
+
+async def init_exchanges(candidates: Dict[str, Tuple[type, Dict[str, Any]]] | None = None,
+                         shard: "ShardSettings | None" = None):
     """
-    Инициализация подключенных бирж.
-    Чтобы временно отключить биржу — просто закомментируй её в 'candidates'.
+    Инициализация подключенных бирж — все кандидаты параллельно, у каждой свой дедлайн INIT_DEADLINE.
+    Рынки берём из дискового кэша (если есть) и обновляем в фоне, иначе — load_markets().
+    Набор бирж — реестр (EXCHANGES / EXCHANGES_CONFIG), см. exchange_candidates().
+    candidates можно передать явно ({name: (класс, параметры)}) — так бенчмарки подставляют фейковые биржи.
+    shard — запуск в воркере: кэш рынков только читаем (пишет и обновляет его главный процесс).
     """
     global exchanges, exchange_status
     exchanges, exchange_status = {}, {}
+    _fee_cache.clear()
+    _fee_vec.clear()
+    instrument_index.clear()
+    volume_store.windows.clear()
+    schedulers.clear()
+    t_start = time.perf_counter()
 
     async def try_init(name, ex_class, **kwargs):
+        """-> (статус, инстанс | None)"""
         if not all(kwargs.values()):
-            exchange_status[name] = {"status": "⚪", "error": "нет API", "ex": None}
             log(f"{name.upper()} ⚪ пропущен — нет API ключей")
-            return None
+            return {"status": "⚪", "error": "нет API", "ex": None}, None
+        t0 = time.perf_counter()
+        ex = None
+        config = {
+            **kwargs,
+            "enableRateLimit": True,
+            "options": {"defaultType": "spot"},
+            "timeout": 30000,
+        }
+        if issubclass(ex_class, ccxt.Exchange):
+            config["session"] = http_pool.session(name)  # пул соединений наш — ccxt его не закрывает
         try:
-            ex = ex_class({
-                **kwargs,
-                "enableRateLimit": True,
-                "options": {"defaultType": "spot"},
-                "timeout": 30000,
-            })
-            await ex.load_markets()
-            exchange_status[name] = {"status": "✅", "error": None, "ex": ex}
-            log(f"{name.upper()} ✅ инициализирован 🟢")
-            return ex
+            ex = ex_class(config)
+            cached = await asyncio.to_thread(_read_markets_cache, name, shard and shard.markets_cache_dir)
+            if cached:
+                ex.set_markets(cached["markets"], cached.get("currencies"))
+                source = "кэш"
+                if time.time() - cached["ts"] > MARKETS_CACHE_TTL and shard is None:
+                    spawn(refresh_markets(name, ex))
+            else:
+                await asyncio.wait_for(ex.load_markets(), INIT_DEADLINE)
+                source = "сеть"
+                if shard is None:
+                    spawn(save_markets_cache(name, ex))
+            log(f"{name.upper()} ✅ инициализирован 🟢 ({time.perf_counter() - t0:.2f} c, рынки: {source})")
+            return {"status": "✅", "error": None, "ex": ex}, ex
         except Exception as e:
-            err = str(e).split("\n")[0][:200]
-            exchange_status[name] = {"status": "❌", "error": err, "ex": None}
-            log(f"{name.upper()} ❌ {err}")
-            return None
+            if isinstance(e, asyncio.TimeoutError):
+                err = f"таймаут старта {INIT_DEADLINE} c"
+            else:
+                err = str(e).split("\n")[0][:200]
+            log(f"{name.upper()} ❌ {err} ({time.perf_counter() - t0:.2f} c)")
+            if ex is not None:
+                try:
+                    await ex.close()
+                except Exception:
+                    pass
+            await http_pool.close(name)
+            return {"status": "❌", "error": err, "ex": None}, None
 
-    candidates = {
-        # === ENABLED BY DEFAULT ===
-        "mexc": (ccxt.mexc, {
-            "apiKey": env["MEXC_API_KEY"], "secret": env["MEXC_API_SECRET"]
-        }),
-        "bitget": (ccxt.bitget, {
-            "apiKey": env["BITGET_API_KEY"], "secret": env["BITGET_API_SECRET"], "password": env["BITGET_API_PASSPHRASE"]
-        }),
-        "bigone": (ccxt.bigone, {
-            "apiKey": env["BIGONE_API_KEY"], "secret": env["BIGONE_API_SECRET"]
-        }),
-        #"kucoin": (ccxt.kucoin, {
-        #    "apiKey": env["KUCOIN_API_KEY"], "secret": env["KUCOIN_API_SECRET"], "password": env["KUCOIN_PASSWORD"]
-        #}),
-        
-        #"okx": (ccxt.okx, {
-        #    "apiKey": env["OKX_API_KEY"], "secret": env["OKX_API_SECRET"],
-        #    "password": env["OKX_API_PASSPHRASE"]
-        #}),
-        # === OPTIONAL — UNCOMMENT TO ENABLE ===
-        # "binance": (ccxt.binance, {
-        #     "apiKey": env["BINANCE_API_KEY"], "secret": env["BINANCE_API_SECRET"]
-        # }),
-        "gate": (ccxt.gate, {
-            "apiKey": env["GATE_API_KEY"], "secret": env["GATE_API_SECRET"]
-        }),
-
-        # }),
-        # "htx": (ccxt.huobi, {
-        #     "apiKey": env["HTX_API_KEY"], "secret": env["HTX_API_SECRET"]
-        # }),
-        # "kraken": (ccxt.kraken, {
-        #     "apiKey": env["KRAKEN_API_KEY"], "secret": env["KRAKEN_API_SECRET"]
-        # }),
-        # "crypto": (ccxt.cryptocom, {
-        #     "apiKey": env["CRYPTO_API_KEY"], "secret": env["CRYPTO_API_SECRET"]
-        # }),
-        # "bybit": (ccxt.bybit, {   # CloudFront 403 с Render — отключено
-        #     "apiKey": env.get("BYBIT_API_KEY"), "secret": env.get("BYBIT_API_SECRET")
-        # }),
-    }
+    candidates = candidates if candidates is not None else exchange_candidates()
 
-    for name, (cls, params) in candidates.items():
-        ex = await try_init(name, cls, **params)
+    inits = await asyncio.gather(*(try_init(name, cls, **params) for name, (cls, params) in candidates.items()))
+    for name, (status, ex) in zip(candidates, inits):
+        exchange_status[name] = status
         if ex:
             exchanges[name] = ex
+            instrument_index.rebuild(name, ex.markets)
 
     active = [k for k, v in exchange_status.items() if v["status"] == "✅"]
     log(f"Активные биржи: {', '.join(active) if active else '—'} 🟩")
-    log(f"Инициализация завершена: {len(active)}/{len(exchange_status)} активны.")
+    log(f"Инициализация завершена: {len(active)}/{len(exchange_status)} активны за {time.perf_counter() - t_start:.2f} c.")
 
 async def close_all_exchanges():
     for name, ex in list(exchanges.items()):
@@ -201,96 +604,2281 @@ async def close_all_exchanges():
             log(f"{name.upper()} закрыт ✅")
         except Exception as e:
             log(f"{name.upper()} ошибка закрытия: {e}")
+    await http_pool.close()
+
+# ================== REQUEST SCHEDULER ==================
+class ExchangeUnavailable(Exception):
+    """Биржа в паузе (circuit breaker / бэкофф) — запрос не отправлялся."""
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def take(self):
+        """Токен без ожидания: при пустом ведре уходим в минус — долг отдадут следующие запросы."""
+        self._refill()
+        self.tokens -= 1
+
+class ExchangeScheduler:
+    """
+    Обёртка над REST-вызовами одной биржи: лимит параллельности, token bucket,
+    бэкофф на 429/таймауты и circuit breaker. Разомкнутая биржа помечается 🟡
+    в exchange_status, пропускается BREAKER_COOLDOWN сек, затем один пробный запрос.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.sem = asyncio.Semaphore(EX_CONCURRENCY)
+        self.bucket = TokenBucket(EX_RATE, EX_BURST)
+        self.fails = 0
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+        self.open_until = 0.0
+        self.probing = False
+        self.waiting = 0   # ждут семафор / токен (очередь к бирже)
+        self.inflight = 0  # запросов в полёте
+
+    @property
+    def degraded(self) -> bool:
+        return self.open_until > 0
+
+    @property
+    def backoff_left(self) -> float:
+        return max(0.0, self.backoff_until - time.monotonic())
+
+    def _check_open(self) -> bool:
+        """True — этот вызов пробный (кулдаун прошёл, пропускаем один запрос)."""
+        if not self.degraded:
+            return False
+        if time.monotonic() < self.open_until or self.probing:
+            raise ExchangeUnavailable(f"{self.name}: деградация, пауза")
+        self.probing = True
+        return True
+
+    def _on_success(self):
+        self.fails = 0
+        self.backoff = 0.0
+        if self.degraded:
+            self.open_until = 0.0
+            st = exchange_status.get(self.name)
+            if st and st["status"] == "🟡":
+                st["status"], st["error"] = "✅", None
+            log(f"{self.name.upper()} ✅ восстановлена после деградации")
+        self.probing = False
+
+    def _on_failure(self, err: Exception, rate_limited: bool):
+        self.fails += 1
+        if rate_limited or isinstance(err, (asyncio.TimeoutError, ccxt.RequestTimeout)):
+            self.backoff = min(max(self.backoff * 2, 1.0), BACKOFF_MAX)
+            self.backoff_until = time.monotonic() + self.backoff
+        if self.probing or self.fails >= BREAKER_FAILS:
+            self.probing = False
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            msg = str(err).split("\n")[0][:120] or type(err).__name__
+            st = exchange_status.get(self.name)
+            if st and st["status"] in ("✅", "🟡"):
+                st["status"], st["error"] = "🟡", f"деградация: {msg} (пауза {BREAKER_COOLDOWN} c)"
+            log(f"{self.name.upper()} 🟡 деградация ({self.fails} ошибок подряд): {msg}")
+
+    @asynccontextmanager
+    async def _slot(self, priority: bool = False):
+        """Семафор + токен; пока ждём — запрос числится в очереди (waiting).
+        priority (ордера): мимо очереди — токен берём в долг, семафор не ждём (бэкофф и
+        CALL_TIMEOUT в call() для них тоже не действуют)."""
+        if priority:
+            self.bucket.take()
+            self.inflight += 1
+            try:
+                yield
+            finally:
+                self.inflight -= 1
+            return
+        self.waiting += 1
+        held = False
+        try:
+            await self.sem.acquire()
+            held = True
+            await self.bucket.acquire()
+        except BaseException:
+            self.waiting -= 1
+            if held:
+                self.sem.release()
+            raise
+        self.waiting -= 1
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self.sem.release()
+
+    async def call(self, ex: ccxt.Exchange, method: str, *args, priority: bool = False, **kwargs):
+        try:
+            probe = self._check_open()
+        except ExchangeUnavailable:
+            metrics.count_error(self.name, "skipped")
+            raise
+        try:
+            return await self._call(ex, method, args, kwargs, priority)
+        except BaseException:
+            if probe:
+                self.probing = False  # проба отменена/упала — без вердикта; следующий вызов пробует снова
+            raise
+
+    async def _call(self, ex: ccxt.Exchange, method: str, args: tuple, kwargs: Dict[str, Any], priority: bool):
+        global HTTP_CALLS
+        wait = self.backoff_until - time.monotonic()
+        if wait > CALL_TIMEOUT and not priority:
+            metrics.count_error(self.name, "skipped")
+            raise ExchangeUnavailable(f"{self.name}: бэкофф {wait:.0f} c")
+        if wait > 0 and not priority:
+            await asyncio.sleep(wait)
+        async with self._slot(priority):
+            HTTP_CALLS += 1
+            t0 = time.perf_counter()
+            try:
+                request = getattr(ex, method)(*args, **kwargs)
+                # ордер на клиенте не обрываем: ждём ответа биржи (таймаут — у самого ccxt, "timeout")
+                res = await (request if priority else asyncio.wait_for(request, CALL_TIMEOUT))
+            except (ccxt.RateLimitExceeded, ccxt.DDoSProtection) as e:
+                metrics.count_error(self.name, "rate_limit")
+                self._on_failure(e, rate_limited=True)
+                raise
+            except (ccxt.RequestTimeout, asyncio.TimeoutError) as e:
+                metrics.count_error(self.name, "timeout")
+                self._on_failure(e, rate_limited=False)
+                raise
+            except ccxt.NetworkError as e:
+                metrics.count_error(self.name, "network")
+                self._on_failure(e, rate_limited=False)
+                raise
+            except Exception:
+                metrics.count_error(self.name, "error")
+                self.probing = False  # ответ получили (BadSymbol и т.п.) — биржа жива
+                raise
+            finally:
+                metrics.observe_call(self.name, method, time.perf_counter() - t0)
+        self._on_success()
+        return res
+
+def scheduler_for(ex: ccxt.Exchange) -> ExchangeScheduler:
+    sch = schedulers.get(id(ex))
+    if sch is None:
+        name = next((n for n, e in exchanges.items() if e is ex), ex.id)
+        sch = schedulers[id(ex)] = ExchangeScheduler(name)
+    return sch
 
 # ================== MARKET DATA / SCAN ==================
-async def get_top_symbols(ex: ccxt.Exchange, top_n=TOPN_PER_EXCHANGE) -> List[str]:
-    tickers = await ex.fetch_tickers()
-    rows = []
-    for s, t in tickers.items():
-        if ":" in s or not s.endswith("/USDT"):
-            continue
-        qv = safe_float(t.get("quoteVolume") or (t.get("info") or {}).get("quoteVolume"))
-        rows.append((s, qv))
-    rows.sort(key=lambda x: x[1], reverse=True)
-    return [s for s, _ in rows[:top_n]]
-
-async def scan_all_pairs(chat_id: int | None = None) -> List[Dict[str, Any]]:
-    global LAST_SCAN_AT
-    # собрать универcальный список символов
-    symbol_set: Set[str] = set()
-    for name, ex in exchanges.items():
+async def api_call(ex: ccxt.Exchange, method: str, *args, priority: bool = False, **kwargs):
+    """Единая точка REST-вызовов к бирже: планировщик биржи + счётчик HTTP-запросов.
+    priority=True — ордера: без очереди, бэкоффа и CALL_TIMEOUT, но с брейкером и учётом лимита."""
+    return await scheduler_for(ex).call(ex, method, *args, priority=priority, **kwargs)
+
+def parse_ticker(t: Dict[str, Any]) -> Tuple[float, float, float]:
+    bid = safe_float(t.get("bid"))
+    ask = safe_float(t.get("ask"))
+    qv = safe_float(t.get("quoteVolume") or (t.get("info") or {}).get("quoteVolume"))
+    return bid, ask, qv
+
+class SymbolTable:
+    """
+    Интернирование символов: строка ↔ int id, общий для всех бирж и снимков.
+    Для каждого символа храним id базового и котируемого активов (граф валют).
+    """
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.asset_ids: Dict[str, int] = {}
+        self.asset_names: List[str] = []
+        self.base: List[int] = []
+        self.quote: List[int] = []
+        self._arrays: Tuple[np.ndarray, np.ndarray] | None = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def asset(self, code: str) -> int:
+        i = self.asset_ids.get(code)
+        if i is None:
+            i = self.asset_ids[code] = len(self.asset_names)
+            self.asset_names.append(code)
+        return i
+
+    def intern(self, symbol: str) -> int:
+        i = self.ids.get(symbol)
+        if i is None:
+            i = self.ids[symbol] = len(self.names)
+            self.names.append(symbol)
+            base, _, quote = symbol.partition("/")
+            self.base.append(self.asset(base))
+            self.quote.append(self.asset(quote))
+        return i
+
+    def pair_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(base, quote) — id активов по id символа."""
+        if self._arrays is None or len(self._arrays[0]) != len(self.names):
+            self._arrays = (np.array(self.base, dtype=np.int32), np.array(self.quote, dtype=np.int32))
+        return self._arrays
+
+symbol_table = SymbolTable()
+
+class VenueQuotes:
+    """
+    Компактный снимок одной биржи: id символов (int32) + bid/ask/объём (float64).
+    Сырые ccxt-тикеры (с payload 'info') после разбора не храним.
+    """
+    __slots__ = ("ids", "bid", "ask", "vol", "ts")
+
+    def __init__(self, ids: np.ndarray, bid: np.ndarray, ask: np.ndarray, vol: np.ndarray, ts: float):
+        self.ids = ids
+        self.bid = bid
+        self.ask = ask
+        self.vol = vol
+        self.ts = ts
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_quotes(cls, quotes: Dict[str, Tuple[float, float, float]], ts: float) -> "VenueQuotes":
+        ids = np.fromiter((symbol_table.intern(s) for s in quotes), dtype=np.int32, count=len(quotes))
+        arr = np.array(list(quotes.values()), dtype=float).reshape(len(quotes), 3)
+        return cls(ids, arr[:, 0].copy(), arr[:, 1].copy(), arr[:, 2].copy(), ts)
+
+def parse_tickers(tickers: Dict[str, Dict[str, Any]], ts: float) -> VenueQuotes:
+    """
+    Разбор bulk-ответа fetch_tickers сразу в массивы — все спотовые пары
+    (USDT — для парного арбитража, остальные — для мульти-хоп циклов).
+    """
+    return VenueQuotes.from_quotes(
+        {s: parse_ticker(t) for s, t in tickers.items() if ":" not in s and "/" in s}, ts)
+
+async def fetch_snapshot(ex: ccxt.Exchange) -> VenueQuotes:
+    """Снимок биржи одним bulk-запросом fetch_tickers в компактном виде."""
+    tickers = await api_call(ex, "fetch_tickers")
+    snap = parse_tickers(tickers, time.time())
+    del tickers  # сырой ответ больше не нужен
+    return snap
+
+def get_top_symbols(snapshot: Dict[str, VenueQuotes], top_n=TOPN_PER_EXCHANGE) -> np.ndarray:
+    """
+    Объединение топ-N ликвидных инструментов каждой биржи — канонические id (BASE/USDT)
+    по индексу инструментов, объём в USDT; по возрастанию id.
+    """
+    if not snapshot:
+        return np.empty(0, dtype=np.int32)
+    tops = []
+    for name, vq in snapshot.items():
+        canon, factor = instrument_index.translate(name, vq)
+        sel = canon >= 0
+        order = np.argsort(-(vq.vol * factor)[sel], kind="stable")[:top_n]
+        tops.append(canon[sel][order])
+    return np.unique(np.concatenate(tops)).astype(np.int32)
+
+class QuoteMatrix:
+    """
+    Плотный снимок symbol × exchange: bid / ask / объём (NaN — нет котировки),
+    ts — время снимка каждой биржи (epoch, сек), ids — id символов (если строили из компактного снимка).
+    """
+    __slots__ = ("symbols", "venues", "bid", "ask", "vol", "ts", "ids")
+
+    def __init__(self, symbols: List[str], venues: List[str],
+                 bid: np.ndarray, ask: np.ndarray, vol: np.ndarray, ts: np.ndarray,
+                 ids: np.ndarray | None = None):
+        self.symbols = symbols
+        self.venues = venues
+        self.bid = bid
+        self.ask = ask
+        self.vol = vol
+        self.ts = ts
+        self.ids = ids
+
+    def take(self, rows: np.ndarray) -> "QuoteMatrix":
+        return QuoteMatrix([self.symbols[r] for r in rows.tolist()], self.venues,
+                           self.bid[rows], self.ask[rows], self.vol[rows], self.ts,
+                           None if self.ids is None else self.ids[rows])
+
+def build_matrix(snapshot: Dict[str, VenueQuotes], ids: np.ndarray) -> QuoteMatrix:
+    """
+    Матрица по компактным снимкам — без Python-циклов по символам. ids — канонические
+    инструменты; родные пары бирж сводятся к ним через индекс (цены — в USDT).
+    """
+    venues = list(snapshot.keys())
+    shape = (len(ids), len(venues))
+    bid = np.full(shape, np.nan)
+    ask = np.full(shape, np.nan)
+    vol = np.full(shape, np.nan)
+    pos = np.full(len(symbol_table), -1, dtype=np.int64)
+    pos[ids] = np.arange(len(ids))
+    for e, name in enumerate(venues):
+        vq = snapshot[name]
+        canon, factor = instrument_index.translate(name, vq)
+        rows = np.where(canon >= 0, pos[canon], -1)
+        hit = rows >= 0
+        bid[rows[hit], e] = vq.bid[hit] * factor[hit]
+        ask[rows[hit], e] = vq.ask[hit] * factor[hit]
+        vol[rows[hit], e] = vq.vol[hit] * factor[hit]
+    ts = np.array([snapshot[name].ts for name in venues], dtype=float)
+    names = symbol_table.names
+    m = QuoteMatrix([names[i] for i in ids.tolist()], venues, bid, ask, vol, ts, ids)
+    instrument_index.screen(m)
+    return m
+
+def matrix_from_quotes(snapshot: Dict[str, Dict[str, Tuple[float, float, float]]],
+                       symbols: List[str], ts: Dict[str, float] | None = None) -> QuoteMatrix:
+    """Матрица по dict-котировкам (перепроверка, живой стрим) — для небольшого числа символов."""
+    venues = list(snapshot.keys())
+    now = time.time()
+    ts_arr = np.array([(ts or {}).get(name, now) for name in venues], dtype=float)
+    shape = (len(symbols), len(venues))
+    bid = np.full(shape, np.nan)
+    ask = np.full(shape, np.nan)
+    vol = np.full(shape, np.nan)
+    for e, name in enumerate(venues):
+        snap = snapshot[name]
+        for r, symbol in enumerate(symbols):
+            q = snap.get(symbol)
+            if q is not None:
+                bid[r, e], ask[r, e], vol[r, e] = q
+    return QuoteMatrix(symbols, venues, bid, ask, vol, ts_arr)
+
+def compute_signals(m: QuoteMatrix, fees: np.ndarray,
+                    min_spread: float = MIN_SPREAD,
+                    min_volume: float = MIN_VOLUME_1H) -> List[Dict[str, Any]]:
+    """
+    Векторный проход по всем символам и всем парам бирж сразу:
+    покупка по ask на бирже i → продажа по bid на бирже j.
+    fees — taker-комиссии (доли), форма (S, E).
+    Возвращает лучшую пару на символ, отсортировано по чистому спреду.
+    """
+    S, E = m.bid.shape
+    if S == 0 or E < 2:
+        return []
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ok = (m.bid > 0) & (m.ask > 0)
+        bid = np.where(ok, m.bid, np.nan)
+        ask = np.where(ok, m.ask, np.nan)
+        vol = np.where(ok, m.vol, np.nan)
+
+        # [S, i(buy @ ask), j(sell @ bid)]
+        gross = (bid[:, None, :] / ask[:, :, None] - 1.0) * 100.0
+        net = gross - (fees[:, :, None] + fees[:, None, :]) * 100.0
+        pair_vol = np.minimum(vol[:, :, None], vol[:, None, :])
+
+        valid = (net >= min_spread) & (pair_vol >= min_volume)
+    valid &= ~np.eye(E, dtype=bool)[None, :, :]
+    net = np.where(valid, net, -np.inf).reshape(S, E * E)
+
+    best = net.argmax(axis=1)
+    best_net = net[np.arange(S), best]
+    rows = np.nonzero(np.isfinite(best_net))[0]
+    rows = rows[np.argsort(-best_net[rows], kind="stable")]
+
+    bi, si = np.divmod(best[rows], E)
+    px_buy = ask[rows, bi].tolist()
+    px_sell = bid[rows, si].tolist()
+    fee_buy = fees[rows, bi].tolist()
+    fee_sell = fees[rows, si].tolist()
+    quote_ts = np.minimum(m.ts[bi], m.ts[si]).tolist()
+    spread = best_net[rows].round(2).tolist()
+    vol_1h = (pair_vol.reshape(S, E * E)[rows, best[rows]] / 1_000_000).round(2).tolist()
+
+    return [
+        {
+            "symbol": m.symbols[r],
+            "cheap": m.venues[i],
+            "expensive": m.venues[j],
+            "price_cheap": round(px_buy[k], 6),
+            "price_expensive": round(px_sell[k], 6),
+            "spread": spread[k],
+            "volume_1h": vol_1h[k],
+            # сырые котировки, по которым посчитан сигнал
+            "ask": px_buy[k],
+            "bid": px_sell[k],
+            "fee_buy": fee_buy[k],
+            "fee_sell": fee_sell[k],
+            "quote_ts": quote_ts[k],
+        }
+        for k, (r, i, j) in enumerate(zip(rows.tolist(), bi.tolist(), si.tolist()))
+    ]
+
+def venue_fees(name: str) -> Tuple[Dict[str, float], float]:
+    """({symbol: taker} из load_markets, общая taker-комиссия биржи). Кэшируется на бирже."""
+    cached = _fee_cache.get(name)
+    if cached is not None:
+        return cached
+    ex = exchanges.get(name)
+    if ex is None:
+        return {}, TAKER_FEE_DEFAULT
+    default = safe_float(((getattr(ex, "fees", None) or {}).get("trading") or {}).get("taker"), TAKER_FEE_DEFAULT)
+    per_symbol = {s: safe_float(mk.get("taker"), default) for s, mk in (ex.markets or {}).items()
+                  if mk.get("taker") is not None}
+    _fee_cache[name] = (per_symbol, default)
+    return _fee_cache[name]
+
+def taker_fee(name: str, symbol: str) -> float:
+    """Taker-комиссия биржи по рынку, иначе общая по бирже, иначе дефолт."""
+    per_symbol, default = venue_fees(name)
+    return per_symbol.get(symbol, default)
+
+def fee_matrix(m: QuoteMatrix) -> np.ndarray:
+    fees = np.empty((len(m.symbols), len(m.venues)), dtype=float)
+    for e, name in enumerate(m.venues):
+        per_symbol, default = venue_fees(name)
+        fees[:, e] = [per_symbol.get(instrument_index.native_symbol(name, s), default) for s in m.symbols]
+    return fees
+
+async def recheck_candidates(cands: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Точечная перепроверка топ-кандидатов: свежий fetch_ticker только по двум биржам сигнала
+    (все запросы параллельно). Кандидаты, не прошедшие фильтры повторно, отбрасываются.
+    """
+    async def one(sig):
+        legs = leg_markets(sig)
         try:
-            tops = await get_top_symbols(ex)
-            symbol_set.update(tops)
-        except Exception as e:
-            if chat_id in scanlog_enabled and app:
-                await app.bot.send_message(chat_id, f"<i>{name} ошибка топ-листа: {e}</i>", parse_mode="HTML")
+            tickers = await asyncio.gather(*(api_call(exchanges[n], "fetch_ticker", s) for n, s, _ in legs))
+        except Exception:
+            return sig  # не смогли перепроверить — оставляем данные bulk-снимка
+        quotes = {}
+        for (n, _, rate), t in zip(legs, tickers):
+            bid, ask, qv = parse_ticker(t)
+            quotes[n] = {sig["symbol"]: (bid * rate, ask * rate, qv * rate)}
+        m = matrix_from_quotes(quotes, [sig["symbol"]])
+        fresh = compute_signals(m, fee_matrix(m))
+        return instrument_index.annotate(fresh[0]) if fresh else None
+
+    checked = await asyncio.gather(*(one(sig) for sig in cands))
+    return [sig for sig in checked if sig]
+
+# ================== INSTRUMENT INDEX ==================
+def _parse_aliases(raw: str) -> Dict[Tuple[str, str], str]:
+    """ASSET_ALIASES="gate:GMT=GMTSTEPN,bigone:ONE=HARMONY" → {(биржа, тикер): канонический актив}."""
+    out = {}
+    for item in filter(None, (x.strip() for x in raw.split(","))):
+        left, _, canon = item.partition("=")
+        venue, _, code = left.partition(":")
+        if venue and code and canon:
+            out[(venue.strip().lower(), code.strip().upper())] = canon.strip().upper()
+    return out
+
+ASSET_ALIASES = _parse_aliases(os.getenv("ASSET_ALIASES", ""))
+
+class InstrumentIndex:
+    """
+    Кросс-биржевой индекс инструментов по load_markets. Канонический инструмент — BASE/USDT
+    (BASE с учётом ASSET_ALIASES); рынки в STABLE_QUOTES сводятся к нему по курсу стейблкоина
+    на той же бирже (на биржу — одна пара, по порядку STABLE_QUOTES). Тикеры, чья цена на бирже
+    расходится с остальными больше чем в COLLISION_RATIO раз, считаем другой монетой и исключаем.
+    Индекс по бирже пересобирается при старте и после обновления её рынков.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.native: Dict[str, Dict[str, str]] = {}      # биржа -> {канонический symbol: родной}
+        self.canon: Dict[str, np.ndarray] = {}           # биржа -> id родного symbol → id канонического (-1 — нет)
+        self.rates: Dict[str, np.ndarray] = {}           # биржа -> курс актива к USDT (по активам; NaN — депег)
+        self.excluded: Dict[str, Dict[int, float]] = {}  # биржа -> {канонический id с коллизией тикера: до какого ts}
+
+    def rebuild(self, name: str, markets: Mapping[str, Mapping[str, Any]]):
+        best: Dict[str, Tuple[int, str]] = {}
+        for symbol, mk in (markets or {}).items():
+            if ":" in symbol or "/" not in symbol or mk.get("spot") is False or mk.get("active") is False:
+                continue
+            base, _, quote = symbol.partition("/")
+            base, quote = mk.get("base") or base, mk.get("quote") or quote
+            if quote not in STABLE_QUOTES:
+                continue
+            canon = f"{ASSET_ALIASES.get((name, base.upper()), base)}/USDT"
+            rank = STABLE_QUOTES.index(quote)
+            if canon not in best or rank < best[canon][0]:
+                best[canon] = (rank, symbol)
+
+        self.native[name] = {canon: symbol for canon, (_, symbol) in best.items()}
+        pairs = [(symbol_table.intern(symbol), symbol_table.intern(canon)) for canon, (_, symbol) in best.items()]
+        canon_arr = np.full(len(symbol_table), -1, dtype=np.int64)
+        for native_id, canon_id in pairs:
+            canon_arr[native_id] = canon_id
+        self.canon[name] = canon_arr
+        self.excluded.pop(name, None)  # новая раскладка рынков — коллизии проверяем заново
+
+    def native_symbol(self, name: str, symbol: str) -> str:
+        return self.native.get(name, {}).get(symbol, symbol)
+
+    def update_rates(self, snapshot: Dict[str, VenueQuotes]):
+        """Курсы стейблкоинов к USDT по снимку каждой биржи (нет пары — считаем 1:1)."""
+        for name, vq in snapshot.items():
+            rates = np.ones(len(symbol_table.asset_names))
+            for code in STABLE_QUOTES:
+                sid = symbol_table.ids.get(f"{code}/USDT")
+                hit = np.flatnonzero(vq.ids == sid) if sid is not None else ()
+                if len(hit):
+                    mid = (vq.bid[hit[0]] + vq.ask[hit[0]]) / 2
+                    rates[symbol_table.asset(code)] = mid if abs(mid - 1.0) <= STABLE_DEPEG else np.nan
+            self.rates[name] = rates
+
+    def translate(self, name: str, vq: VenueQuotes) -> Tuple[np.ndarray, np.ndarray]:
+        """(id канонического инструмента или -1, множитель цены к USDT) для каждой строки снимка."""
+        canon = self.canon.get(name)
+        if canon is None:
+            # биржа без индекса (replay, бенчмарки) — только родные USDT-пары
+            usdt = symbol_table.asset("USDT")
+            return np.where(symbol_table.pair_arrays()[1][vq.ids] == usdt, vq.ids, -1), np.ones(len(vq))
+        ids = vq.ids
+        inside = ids < len(canon)  # символы, появившиеся после сборки индекса, — не в индексе
+        c = np.where(inside, canon[np.where(inside, ids, 0)], -1)
+        q = symbol_table.pair_arrays()[1][ids]
+        rates = self.rates.get(name)
+        if rates is not None and len(rates) < len(symbol_table.asset_names):
+            rates = self.rates[name] = np.r_[rates, np.ones(len(symbol_table.asset_names) - len(rates))]
+        factor = rates[q] if rates is not None else np.ones(len(ids))
+        c = np.where(np.isfinite(factor), c, -1)
+        excluded = self.active_exclusions(name)
+        if excluded:
+            c = np.where(np.isin(c, list(excluded)), -1, c)
+        return c, factor
+
+    def screen(self, m: QuoteMatrix):
+        """Коллизии тикеров: ячейки, где цена отличается от медианы по биржам > COLLISION_RATIO раз."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mid = np.where((m.bid > 0) & (m.ask > 0), (m.bid + m.ask) / 2, np.nan)
+            quoted = np.isfinite(mid)
+            n = quoted.sum(axis=1)
+            rows = np.flatnonzero(n >= 2)
+            if not len(rows):
+                return
+            sub, k = mid[rows], n[rows]
+            srt = np.sort(sub, axis=1)  # NaN — в конце строки; медиана без nanmedian (он медленный)
+            r = np.arange(len(rows))
+            med = (srt[r, (k - 1) // 2] + srt[r, k // 2]) / 2
+            dev = np.abs(np.log(sub / med[:, None]))
+            spread = np.log(srt[r, k - 1] / srt[:, 0])
+            limit = np.log(COLLISION_RATIO)
+            # две котировки — какая «настоящая», не понять: исключаем обе
+            bad = (dev > limit) | ((k == 2) & (spread > limit))[:, None]
+            bad &= quoted[rows]
+        for r, e in zip(*np.nonzero(bad)):
+            row, name = rows[r], m.venues[e]
+            m.bid[row, e] = m.ask[row, e] = m.vol[row, e] = np.nan
+            if m.ids is not None:
+                cid = int(m.ids[row])
+                if cid not in self.active_exclusions(name):
+                    self.excluded.setdefault(name, {})[cid] = time.time() + COLLISION_TTL
+                    log(f"⚠️ {m.symbols[row]} на {name.upper()}: цена расходится с другими биржами "
+                        f"в {np.exp(spread[r]):.1f} раз — похоже, другая монета, исключаем на {COLLISION_TTL} c")
+
+    def active_exclusions(self, name: str) -> Set[int]:
+        """Действующие исключения биржи; истёкшие снимаем — инструмент снова проверит screen."""
+        excluded = self.excluded.get(name)
+        if not excluded:
+            return set()
+        now = time.time()
+        for cid in [c for c, until in excluded.items() if until <= now]:
+            del excluded[cid]
+        return set(excluded)
+
+    def excluded_assets(self, name: str) -> Set[int]:
+        """Базовые активы исключённых на бирже инструментов (для графа циклов)."""
+        base = symbol_table.pair_arrays()[0]
+        return {int(base[cid]) for cid in self.active_exclusions(name)}
+
+    def annotate(self, sig: Dict[str, Any]) -> Dict[str, Any]:
+        """Родные символы и курсы ног сигнала; executable — обе ноги на родной USDT-паре."""
+        sym_buy = self.native_symbol(sig["cheap"], sig["symbol"])
+        sym_sell = self.native_symbol(sig["expensive"], sig["symbol"])
+        if sym_buy == sig["symbol"] and sym_sell == sig["symbol"]:
+            return sig
+        return {**sig, "symbol_buy": sym_buy, "symbol_sell": sym_sell,
+                "rate_buy": self.leg_rate(sig["cheap"], sym_buy), "rate_sell": self.leg_rate(sig["expensive"], sym_sell)}
+
+    def leg_rate(self, name: str, native: str) -> float:
+        rates = self.rates.get(name)
+        if rates is None or native not in symbol_table.ids:
+            return 1.0
+        quote = symbol_table.pair_arrays()[1][symbol_table.ids[native]]
+        return float(rates[quote]) if quote < len(rates) else 1.0
+
+instrument_index = InstrumentIndex()
+
+def executable(sig: Mapping[str, Any]) -> bool:
+    """Сделку по кнопке BUY исполняем только на родных USDT-парах обеих бирж."""
+    return sig.get("kind") != "cycle" and sig.get("symbol_buy", sig["symbol"]) == sig["symbol"] \
+        and sig.get("symbol_sell", sig["symbol"]) == sig["symbol"]
+
+# ================== ORDER BOOK DEPTH ==================
+def _book_segments(asks: List[List[float]], bids: List[List[float]]):
+    """Идём по обоим стаканам сразу: (ask, bid, кол-во base), пока есть уровни."""
+    ia = ib = 0
+    qa = qb = None
+    while ia < len(asks) and ib < len(bids):
+        a, b = safe_float(asks[ia][0]), safe_float(bids[ib][0])
+        if a <= 0 or b <= 0:
+            return
+        qa = safe_float(asks[ia][1]) if qa is None else qa
+        qb = safe_float(bids[ib][1]) if qb is None else qb
+        dq = min(qa, qb)
+        if dq > 0:
+            yield a, b, dq
+        qa -= dq
+        qb -= dq
+        if qa <= 0:
+            ia, qa = ia + 1, None
+        if qb <= 0:
+            ib, qb = ib + 1, None
+
+def walk_books(asks: List[List[float]], bids: List[List[float]], fee_buy: float, fee_sell: float,
+               size_usdt: float, min_spread: float = MIN_SPREAD) -> Dict[str, Any]:
+    """
+    BUY по стакану asks, SELL того же кол-ва по стакану bids.
+    max_size_usdt — максимальная сумма покупки, при которой средний чистый профит ≥ min_spread;
+    vwap_buy / vwap_sell / profit_usdt — при покупке на size_usdt (filled_usdt — сколько реально влезло).
+    """
+    k = 1.0 + min_spread / 100.0 + fee_buy + fee_sell
+
+    # 1) максимальный прибыльный объём: P ≥ k·C по накопленным стоимостям
+    cost = proceeds = 0.0
+    for a, b, dq in _book_segments(asks, bids):
+        if b - k * a < 0:
+            dq_max = max(proceeds - k * cost, 0.0) / (k * a - b)
+            if dq_max < dq:
+                cost += a * dq_max
+                proceeds += b * dq_max
+                break
+        cost += a * dq
+        proceeds += b * dq
+    max_size, max_profit = cost, proceeds - cost * (1.0 + fee_buy + fee_sell)
+
+    # 2) VWAP и профит при заданной сумме
+    cost = proceeds = qty = 0.0
+    for a, b, dq in _book_segments(asks, bids):
+        dq = min(dq, (size_usdt - cost) / a)
+        cost += a * dq
+        proceeds += b * dq
+        qty += dq
+        if cost >= size_usdt * (1 - 1e-9):
+            break
+
+    return {
+        "max_size_usdt": round(max_size, 2),
+        "max_profit_usdt": round(max_profit, 2),
+        "filled_usdt": round(cost, 2),
+        "vwap_buy": cost / qty if qty else 0.0,
+        "vwap_sell": proceeds / qty if qty else 0.0,
+        "profit_usdt": round(proceeds - cost * (1.0 + fee_buy + fee_sell), 2),
+    }
+
+async def fetch_books(keys: Set[Tuple[str, str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Стаканы по (биржа, symbol) — все запросы параллельно; ошибки пропускаем."""
+    keys = [k for k in keys if k[0] in exchanges]
+    books = await asyncio.gather(*(api_call(exchanges[n], "fetch_order_book", s, DEPTH_LIMIT) for n, s in keys),
+                                 return_exceptions=True)
+    now = time.time()
+    out = {}
+    for key, book in zip(keys, books):
+        if isinstance(book, Exception):
+            continue
+        _book_cache[key] = (now, book)
+        out[key] = book
+    return out
+
+async def get_books(cheap: str, expensive: str, symbol: str) -> Tuple[Dict[str, Any], Dict[str, Any]] | None:
+    """Стаканы для сделки: из кэша, если моложе QUOTE_FRESH_SEC, иначе — свежие."""
+    keys = [(cheap, symbol), (expensive, symbol)]
+    now = time.time()
+    if all(k in _book_cache and now - _book_cache[k][0] <= QUOTE_FRESH_SEC for k in keys):
+        return _book_cache[keys[0]][1], _book_cache[keys[1]][1]
+    books = await fetch_books(set(keys))
+    if not all(k in books for k in keys):
+        return None
+    return books[keys[0]], books[keys[1]]
+
+def leg_markets(sig: Mapping[str, Any]) -> Tuple[Tuple[str, str, float], Tuple[str, str, float]]:
+    """((биржа, родной symbol, курс к USDT) покупки, то же для продажи)."""
+    return ((sig["cheap"], sig.get("symbol_buy", sig["symbol"]), sig.get("rate_buy", 1.0)),
+            (sig["expensive"], sig.get("symbol_sell", sig["symbol"]), sig.get("rate_sell", 1.0)))
+
+def _in_usdt(levels: List[List[float]], rate: float) -> List[List[float]]:
+    return levels if rate == 1.0 else [[lvl[0] * rate, lvl[1]] for lvl in levels]
+
+async def depth_check(cands: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Второй этап скана: стаканы только для топ-K кандидатов.
+    Добавляет в сигнал макс. прибыльный объём и VWAP/профит на DEPTH_NOTIONAL_USDT;
+    кандидаты без достаточной глубины отбрасываются.
+    """
+    keys = {(n, s) for sig in cands for n, s, _ in leg_markets(sig)}
+    books = await fetch_books(keys)
+    out = []
+    for sig in cands:
+        (buy_venue, buy_symbol, buy_rate), (sell_venue, sell_symbol, sell_rate) = leg_markets(sig)
+        book_buy = books.get((buy_venue, buy_symbol))
+        book_sell = books.get((sell_venue, sell_symbol))
+        if not book_buy or not book_sell:
+            out.append(sig)  # стакан не получили — оставляем сигнал по тикерам
+            continue
+        depth = walk_books(_in_usdt(book_buy.get("asks") or [], buy_rate), _in_usdt(book_sell.get("bids") or [], sell_rate),
+                           sig["fee_buy"], sig["fee_sell"], DEPTH_NOTIONAL_USDT)
+        if depth["max_size_usdt"] < MIN_DEPTH_USDT:
+            continue
+        out.append({**sig, **depth, "size_usdt": DEPTH_NOTIONAL_USDT})
+    return out
+
+# ================== ROLLING 1H VOLUME ==================
+class VolumeWindow:
+    """Кольцо минутных бакетов объёма (USDT) одного рынка; бакет помнит свою минуту."""
+    __slots__ = ("vol", "minute", "last", "fetched")
+
+    def __init__(self):
+        self.vol = np.zeros(VOLUME_WINDOW_MIN)
+        self.minute = np.full(VOLUME_WINDOW_MIN, -1, dtype=np.int64)
+        self.last = -1       # последняя полученная минута (она могла быть незакрытой)
+        self.fetched = 0.0   # когда обновляли
+
+    def put(self, minute: int, vol: float):
+        slot = minute % VOLUME_WINDOW_MIN
+        self.vol[slot] = vol
+        self.minute[slot] = minute
+        self.last = max(self.last, minute)
+
+    def total(self, now_minute: int) -> float:
+        """Сумма за окно; бакеты старше окна и минуты без сделок не считаются."""
+        return float(self.vol[self.minute > now_minute - VOLUME_WINDOW_MIN].sum())
+
+class VolumeStore:
+    """
+    Реальный объём за последний час по (биржа, родной symbol) — только для кандидатов скана.
+    Минутные свечи fetch_ohlcv догружаем инкрементально: с последней полученной минуты
+    (её перезапрашиваем — была незакрытой), не чаще VOLUME_REFRESH_SEC на рынок.
+    """
+    def __init__(self):
+        self.windows: Dict[Tuple[str, str], VolumeWindow] = {}
+        self.candles = 0  # свечей получено (за всё время)
+
+    async def refresh(self, name: str, symbol: str, rate: float = 1.0) -> float | None:
+        """Объём 1ч в USDT; None — биржа не отдаёт свечи или запрос не удался."""
+        ex = exchanges.get(name)
+        if ex is None or not ex.has.get("fetchOHLCV"):
+            return None
+        key = (name, symbol)
+        win = self.windows.get(key)
+        if win is None:
+            win = self.windows[key] = VolumeWindow()
+        now = time.time()
+        now_minute = int(now // 60)
+        if now - win.fetched >= VOLUME_REFRESH_SEC:
+            first = max(win.last, now_minute - VOLUME_WINDOW_MIN + 1)
+            try:
+                candles = await api_call(ex, "fetch_ohlcv", symbol, "1m", first * 60_000, now_minute - first + 1)
+            except Exception:
+                return None if win.last < 0 else win.total(now_minute)
+            for ts, _o, _h, _l, close, volume in candles or ():
+                if volume is not None and close:
+                    win.put(int(ts // 60_000), float(volume) * float(close) * rate)
+            self.candles += len(candles or ())
+            win.fetched = now
+        return win.total(now_minute)
 
-    results: List[Dict[str, Any]] = []
-    FEES = {name: TAKER_FEE_DEFAULT for name in exchanges.keys()}
+volume_store = VolumeStore()
 
-    # пройти все символы, собрать цены и объёмы
-    for symbol in symbol_set:
-        prices: Dict[str, float] = {}
-        vols: Dict[str, float] = {}
-        for name, ex in exchanges.items():
+async def volume_check(cands: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Этап скана после префильтра по 24ч-объёму: реальный объём за час по обеим ногам кандидатов.
+    Ниже MIN_VOLUME_1H — отбрасываем; свечей нет — оставляем сигнал с 24ч-оценкой.
+    """
+    legs = {(n, s): r for sig in cands for n, s, r in leg_markets(sig)}
+    vols = await asyncio.gather(*(volume_store.refresh(n, s, r) for (n, s), r in legs.items()))
+    by_leg = dict(zip(legs, vols))
+    out = []
+    for sig in cands:
+        buy, sell = (by_leg[(n, s)] for n, s, _ in leg_markets(sig))
+        if buy is None or sell is None:
+            out.append(sig)
+            continue
+        vol = min(buy, sell)
+        if vol < MIN_VOLUME_1H:
+            continue
+        out.append({**sig, "volume_24h": sig["volume_1h"], "volume_1h": round(vol / 1_000_000, 2)})
+    return out
+
+# ================== MULTI-HOP CYCLES ==================
+# Граф валют по всем спотовым рынкам снимка: узел — (биржа, актив), ребро — сделка
+# (buy: quote→base по ask, sell: base→quote по bid, с taker-комиссией) или переход актива
+# между биржами (инвентарь разложен заранее, цена CYCLE_MOVE_COST). Вес ребра — −log(курса):
+# прибыльный цикл = цикл отрицательного веса. Ищем послойным Bellman-Ford от USDT каждой
+# биржи не длиннее CYCLE_MAX_HOPS рёбер — все источники и все рёбра одним numpy-проходом на слой.
+_MOVE = -1  # sym ребра-перехода между биржами
+
+def venue_fee_vec(name: str) -> np.ndarray:
+    """Taker-комиссии биржи по id символа (вектор поверх venue_fees)."""
+    vec = _fee_vec.get(name)
+    if vec is None or len(vec) < len(symbol_table):
+        per_symbol, default = venue_fees(name)
+        vec = np.full(len(symbol_table), default)
+        for symbol, fee in per_symbol.items():
+            i = symbol_table.ids.get(symbol)
+            if i is not None:
+                vec[i] = fee
+        _fee_vec[name] = vec
+    return vec
+
+class CurrencyGraph:
+    """Рёбра графа массивами: src/dst — узлы (venue * A + asset), w — −log(курса), плюс что за сделка."""
+    __slots__ = ("venues", "n_assets", "src", "dst", "w", "venue", "sym", "side", "price", "usd_vol", "ts")
+
+    def __init__(self, snapshot: Dict[str, VenueQuotes], min_volume: float = MIN_VOLUME_1H):
+        self.venues = list(snapshot.keys())
+        A = self.n_assets = len(symbol_table.asset_names)
+        base_of, quote_of = symbol_table.pair_arrays()
+        usdt = symbol_table.asset("USDT")
+        parts: Dict[str, List[np.ndarray]] = {k: [] for k in ("src", "dst", "w", "venue", "sym", "side", "price", "usd_vol")}
+        present = np.zeros((len(self.venues), A), dtype=bool)
+
+        def add(src, dst, w, e, sym, side, price, usd_vol):
+            for k, v in (("src", src), ("dst", dst), ("w", w), ("sym", sym), ("side", side),
+                         ("price", price), ("usd_vol", usd_vol)):
+                parts[k].append(np.asarray(v))
+            parts["venue"].append(np.full(len(src), e, dtype=np.int32))
+
+        for e, name in enumerate(self.venues):
+            vq = snapshot[name]
+            base, quote = base_of[vq.ids], quote_of[vq.ids]
+            fee = venue_fee_vec(name)[vq.ids]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                # USD-цена котируемого актива — по его USDT-паре на этой же бирже
+                usd = np.full(A, np.nan)
+                usd[usdt] = 1.0
+                direct = quote == usdt
+                usd[base[direct]] = (vq.bid[direct] + vq.ask[direct]) / 2
+                usd_vol = vq.vol * usd[quote]
+                ok = (vq.bid > 0) & (vq.ask > 0) & (usd_vol >= min_volume)
+                keep = lambda a: a[ok]
+                base, quote, fee, bid, ask, sym, uv = map(keep, (base, quote, fee, vq.bid, vq.ask, vq.ids, usd_vol))
+                fee_w = -np.log1p(-fee)
+                off = e * A
+                add(off + quote, off + base, np.log(ask) + fee_w, e, sym, np.zeros(len(sym), np.int8), ask, uv)   # buy
+                add(off + base, off + quote, -np.log(bid) + fee_w, e, sym, np.ones(len(sym), np.int8), bid, uv)   # sell
+            present[e, base] = True
+            present[e, quote] = True
+
+        for e, name in enumerate(self.venues):
+            # тикер с коллизией на бирже — это другая монета, переносить её между биржами нельзя
+            present[e, list(instrument_index.excluded_assets(name))] = False
+        move_w = -np.log1p(-CYCLE_MOVE_COST)
+        for e1 in range(len(self.venues)):
+            for e2 in range(len(self.venues)):
+                if e1 == e2:
+                    continue
+                assets = np.flatnonzero(present[e1] & present[e2])
+                n = len(assets)
+                add(e1 * A + assets, e2 * A + assets, np.full(n, move_w), e1, np.full(n, _MOVE),
+                    np.full(n, 2, np.int8), np.ones(n), np.full(n, np.inf))
+
+        cat = lambda k, dt: np.concatenate(parts[k]).astype(dt) if parts[k] else np.empty(0, dt)
+        self.src, self.dst = cat("src", np.int64), cat("dst", np.int64)
+        self.w, self.price, self.usd_vol = cat("w", float), cat("price", float), cat("usd_vol", float)
+        self.venue, self.sym, self.side = cat("venue", np.int32), cat("sym", np.int64), cat("side", np.int8)
+        self.ts = np.array([snapshot[n].ts for n in self.venues], dtype=float)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.venues) * self.n_assets
+
+def _pair_free_edges(g: CurrencyGraph, usdt: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Рёбра графа с битом состояния пути (узел + n_nodes — бит поднят): бит поднимается сделкой
+    между двумя не-USDT активами; пока он опущен, продавать в USDT нельзя. Так парный арбитраж
+    (USDT → X → переходы → USDT) в релаксацию не попадает и не вытесняет из ячейки D лучший
+    мульти-хоп путь через тот же узел. -> (src, dst, вес, индекс исходного ребра).
+    """
+    N, A = g.n_nodes, g.n_assets
+    sa, da = g.src % A, g.dst % A
+    trade = g.side != 2
+    cross = trade & (sa != usdt) & (da != usdt)
+    low = np.flatnonzero(~(trade & (da == usdt)))
+    orig = np.r_[low, np.arange(len(g.src))]
+    src = np.r_[g.src[low], g.src + N]
+    dst = np.r_[g.dst[low] + np.where(cross[low], N, 0), g.dst + N]
+    return src, dst, g.w[orig], orig
+
+def _relax_layers(src: np.ndarray, dst: np.ndarray, w: np.ndarray, n_nodes: int,
+                  sources: np.ndarray, hops: int) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Послойный Bellman-Ford: D[k][s, v] — мин. вес пути ровно из k рёбер от sources[s] до v,
+    P[k][s, v] — последнее ребро этого пути. Рёбра сгруппированы по dst → min через reduceat.
+    В ячейке держим один лучший путь: всё, что потом отбрасывается (парный арбитраж), надо
+    исключать из графа до релаксации — иначе оно вытеснит годный путь (см. _pair_free_edges).
+    """
+    order = np.argsort(dst, kind="stable")
+    src, dst, w = src[order], dst[order], w[order]
+    starts = np.flatnonzero(np.r_[True, dst[1:] != dst[:-1]])
+    targets = dst[starts]
+    idx = np.arange(len(order))
+
+    D = np.full((len(sources), n_nodes), np.inf)
+    D[np.arange(len(sources)), sources] = 0.0
+    Ds, Ps = [D], [None]
+    for _ in range(hops):
+        cand = D[:, src] + w
+        best = np.minimum.reduceat(cand, starts, axis=1)
+        first = np.minimum.reduceat(np.where(cand == np.repeat(best, np.diff(np.r_[starts, len(src)]), axis=1),
+                                             idx, len(idx)), starts, axis=1)
+        D = np.full_like(D, np.inf)
+        D[:, targets] = best
+        P = np.full(D.shape, -1, dtype=np.int64)
+        P[:, targets] = np.where(np.isfinite(best), order[np.minimum(first, len(idx) - 1)], -1)
+        Ds.append(D)
+        Ps.append(P)
+    return Ds, Ps
+
+def find_cycles(snapshot: Dict[str, VenueQuotes], min_profit: float = CYCLE_MIN_PROFIT,
+                hops: int = CYCLE_MAX_HOPS, top_k: int = CYCLE_TOP_K) -> List[Dict[str, Any]]:
+    """
+    Прибыльные циклы USDT → … → USDT по графу валют. Парные циклы (один промежуточный актив) —
+    это обычный межбиржевой арбитраж, его считает compute_signals; их отсекаем ещё в графе
+    (_pair_free_edges): в каждой ячейке релаксации живёт только один путь, и прибыльная пара
+    иначе закрывала бы собой мульти-хоп цикл через те же узлы. Пути с повтором узла всё так же
+    отбрасываются после релаксации.
+    """
+    if hops < 3 or not snapshot:
+        return []
+    g = CurrencyGraph(snapshot)
+    if not len(g.w):
+        return []
+    A, N, usdt = g.n_assets, g.n_nodes, symbol_table.asset("USDT")
+    sources = np.array([e * A + usdt for e in range(len(g.venues))], dtype=np.int64)
+    src, dst, w, orig = _pair_free_edges(g, usdt)
+    Ds, Ps = _relax_layers(src, dst, w, 2 * N, sources, hops)
+    limit = -np.log1p(min_profit / 100.0)
+
+    found: Dict[Tuple[int, ...], Dict[str, Any]] = {}
+    for k in range(3, hops + 1):
+        # цикл — путь до своего же USDT с поднятым битом (была сделка между двумя не-USDT активами)
+        for s in np.flatnonzero(Ds[k][np.arange(len(sources)), sources + N] < limit).tolist():
+            path, node = [], int(sources[s]) + N
+            for layer in range(k, 0, -1):
+                e = int(Ps[layer][s, node])
+                if e < 0:
+                    break
+                path.append(int(orig[e]))
+                node = int(src[e])
+            path.reverse()
+            if len(path) != k:
+                continue
+            nodes = [int(g.src[e]) for e in path]
+            if len(set(nodes)) != len(nodes):
+                continue  # путь с повтором узла — не простой цикл
+            key = tuple(sorted(path))
+            if key in found:
+                continue
+            sig = _cycle_signal(g, path, float(np.sum(g.w[path])))
+            found[key] = sig
+    return sorted(found.values(), key=lambda x: x["spread"], reverse=True)[:top_k]
+
+def _cycle_signal(g: CurrencyGraph, path: List[int], weight: float) -> Dict[str, Any]:
+    A, names, assets = g.n_assets, symbol_table.names, symbol_table.asset_names
+    legs, route = [], [assets[int(g.src[path[0]]) % A]]
+    for e in path:
+        venue = g.venues[int(g.venue[e])]
+        if g.side[e] == 2:
+            legs.append({"venue": venue, "to": g.venues[int(g.dst[e]) // A], "asset": assets[int(g.src[e]) % A],
+                         "side": "move"})
+            continue
+        legs.append({"venue": venue, "symbol": names[int(g.sym[e])], "side": "buy" if g.side[e] == 0 else "sell",
+                     "price": float(g.price[e]), "fee": float(venue_fee_vec(venue)[int(g.sym[e])])})
+        route.append(assets[int(g.dst[e]) % A])
+    trades = [leg for leg in legs if leg["side"] != "move"]
+    venues = list(dict.fromkeys(leg["venue"] for leg in trades))
+    vol = g.usd_vol[[e for e in path if g.side[e] != 2]]
+    return {
+        "kind": "cycle",
+        "symbol": "→".join(route),
+        "cheap": trades[0]["venue"],
+        "expensive": trades[-1]["venue"],
+        "venues": venues,
+        "legs": legs,
+        "spread": round((np.exp(-weight) - 1.0) * 100.0, 2),
+        "volume_1h": round(float(vol.min()) / 1_000_000, 2),
+        "quote_ts": float(g.ts[[g.venues.index(v) for v in venues]].min()),
+    }
+
+# ================== STREAMING ==================
+Quotes = Dict[str, Tuple[float, float, float]]  # symbol -> (bid, ask, quoteVolume)
+
+def _usdt_quotes(tickers: Dict[str, Dict[str, Any]]) -> Quotes:
+    return {s: parse_ticker(t) for s, t in tickers.items() if ":" not in s and s.endswith("/USDT")}
+
+class FeedTransport(ABC):
+    """
+    Источник обновлений котировок одной биржи: асинхронный поток пачек {symbol: (bid, ask, qv)}.
+    Реализации: ccxt.pro (watch_tickers), фолбэк-опрос fetch_tickers, очередь (фейковый фид).
+    """
+    @abstractmethod
+    def updates(self, name: str, ex: ccxt.Exchange) -> AsyncIterator[Quotes]:
+        """Асинхронный генератор пачек котировок (в реализациях — async def с yield)."""
+
+    async def close(self):
+        pass
+
+class PollingTransport(FeedTransport):
+    """Фолбэк: bulk fetch_tickers раз в interval сек, отдаём только изменившиеся котировки."""
+    def __init__(self, interval: float = STREAM_POLL_INTERVAL):
+        self.interval = interval
+
+    async def updates(self, name, ex):
+        last: Quotes = {}
+        while True:
+            quotes = _usdt_quotes(await api_call(ex, "fetch_tickers"))
+            changed = {s: q for s, q in quotes.items() if last.get(s) != q}
+            last = quotes
+            if changed:
+                yield changed
+            await asyncio.sleep(self.interval)
+
+def pro_module():
+    """ccxt.pro грузит ещё по классу на каждую биржу — импортируем только когда нужен стриминг."""
+    global ccxtpro
+    if ccxtpro is None:
+        try:
+            import ccxt.pro as ccxtpro
+        except ImportError:  # старые ccxt без pro
+            ccxtpro = False
+    return ccxtpro or None
+
+class CcxtProTransport(FeedTransport):
+    """watch_tickers через ccxt.pro (websocket), рынки берём у REST-инстанса."""
+    def __init__(self):
+        self.clients: List[Any] = []
+
+    @staticmethod
+    def supported(ex: ccxt.Exchange) -> bool:
+        pro = pro_module()
+        cls = getattr(pro, ex.id, None) if pro else None
+        return bool(cls and cls().has.get("watchTickers"))
+
+    async def updates(self, name, ex):
+        client = getattr(pro_module(), ex.id)({"enableRateLimit": True, "options": {"defaultType": "spot"}})
+        self.clients.append(client)
+        client.set_markets(ex.markets, ex.currencies)
+        while True:
+            tickers = await client.watch_tickers()
+            quotes = _usdt_quotes(tickers)
+            if quotes:
+                yield quotes
+
+    async def close(self):
+        for client in self.clients:
             try:
-                t = await ex.fetch_ticker(symbol)
-                bid = safe_float(t.get("bid"))
-                ask = safe_float(t.get("ask"))
-                if bid and ask:
-                    mid = (bid + ask) / 2.0
-                    prices[name] = mid
-                    vols[name] = safe_float(t.get("quoteVolume") or (t.get("info") or {}).get("quoteVolume"))
+                await client.close()
             except Exception:
+                pass
+
+class QueueTransport(FeedTransport):
+    """Фейковый фид для тестов: пачки котировок кладём руками через push()."""
+    def __init__(self):
+        self.queues: Dict[str, asyncio.Queue] = {}
+
+    def _queue(self, name: str) -> asyncio.Queue:
+        return self.queues.setdefault(name, asyncio.Queue())
+
+    def push(self, name: str, quotes: Quotes):
+        self._queue(name).put_nowait(quotes)
+
+    async def updates(self, name, ex):
+        q = self._queue(name)
+        while True:
+            yield await q.get()
+
+def default_transport(name: str, ex: ccxt.Exchange) -> FeedTransport:
+    return CcxtProTransport() if CcxtProTransport.supported(ex) else PollingTransport()
+
+class MarketStream:
+    """
+    Живой in-memory снимок по каждой бирже + инкрементальный пересчёт:
+    на каждое обновление пересчитываются только символы, чьи котировки изменились.
+    Коллизии тикеров отсеиваются так же, как в скане; новые/изменившиеся сигналы раз в
+    STREAM_ALERT_INTERVAL уходят подписчикам автоскана (alert_targeted), не дожидаясь тика.
+    transport_factory(name, ex) -> FeedTransport — подменяется в тестах.
+    """
+    def __init__(self, exs: Dict[str, ccxt.Exchange],
+                 transport_factory: Callable[[str, ccxt.Exchange], FeedTransport] = default_transport):
+        self.exs = exs
+        self.transport_factory = transport_factory
+        self.book: Dict[str, Quotes] = {name: {} for name in exs}
+        self.book_ts: Dict[str, float] = {}
+        self.signals: Dict[str, Dict[str, Any]] = {}   # symbol -> лучший сигнал
+        self.transports: Dict[str, FeedTransport] = {}
+        self.errors: Dict[str, str] = {}
+        self._dirty: Set[str] = set()
+        self._alert_scope: Set[str] = set()  # пересчитанные символы, ещё не сверенные с трекером
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and any(self.book.values())
+
+    async def start(self):
+        for name, ex in self.exs.items():
+            self._tasks.append(asyncio.ensure_future(self._ingest(name, ex)))
+        self._tasks.append(asyncio.ensure_future(self._evaluate_loop()))
+        self._tasks.append(asyncio.ensure_future(self._alert_loop()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for tr in self.transports.values():
+            await tr.close()
+
+    def apply(self, name: str, quotes: Quotes):
+        book = self.book.setdefault(name, {})
+        for s, q in quotes.items():
+            if book.get(s) != q:
+                book[s] = q
+                self._dirty.add(s)
+        self.book_ts[name] = time.time()
+        if self._dirty:
+            self._wake.set()
+
+    async def _ingest(self, name: str, ex: ccxt.Exchange):
+        transport = self.transport_factory(name, ex)
+        self.transports[name] = transport
+        kind = type(transport).__name__
+        log(f"{name.upper()} стрим: {kind}")
+        delay = 1.0
+        while True:
+            try:
+                async for quotes in transport.updates(name, ex):
+                    self.apply(name, quotes)
+                    self.errors.pop(name, None)
+                    delay = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors[name] = str(e).split("\n")[0][:200]
+                if isinstance(transport, CcxtProTransport):
+                    # websocket не взлетел — переходим на bulk-опрос этой биржи
+                    log(f"{name.upper()} стрим ❌ {self.errors[name]} → фолбэк на опрос")
+                    await transport.close()
+                    transport = self.transports[name] = PollingTransport()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+
+    def evaluate(self, symbols: List[str]):
+        """Пересчёт только переданных символов по живому снимку."""
+        live = {name: q for name, q in self.book.items() if q}
+        m = matrix_from_quotes(live, symbols, self.book_ts)
+        m.ids = np.array([symbol_table.intern(s) for s in symbols], dtype=np.int32)
+        for e, name in enumerate(m.venues):
+            excluded = instrument_index.active_exclusions(name)
+            if excluded:
+                hit = np.isin(m.ids, list(excluded))
+                m.bid[hit, e] = m.ask[hit, e] = m.vol[hit, e] = np.nan
+        instrument_index.screen(m)
+        fresh = {sig["symbol"]: instrument_index.annotate(sig) for sig in compute_signals(m, fee_matrix(m))}
+        for s in symbols:
+            if s in fresh:
+                self.signals[s] = fresh[s]
+            else:
+                self.signals.pop(s, None)
+        self._alert_scope.update(symbols)
+
+    async def _evaluate_loop(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(STREAM_DEBOUNCE)
+            self._wake.clear()
+            dirty, self._dirty = self._dirty, set()
+            if dirty:
+                self.evaluate(sorted(dirty))
+
+    async def _alert_loop(self):
+        while True:
+            await asyncio.sleep(STREAM_ALERT_INTERVAL)
+            if not self._alert_scope:
                 continue
+            scope, self._alert_scope = self._alert_scope, set()
+            raw = sorted((self.signals[s] for s in scope if s in self.signals), key=lambda x: x["spread"], reverse=True)
+            unseen = set(self.errors) | {name for name, q in self.book.items() if not q}
+            try:
+                opened, changed, closed = await alert_targeted(
+                    raw, scope, unseen, f"📡 <b>Стрим {datetime.now().strftime('%H:%M:%S')}</b>")
+            except Exception as e:
+                log(f"⚠️ Стрим-алерты: {e}")
+                continue
+            if opened or changed or closed:
+                log(f"📡 Стрим ({len(scope)} симв.): +{len(opened)} ~{len(changed)} -{len(closed)}")
+
+    def current_signals(self) -> List[Dict[str, Any]]:
+        return sorted(self.signals.values(), key=lambda x: x["spread"], reverse=True)
+
+# ================== SHARDED INGESTION ==================
+# SHARD_WORKERS > 0: bulk-снимки собирают процессы-воркеры (spawn), биржи разложены по шардам.
+# Воркер сам ходит в API и парсит тяжёлый JSON fetch_tickers; в главный процесс по Pipe
+# приходят только компактные массивы и новые имена символов (id у процессов свои — ремапим).
+# Главному процессу остаются агрегация, сделки и Telegram. Бюджет запросов биржи (EX_RATE/EX_BURST)
+# делим: SHARD_RATE_SHARE — воркеру, остаток — главному процессу. Упал шард — его биржи снова
+# опрашиваем из главного процесса с полным бюджетом.
+# Окупается, только когда главный процесс упирается в CPU: много бирж × тысячи символов
+# (парсинг JSON тикеров) плюс Telegram/стрим в том же event loop. На 4–5 биржах шарды медленнее:
+# пересылка по Pipe и половина лимита биржи на перепроверку/стаканы главного процесса
+# (bench.py scan: 5×1000 — ~330 мс без шардов против ~800 мс с 2 шардами; 8×5000 — 1.09 c против 1.0 c с 4).
+@dataclass(frozen=True)
+class ShardSettings:
+    """Всё, что воркер берёт от главного процесса; остальные настройки — дефолты модуля."""
+    markets_cache_dir: str  # кэш рынков главного процесса (воркер его только читает)
+    ex_rate: float          # доля EX_RATE биржи, отданная шарду
+    ex_burst: float         # доля EX_BURST
+
+def _shard_main(conn, factory: Callable[[], Dict[str, Tuple[type, Dict[str, Any]]]],
+                names: List[str], settings: ShardSettings):
+    """Точка входа процесса-шарда."""
+    asyncio.run(_shard_serve(conn, factory, names, settings))
+
+async def _shard_serve(conn, factory, names: List[str], settings: ShardSettings):
+    await init_exchanges({n: c for n, c in factory().items() if n in names}, shard=settings)
+    for ex in exchanges.values():  # init запросов через планировщик не делает — бюджет ставим после
+        scheduler_for(ex).bucket = TokenBucket(settings.ex_rate, settings.ex_burst)
+    conn.send(("ready", {n: st["status"] for n, st in exchange_status.items()}))
+    sent = 0  # сколько имён из symbol_table уже ушло в главный процесс
+
+    async def one(req: int, name: str):
+        nonlocal sent
+        t0 = time.perf_counter()
+        try:
+            vq = await fetch_snapshot(exchanges[name])
+        except ExchangeUnavailable as e:
+            reply = ("unavailable", str(e))
+        except Exception as e:
+            reply = ("error", str(e).split("\n")[0][:300] or type(e).__name__)
+        else:
+            new, sent = symbol_table.names[sent:], len(symbol_table.names)
+            reply = ("ok", (new, vq.ids, vq.bid, vq.ask, vq.vol, vq.ts))
+        conn.send(("snapshot", req, reply, time.perf_counter() - t0))
 
-        if len(prices) < 2:
-            continue
+    while True:
+        try:
+            msg = await asyncio.to_thread(conn.recv)
+        except (EOFError, OSError):
+            break
+        if msg[0] == "stop":
+            break
+        if msg[0] == "snapshot" and msg[2] in exchanges:
+            spawn(one(msg[1], msg[2]))
+    await close_all_exchanges()
+
+class Shard:
+    __slots__ = ("proc", "conn", "names", "pending", "remap", "remap_arr", "ready", "alive")
+
+    def __init__(self, proc, conn, names: List[str]):
+        self.proc = proc
+        self.conn = conn
+        self.names = names
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.remap: List[int] = []             # id символа в воркере → id в главном процессе
+        self.remap_arr = np.empty(0, dtype=np.int32)
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.alive = True
+
+class ShardPool:
+    """Пул процессов-воркеров для bulk-снимков, шардирование по биржам (round-robin)."""
+    def __init__(self, workers: int = SHARD_WORKERS):
+        self.workers = workers
+        self.shards: List[Shard] = []
+        self.owner: Dict[str, Shard] = {}
+        self._req = 0
+
+    async def start(self, factory: Callable[[], Dict[str, Tuple[type, Dict[str, Any]]]], names: List[str]):
+        ctx = mp.get_context("spawn")
+        settings = ShardSettings(MARKETS_CACHE_DIR, EX_RATE * SHARD_RATE_SHARE, max(1.0, EX_BURST * SHARD_RATE_SHARE))
+        for group in (names[i::self.workers] for i in range(self.workers)):
+            if not group:
+                continue
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_shard_main, args=(child, factory, group, settings), daemon=True)
+            proc.start()
+            child.close()
+            shard = Shard(proc, parent, group)
+            self.shards.append(shard)
+            spawn(self._read(shard))
+        for shard in self.shards:
+            try:
+                statuses = await asyncio.wait_for(asyncio.shield(shard.ready), INIT_DEADLINE * 2)
+            except asyncio.TimeoutError:
+                log(f"⚠️ Шард {'/'.join(shard.names)} не стартовал за {INIT_DEADLINE * 2} c — опрашиваем сами")
+                continue
+            for name, status in statuses.items():
+                if status == "✅":
+                    self.owner[name] = shard
+                    if name in exchanges:  # у ключа один лимит на оба процесса
+                        scheduler_for(exchanges[name]).bucket = TokenBucket(
+                            EX_RATE * (1 - SHARD_RATE_SHARE), max(1.0, EX_BURST * (1 - SHARD_RATE_SHARE)))
+            log(f"🧩 Шард pid {shard.proc.pid}: {', '.join(n for n, st in statuses.items() if st == '✅') or '—'}")
+
+    def owns(self, name: str) -> bool:
+        shard = self.owner.get(name)
+        return shard is not None and shard.alive
+
+    async def snapshot(self, name: str) -> VenueQuotes:
+        global HTTP_CALLS
+        shard = self.owner[name]
+        self._req += 1
+        fut = asyncio.get_running_loop().create_future()
+        shard.pending[self._req] = fut
+        shard.conn.send(("snapshot", self._req, name))
+        HTTP_CALLS += 1
+        kind, payload, sec = await fut
+        if kind == "unavailable":
+            metrics.count_error(name, "skipped")
+            raise ExchangeUnavailable(payload)
+        if kind == "error":
+            metrics.count_error(name, "error")
+            raise RuntimeError(payload)
+        metrics.observe_call(name, "fetch_tickers", sec)
+        ids, bid, ask, vol, ts = payload
+        return VenueQuotes(shard.remap_arr[ids], bid, ask, vol, ts)
+
+    async def _read(self, shard: Shard):
+        while True:
+            try:
+                msg = await asyncio.to_thread(shard.conn.recv)
+            except (EOFError, OSError):
+                break
+            if msg[0] == "ready" and not shard.ready.done():
+                shard.ready.set_result(msg[1])
+            elif msg[0] == "snapshot":
+                _, req, reply, sec = msg
+                if reply[0] == "ok":
+                    # новые имена воркер шлёт один раз — ремапим сразу, даже если ответ уже никто не ждёт
+                    new, *arrays = reply[1]
+                    if new:
+                        shard.remap += [symbol_table.intern(s) for s in new]
+                        shard.remap_arr = np.array(shard.remap, dtype=np.int32)
+                    reply = ("ok", tuple(arrays))
+                fut = shard.pending.pop(req, None)
+                if fut is not None and not fut.done():
+                    fut.set_result((*reply, sec))
+        shard.alive = False
+        for name in shard.names:
+            if self.owner.get(name) is shard and name in exchanges:
+                scheduler_for(exchanges[name]).bucket = TokenBucket(EX_RATE, EX_BURST)
+        err = ExchangeUnavailable(f"шард {'/'.join(shard.names)} остановлен")
+        for fut in shard.pending.values():
+            if not fut.done():
+                fut.set_exception(err)
+        shard.pending.clear()
+        if not shard.ready.done():
+            shard.ready.set_result({})
+        if self.shards:
+            log(f"⚠️ {err} — опрашиваем его биржи из главного процесса")
+
+    async def stop(self):
+        shards, self.shards = self.shards, []
+        for shard in shards:
+            try:
+                shard.conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+        for shard in shards:
+            await asyncio.to_thread(shard.proc.join, 5)
+            if shard.proc.is_alive():
+                shard.proc.terminate()
+
+async def snapshot_for(name: str) -> VenueQuotes:
+    """Снимок биржи — из её шарда, если он жив, иначе запросом из этого процесса."""
+    if shard_pool is not None and shard_pool.owns(name):
+        return await shard_pool.snapshot(name)
+    return await fetch_snapshot(exchanges[name])
+
+# ================== INCREMENTAL / LIFETIME ==================
+class IncrementalEvaluator:
+    """
+    Диф нового bulk-снимка с предыдущим (векторно, по id символов): пересчитываем только символы,
+    у которых поменялась котировка хотя бы на одной бирже; остальные сигналы переносим.
+    """
+    def __init__(self):
+        self.prev: QuoteMatrix | None = None
+        self.signals: Dict[str, Dict[str, Any]] = {}
+
+    def _dirty_rows(self, m: QuoteMatrix) -> np.ndarray:
+        prev = self.prev
+        if prev is None or prev.venues != m.venues:
+            return np.ones(len(m.ids), dtype=bool)  # набор бирж поменялся — считаем всё заново
+        pos = np.full(len(symbol_table), -1, dtype=np.int64)
+        pos[prev.ids] = np.arange(len(prev.ids))
+        prow = pos[m.ids]
+        same = prow >= 0
+        prow = np.where(same, prow, 0)
+        for cur, old in ((m.bid, prev.bid), (m.ask, prev.ask), (m.vol, prev.vol)):
+            old = old[prow]
+            same &= np.all((cur == old) | (np.isnan(cur) & np.isnan(old)), axis=1)
+        return ~same
+
+    def update(self, snapshot: Dict[str, VenueQuotes], ids: np.ndarray) -> Tuple[List[Dict[str, Any]], int]:
+        m = build_matrix(snapshot, ids)
+        dirty = self._dirty_rows(m)
+        sub = m.take(np.nonzero(dirty)[0])
+        fresh = {sig["symbol"]: instrument_index.annotate(sig) for sig in compute_signals(sub, fee_matrix(sub))}
+
+        ts = dict(zip(m.venues, m.ts.tolist()))
+        signals: Dict[str, Dict[str, Any]] = dict(fresh)
+        for symbol, is_dirty in zip(m.symbols, dirty.tolist()):
+            if not is_dirty and symbol in self.signals:
+                old = self.signals[symbol]
+                # котировки те же — подтверждены свежим снимком
+                signals[symbol] = {**old, "quote_ts": min(ts[old["cheap"]], ts[old["expensive"]])}
+
+        self.prev, self.signals = m, signals
+        return sorted(signals.values(), key=lambda x: x["spread"], reverse=True), len(sub.symbols)
+
+class Opportunity:
+    __slots__ = ("first_seen", "last_seen", "peak", "streak", "sent_spread")
+
+    def __init__(self, now: float, spread: float):
+        self.first_seen = self.last_seen = now
+        self.peak = self.sent_spread = spread
+        self.streak = 1
+
+class OpportunityTracker:
+    """
+    Состояние каждой возможности (symbol, buy, sell): первый/последний раз,
+    пиковый спред, сколько сканов подряд держится. Фиксированный размер, LRU-вытеснение.
+    """
+    def __init__(self, capacity: int = OPP_TRACK_MAX):
+        self.capacity = capacity
+        self.items: "OrderedDict[Tuple[str, str, str], Opportunity]" = OrderedDict()
+
+    def update(self, signals: List[Dict[str, Any]], now: float, unseen: Set[str] = frozenset(),
+               scope: Set[str] | None = None):
+        """
+        Возвращает (сигналы с lifetime-полями, новые, заметно изменившиеся, закрытые).
+        Входные сигналы не мутируем — на них могут ссылаться прошлые результаты.
+        unseen — биржи, не попавшие в этот скан: их возможности не закрываем.
+        scope — символы, которые замер покрывал (точечный опрос); остальные не закрываем.
+        """
+        enriched, opened, changed, closed = [], [], [], []
+        seen = set()
+        for sig in signals:
+            key = (sig["symbol"], sig["cheap"], sig["expensive"])
+            seen.add(key)
+            opp = self.items.get(key)
+            if opp is None:
+                opp = self.items[key] = Opportunity(now, sig["spread"])
+                bucket = opened
+            else:
+                opp.last_seen = now
+                opp.streak += 1
+                opp.peak = max(opp.peak, sig["spread"])
+                self.items.move_to_end(key)
+                bucket = None
+                if abs(sig["spread"] - opp.sent_spread) >= SIGNAL_CHANGE_PCT:
+                    opp.sent_spread = sig["spread"]
+                    bucket = changed
+            sig = {**sig, "first_seen": opp.first_seen, "streak": opp.streak, "peak": opp.peak}
+            enriched.append(sig)
+            if bucket is not None:
+                bucket.append(sig)
+
+        for key in [k for k in self.items if k not in seen and not ({k[1], k[2]} & unseen)
+                    and (scope is None or k[0] in scope)]:
+            opp = self.items.pop(key)
+            closed.append({
+                "symbol": key[0], "cheap": key[1], "expensive": key[2],
+                "lifetime": now - opp.first_seen, "peak": opp.peak, "streak": opp.streak,
+            })
 
-        min_p = min(prices.values())
-        max_p = max(prices.values())
-        spread_pct = (max_p - min_p) / min_p * 100.0
-        if spread_pct < MIN_SPREAD:
-            continue
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+        return enriched, opened, changed, closed
 
-        # проверяем минимальный объём 1ч среди доступных бирж по этому символу
-        if vols:
-            min_vol = min(v for v in vols.values() if v is not None)
-            if min_vol < MIN_VOLUME_1H:
+# ================== SYMBOL TIERS ==================
+class SymbolTiers:
+    """
+    Приоритет символов по недавнему поведению: разрыв цен между биржами, движение цены
+    между замерами и попадание в сигналы — EWMA по замерам (вес прошлого TIER_DECAY).
+    Горячие (HOT_SYMBOLS) перепроверяем точечно каждые HOT_INTERVAL сек, тёплые (WARM_SYMBOLS) —
+    каждые WARM_INTERVAL, остальные обновляет только bulk-снимок скана.
+    """
+    def __init__(self):
+        self.score = np.zeros(0)
+        self.mid = np.full(0, np.nan)
+        self.hot = np.empty(0, dtype=np.int32)
+        self.warm = np.empty(0, dtype=np.int32)
+
+    def _grow(self):
+        n = len(symbol_table)
+        if len(self.score) < n:
+            self.score = np.concatenate([self.score, np.zeros(n - len(self.score))])
+            self.mid = np.concatenate([self.mid, np.full(n - len(self.mid), np.nan)])
+
+    def observe(self, m: QuoteMatrix, signals: List[Mapping[str, Any]] = ()):
+        """Обновляет скоринг строк матрицы (канонические id) и пересобирает уровни."""
+        if m.ids is None or not len(m.ids):
+            return
+        self._grow()
+        with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # строки без котировок — NaN
+            quoted = np.sum(~np.isnan(m.ask), axis=1)
+            gap = np.where(quoted >= 2, (np.nanmax(m.bid, axis=1) / np.nanmin(m.ask, axis=1) - 1.0) * 100.0, 0.0)
+            mid = np.nanmean((m.bid + m.ask) / 2, axis=1)
+            move = np.abs(mid / self.mid[m.ids] - 1.0) * 100.0
+        hits = np.isin(m.ids, [symbol_table.ids[sig["symbol"]] for sig in signals if sig["symbol"] in symbol_table.ids])
+        fresh = np.nan_to_num(np.clip(gap, 0, None)) + np.nan_to_num(move) + hits * TIER_SIGNAL_BONUS
+        self.score[m.ids] = TIER_DECAY * self.score[m.ids] + (1 - TIER_DECAY) * fresh
+        self.mid[m.ids] = np.where(np.isnan(mid), self.mid[m.ids], mid)
+
+        order = np.argsort(-self.score, kind="stable")
+        order = order[self.score[order] > 0]
+        self.hot = order[:HOT_SYMBOLS].astype(np.int32)
+        self.warm = order[HOT_SYMBOLS:HOT_SYMBOLS + WARM_SYMBOLS].astype(np.int32)
+
+async def alert_targeted(raw: List[Dict[str, Any]], scope: Set[str], unseen: Set[str], title: str):
+    """
+    Точечный замер (опрос горячих символов, стрим) → подписчикам автоскана. Лучшие HOT_CHECK_K
+    кандидатов проходят те же фильтры, что и в скане (объём 1ч, стаканы, инвентарь); котировки
+    свежие — перепроверка тикером не нужна. Отсеянные и не попавшие в топ замер не открывает
+    и не закрывает — решает скан. Возвращает (новые, изменившиеся, закрытые).
+    """
+    if tracker is None:
+        return [], [], []
+    signals = raw[:HOT_CHECK_K]
+    if VOLUME_TOP_K > 0 and signals:
+        signals = await volume_check(signals)
+    if DEPTH_TOP_K > 0 and signals:
+        signals = await depth_check(signals)
+    signals = inventory_check(signals)
+    rejected = {sig["symbol"] for sig in raw} - {sig["symbol"] for sig in signals}
+    _, opened, changed, closed = tracker.update(signals, time.time(), unseen, scope=scope - rejected)
+    if opened or changed or closed:
+        broadcast_digest(opened + changed, closed, title)
+    return opened, changed, closed
+
+class TieredPoller:
+    """
+    Точечные перезапросы горячих/тёплых символов между bulk-сканами (только bulk-режим).
+    На биржу за тик — один fetch_tickers(symbols), если биржа фильтрует символы на сервере
+    (TICKERS_FILTER_SERVER), иначе поштучные fetch_ticker в пределах TIER_RATE_SHARE её лимита;
+    всё через планировщик биржи, т.е. в тех же лимитах;
+    если у биржи есть очередь (скан, сделка) или она в деградации — тик для неё пропускаем.
+    Новые/изменившиеся возможности по этим символам сразу уходят подписчикам автоскана
+    через alert_targeted — с теми же фильтрами, что и в скане.
+    """
+    def __init__(self, tiers: SymbolTiers):
+        self.tiers = tiers
+        self.ticks = 0
+        self.calls = 0
+        self.skipped = 0
+        self.alerts = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(HOT_INTERVAL)
+            try:
+                await self.tick()
+            except Exception as e:
+                log(f"⚠️ Точечный опрос: {e}")
+
+    async def _quotes(self, name: str, symbols: List[str]) -> VenueQuotes:
+        ex = exchanges[name]
+        if ex.has.get("fetchTickers") and ex.id in TICKERS_FILTER_SERVER:
+            tickers = await api_call(ex, "fetch_tickers", symbols)
+            self.calls += 1
+            return parse_tickers(tickers, time.time())
+        # горячие идут первыми — при нехватке бюджета отрезаются тёплые
+        budget = max(1, int(scheduler_for(ex).bucket.rate * HOT_INTERVAL * TIER_RATE_SHARE))
+        res = await asyncio.gather(*(api_call(ex, "fetch_ticker", s) for s in symbols[:budget]), return_exceptions=True)
+        self.calls += min(len(symbols), budget)
+        return parse_tickers({s: t for s, t in zip(symbols, res) if isinstance(t, dict)}, time.time())
+
+    async def tick(self):
+        self.ticks += 1
+        ids = self.tiers.hot
+        if WARM_SYMBOLS and self.ticks % max(1, round(WARM_INTERVAL / HOT_INTERVAL)) == 0:
+            ids = np.concatenate([ids, self.tiers.warm])
+        if not len(ids) or not snapshot_history or not exchanges:
+            return
+        base = snapshot_history[-1]
+        names = symbol_table.names
+        wanted = {}
+        for name in base:
+            sch = scheduler_for(exchanges[name]) if name in exchanges else None
+            if sch is None or sch.degraded or sch.waiting:
+                self.skipped += 1
+                continue
+            listed = instrument_index.native.get(name)
+            symbols = [instrument_index.native_symbol(name, names[i]) for i in ids.tolist()
+                       if listed is None or names[i] in listed]
+            if symbols:
+                wanted[name] = symbols
+        if not wanted:
+            return
+
+        tasks = {name: asyncio.ensure_future(self._quotes(name, symbols)) for name, symbols in wanted.items()}
+        await asyncio.wait(tasks.values(), timeout=HOT_INTERVAL)
+        snapshot = dict(base)  # кто не ответил — остаётся со снимком последнего скана
+        for name, task in tasks.items():
+            if task.done() and not task.exception():
+                snapshot[name] = task.result()
+            elif not task.done():
+                task.cancel()
+        stale = {name for name in base if snapshot[name] is base[name]}
+
+        ids = np.sort(ids)
+        m = build_matrix(snapshot, ids)
+        raw = [instrument_index.annotate(sig) for sig in compute_signals(m, fee_matrix(m))]
+        self.tiers.observe(m, raw)
+        opened, changed, closed = await alert_targeted(
+            raw, set(m.symbols), stale, f"⚡ <b>Горячие символы {datetime.now().strftime('%H:%M:%S')}</b>")
+        if opened or changed or closed:
+            self.alerts += len(opened) + len(changed)
+            log(f"⚡ Точечный опрос ({len(ids)} симв.): +{len(opened)} ~{len(changed)} -{len(closed)}")
+
+tiers = SymbolTiers()
+
+# ================== TICK RECORDER ==================
+# Формат записи (каталог RECORD_DIR):
+#   ticks.bin — append-only поток чанков: <u32 len(header)><u32 len(body)> header(JSON) body(zlib)
+#   ticks.idx — индекс по времени, JSON-строка на чанк: t0, t1, offset, size, scans, rows
+# Тело чанка — колонки подряд: scan(u32) venue(u16) sym(i32) bid ask vol(f64).
+# Символы и биржи в чанке локальные (списки в header) — чанк читается сам по себе.
+_CHUNK_HEAD = struct.Struct("<II")
+_TICK_COLUMNS = (("scan", "<u4"), ("venue", "<u2"), ("sym", "<i4"), ("bid", "<f8"), ("ask", "<f8"), ("vol", "<f8"))
+
+def _encode_chunk(batch: List[Tuple[float, Dict[str, VenueQuotes]]]) -> Tuple[Dict[str, Any], bytes]:
+    venues = sorted({name for _, snap in batch for name in snap})
+    vidx = {name: i for i, name in enumerate(venues)}
+    parts: Dict[str, List[np.ndarray]] = {col: [] for col, _ in _TICK_COLUMNS}
+    for k, (_, snap) in enumerate(batch):
+        for name in venues:
+            vq = snap.get(name)
+            if vq is None or not len(vq):
+                continue
+            n = len(vq)
+            parts["scan"].append(np.full(n, k, dtype="<u4"))
+            parts["venue"].append(np.full(n, vidx[name], dtype="<u2"))
+            parts["sym"].append(vq.ids)
+            parts["bid"].append(vq.bid)
+            parts["ask"].append(vq.ask)
+            parts["vol"].append(vq.vol)
+    cols = {col: (np.concatenate(parts[col]) if parts[col] else np.empty(0)).astype(dt)
+            for col, dt in _TICK_COLUMNS}
+    uniq, local = np.unique(cols["sym"], return_inverse=True)
+    cols["sym"] = local.astype("<i4")
+    header = {
+        "v": 1,
+        "ts": [ts for ts, _ in batch],
+        "venues": venues,
+        "symbols": [symbol_table.names[i] for i in uniq.tolist()],
+        "fees": {name: venue_fees(name)[1] for name in venues},
+        "rows": int(len(local)),
+    }
+    return header, b"".join(cols[col].tobytes() for col, _ in _TICK_COLUMNS)
+
+def _decode_chunk(header: Dict[str, Any], body: bytes) -> Iterator[Tuple[float, Dict[str, VenueQuotes], Dict[str, float]]]:
+    raw = zlib.decompress(body)
+    n, off, cols = header["rows"], 0, {}
+    for col, dt in _TICK_COLUMNS:
+        size = n * np.dtype(dt).itemsize
+        cols[col] = np.frombuffer(raw, dtype=dt, count=n, offset=off)
+        off += size
+    # локальные id символов → id текущего процесса
+    remap = np.fromiter((symbol_table.intern(s) for s in header["symbols"]), dtype=np.int32,
+                        count=len(header["symbols"]))
+    sym = remap[cols["sym"]] if n else np.empty(0, dtype=np.int32)
+    venues, fees = header["venues"], header.get("fees", {})
+    # строки лежат по порядку (scan, venue) — режем границами
+    key = cols["scan"].astype(np.int64) * len(venues) + cols["venue"]
+    for k, ts in enumerate(header["ts"]):
+        snap: Dict[str, VenueQuotes] = {}
+        for v, name in enumerate(venues):
+            lo, hi = np.searchsorted(key, [k * len(venues) + v, k * len(venues) + v + 1])
+            if hi > lo:
+                snap[name] = VenueQuotes(sym[lo:hi], cols["bid"][lo:hi], cols["ask"][lo:hi], cols["vol"][lo:hi], ts)
+        yield ts, snap, fees
+
+class TickRecorder:
+    """
+    Пишет каждый снимок скана (bid/ask/объём по биржам и символам) в сжатые колоночные чанки.
+    Чанк копится в памяти RECORD_CHUNK_SCANS сканов, сжатие и запись — в потоке, не блокируя цикл.
+    """
+    def __init__(self, path: str, chunk_scans: int = RECORD_CHUNK_SCANS):
+        os.makedirs(path, exist_ok=True)
+        self.data_path = os.path.join(path, "ticks.bin")
+        self.index_path = os.path.join(path, "ticks.idx")
+        self.chunk_scans = chunk_scans
+        self.pending: List[Tuple[float, Dict[str, VenueQuotes]]] = []
+        self.chunks = 0
+        self._lock = threading.Lock()
+
+    def append(self, ts: float, snapshot: Dict[str, VenueQuotes]):
+        if not snapshot:
+            return
+        self.pending.append((ts, dict(snapshot)))
+        if len(self.pending) >= self.chunk_scans:
+            spawn(self.flush())
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        # колонки собираем в цикле (id символов → имена), сжимаем и пишем в потоке
+        header, raw = _encode_chunk(batch)
+        try:
+            await asyncio.to_thread(self._write_chunk, header, raw)
+        except Exception as e:
+            log(f"⚠️ Запись тиков: {e}")
+
+    def _write_chunk(self, header: Dict[str, Any], raw: bytes):
+        body = zlib.compress(raw, 6)
+        head = json.dumps(header, separators=(",", ":")).encode()
+        with self._lock:
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(_CHUNK_HEAD.pack(len(head), len(body)))
+                f.write(head)
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            # индекс пишем после данных: оборванный чанк без строки индекса при чтении не виден
+            entry = {"t0": header["ts"][0], "t1": header["ts"][-1], "offset": offset,
+                     "size": _CHUNK_HEAD.size + len(head) + len(body),
+                     "scans": len(header["ts"]), "rows": header["rows"]}
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.chunks += 1
+
+def read_index(path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(os.path.join(path, "ticks.idx"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def read_ticks(path: str, start: float | None = None,
+               end: float | None = None) -> Iterator[Tuple[float, Dict[str, VenueQuotes], Dict[str, float]]]:
+    """(ts, {биржа: VenueQuotes}, {биржа: taker}) по записи; по индексу читаем только нужные чанки."""
+    with open(os.path.join(path, "ticks.bin"), "rb") as f:
+        for entry in read_index(path):
+            if (start is not None and entry["t1"] < start) or (end is not None and entry["t0"] > end):
                 continue
+            f.seek(entry["offset"])
+            hlen, blen = _CHUNK_HEAD.unpack(f.read(_CHUNK_HEAD.size))
+            header = json.loads(f.read(hlen))
+            for ts, snap, fees in _decode_chunk(header, f.read(blen)):
+                if (start is None or ts >= start) and (end is None or ts <= end):
+                    yield ts, snap, fees
+
+@dataclass(frozen=True)
+class ScanResult:
+    """Неизменяемый результат одного скана — один на всех подписчиков."""
+    at: datetime
+    mono: float
+    signals: Tuple[Mapping[str, Any], ...]
+    errors: Tuple[str, ...]
+    opened: Tuple[Mapping[str, Any], ...] = ()    # новые возможности
+    changed: Tuple[Mapping[str, Any], ...] = ()   # спред заметно сдвинулся
+    closed: Tuple[Mapping[str, Any], ...] = ()    # исчезли с прошлого скана
+    partial: bool = False                         # скан упёрся в дедлайн
+    missed: Tuple[str, ...] = ()                  # биржи / этапы, не успевшие к дедлайну
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.mono
+
+async def _until_deadline(coro, deadline_at: float):
+    """None, если этап не успел к дедлайну скана."""
+    remaining = deadline_at - time.monotonic()
+    if remaining <= 0:
+        coro.close()
+        return None
+    try:
+        return await asyncio.wait_for(coro, remaining)
+    except asyncio.TimeoutError:
+        return None
 
-        cheap = min(prices, key=prices.get)
-        expensive = max(prices, key=prices.get)
+async def scan_all_pairs(deadline: float = SCAN_DEADLINE) -> ScanResult:
+    """
+    Один скан с дедлайном: что не успело к сроку — отбрасываем и возвращаем
+    лучший результат по ответившим биржам, помеченный как частичный.
+    """
+    global LAST_SCAN_AT, LAST_SCAN_STATS, LAST_RESULT, evaluator, tracker
+    t0 = time.perf_counter()
+    deadline_at = time.monotonic() + deadline
+    calls0 = HTTP_CALLS
+
+    names = list(exchanges.keys())
+    errors: List[str] = []
+    missed: List[str] = []
+    unseen: Set[str] = set()  # биржи без данных в этом скане
+    recomputed = 0
+    cycles: List[Dict[str, Any]] = []
+    if live_stream is not None and live_stream.running:
+        # стриминг: сигналы уже пересчитаны инкрементально по изменившимся котировкам
+        with metrics.phase("compute"):
+            results = live_stream.current_signals()
+        venues_ok = sum(1 for q in live_stream.book.values() if q)
+        n_symbols = len(set().union(*live_stream.book.values()))
+        errors = [f"{name} стрим: {err}" for name, err in live_stream.errors.items()]
+        unseen = {name for name, q in live_stream.book.items() if not q}
+        if recorder is not None:
+            recorder.append(time.time(), {name: VenueQuotes.from_quotes(q, live_stream.book_ts.get(name, time.time()))
+                                          for name, q in live_stream.book.items() if q})
+    else:
+        # один bulk-снимок на биржу, все биржи параллельно;
+        # ждём до 70% дедлайна — остаток оставляем на перепроверку и стаканы
+        tasks = {name: asyncio.ensure_future(snapshot_for(name)) for name in names}
+        with metrics.phase("quotes"):
+            if tasks:
+                await asyncio.wait(tasks.values(), timeout=deadline * 0.7)
+
+        snapshot: Dict[str, VenueQuotes] = {}
+        for name, task in tasks.items():
+            if not task.done():
+                task.cancel()
+                missed.append(name)
+                unseen.add(name)
+                continue
+            snap = task.exception() or task.result()
+            if isinstance(snap, ExchangeUnavailable):
+                errors.append(f"{name} пропущена: {snap}")
+                unseen.add(name)
+                continue
+            if isinstance(snap, Exception):
+                errors.append(f"{name} ошибка снимка: {snap}")
+                unseen.add(name)
+                continue
+            snapshot[name] = snap
+        snapshot_history.append(snapshot)
+        instrument_index.update_rates(snapshot)
+        if recorder is not None:
+            recorder.append(time.time(), snapshot)
+        with metrics.phase("top_symbols"):
+            top_ids = get_top_symbols(snapshot)
+
+        # спреды считаем по снимку — без запросов к биржам; пересчитываем только изменившиеся символы
+        if evaluator is None:
+            evaluator = IncrementalEvaluator()
+        with metrics.phase("compute"):
+            results, recomputed = evaluator.update(snapshot, top_ids)
+            tiers.observe(evaluator.prev, results)
+        if CYCLE_MAX_HOPS:
+            # мульти-хоп циклы по всем рынкам снимка (включая не-USDT пары)
+            with metrics.phase("cycles"):
+                cycles = find_cycles(snapshot)
+        venues_ok, n_symbols = len(snapshot), len(top_ids)
+
+    # доп. этапы — только в остаток дедлайна; не успели — оставляем данные тикеров
+    if RECHECK_TOP_K > 0 and results:
+        with metrics.phase("recheck"):
+            head = await _until_deadline(recheck_candidates(results[:RECHECK_TOP_K]), deadline_at)
+        if head is None:
+            missed.append("recheck")
+        else:
+            results = head + results[RECHECK_TOP_K:]
+            results.sort(key=lambda x: x["spread"], reverse=True)
+
+    if VOLUME_TOP_K > 0 and results:
+        with metrics.phase("volume"):
+            head = await _until_deadline(volume_check(results[:VOLUME_TOP_K]), deadline_at)
+        if head is None:
+            missed.append("volume")
+        else:
+            results = head + results[VOLUME_TOP_K:]
 
-        gross = (max_p / min_p - 1.0) * 100.0
-        fees = (FEES.get(cheap, TAKER_FEE_DEFAULT) + FEES.get(expensive, TAKER_FEE_DEFAULT)) * 100.0
-        net = gross - fees
+    if DEPTH_TOP_K > 0 and results:
+        with metrics.phase("depth"):
+            head = await _until_deadline(depth_check(results[:DEPTH_TOP_K]), deadline_at)
+        if head is None:
+            missed.append("depth")
+        else:
+            results = head + results[DEPTH_TOP_K:]
 
-        if net < MIN_SPREAD:
-            continue
+    results = inventory_check(results)
+    if cycles:
+        results = sorted(results + cycles, key=lambda x: x["spread"], reverse=True)
 
-        results.append({
-            "symbol": symbol,
-            "cheap": cheap,
-            "expensive": expensive,
-            "price_cheap": round(prices[cheap], 6),
-            "price_expensive": round(prices[expensive], 6),
-            "spread": round(net, 2),
-            "volume_1h": round((min_vol if vols else 0) / 1_000_000, 2),
-        })
-
-    results.sort(key=lambda x: x["spread"], reverse=True)
     LAST_SCAN_AT = datetime.now()
-    return results[:10]
+    metrics.observe_phase("scan", time.perf_counter() - t0)
+    LAST_SCAN_STATS = {
+        "duration": time.perf_counter() - t0,
+        "http_calls": HTTP_CALLS - calls0,
+        "exchanges": f"{venues_ok}/{len(names)}",
+        "symbols": n_symbols,
+        "recomputed": recomputed,
+        "signals": len(results),
+        "cycles": len(cycles),
+        "missed": list(missed),
+    }
+
+    if tracker is None:
+        tracker = OpportunityTracker()
+    # возможности на не ответивших биржах не закрываем — мы их просто не видели
+    results, opened, changed, closed = tracker.update(results, time.time(), unseen)
+    log(f"Скан: {LAST_SCAN_STATS['duration']:.2f} c | HTTP: {LAST_SCAN_STATS['http_calls']} | "
+        f"биржи {LAST_SCAN_STATS['exchanges']} | пар {n_symbols} (пересчёт {recomputed}) | "
+        f"сигналов {len(results)} (циклов {len(cycles)}) | +{len(opened)} ~{len(changed)} -{len(closed)}"
+        + (f" | ⏰ частично, не успели: {', '.join(missed)}" if missed else ""))
+
+    frozen = lambda items: tuple(MappingProxyType(x) for x in items)
+    LAST_RESULT = ScanResult(
+        at=LAST_SCAN_AT,
+        mono=time.monotonic(),
+        signals=frozen(results[:10]),
+        errors=tuple(errors),
+        opened=frozen(opened[:10]),
+        changed=frozen(changed[:10]),
+        closed=frozen(closed),
+        partial=bool(missed),
+        missed=tuple(missed),
+    )
+    send_scanlog(LAST_RESULT)
+    return LAST_RESULT
+
+def send_scanlog(res: ScanResult):
+    if not app or not res.errors:
+        return
+    # все ошибки скана — одним сообщением на чат, через очередь
+    text = "\n".join(f"<i>{err}</i>" for err in res.errors)[:TG_MAX_LEN]
+    for chat_id in list(state.scanlog):
+        outbox.send(chat_id, text, parse_mode="HTML")
+
+async def run_scan() -> ScanResult:
+    """
+    Single-flight: если скан уже идёт — ждём его результат, второй не запускаем.
+    """
+    global _scan_task
+    if _scan_task is None or _scan_task.done():
+        _scan_task = asyncio.ensure_future(scan_all_pairs())
+    return await asyncio.shield(_scan_task)
+
+async def get_scan_result(max_age: float = SCAN_CACHE_MAX_AGE) -> ScanResult:
+    """Свежий-достаточно кэш отдаём сразу, иначе — (общий) новый скан."""
+    if LAST_RESULT is not None and LAST_RESULT.age <= max_age:
+        return LAST_RESULT
+    return await run_scan()
+
+# ================== EXECUTION ==================
+class BalanceCache:
+    """
+    Тёплый кэш инвентаря {биржа: {asset: free / total}} с фоновым обновлением всех бирж параллельно.
+    Точность рынков (amount_to_precision) берётся из ex.markets — они уже в памяти после старта.
+    """
+    def __init__(self):
+        self.free: Dict[str, Dict[str, float]] = {}
+        self.total: Dict[str, Dict[str, float]] = {}
+        self.ts: Dict[str, float] = {}
+
+    async def refresh(self, name: str):
+        ex = exchanges.get(name)
+        if ex is None:
+            return
+        b = await api_call(ex, "fetch_balance")
+        assets = {asset: v for asset, v in b.items() if isinstance(v, dict) and "free" in v}
+        self.free[name] = {asset: safe_float(v.get("free")) for asset, v in assets.items()}
+        self.total[name] = {asset: safe_float(v.get("total"), self.free[name][asset]) for asset, v in assets.items()
+                            if safe_float(v.get("total"), self.free[name][asset]) > 0}
+        self.ts[name] = time.time()
+
+    async def refresh_all(self, names: List[str] | None = None):
+        names = list(exchanges) if names is None else names
+        res = await asyncio.gather(*(self.refresh(n) for n in names), return_exceptions=True)
+        for name, r in zip(names, res):
+            if isinstance(r, Exception):
+                log(f"{name.upper()} баланс не обновлён: {str(r).split(chr(10))[0][:200]}")
+
+    async def run(self):
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(BALANCE_REFRESH_SEC)
+
+    def fresh(self, name: str) -> bool:
+        return time.time() - self.ts.get(name, 0) <= BALANCE_MAX_AGE
+
+    def known(self, name: str) -> bool:
+        """Инвентарь биржи хоть раз получен (после своих ордеров остаётся прошлый, пока обновляется)."""
+        return name in self.free
+
+    def get(self, name: str, asset: str) -> float:
+        return self.free.get(name, {}).get(asset, 0.0)
+
+    def holdings(self, name: str, prices: Dict[str, Dict[str, float]]) -> List[Tuple[str, float, float | None]]:
+        """(актив, всего, оценка в USDT или None) по убыванию оценки; пыль отбрасываем."""
+        out = []
+        for asset, amount in self.total.get(name, {}).items():
+            price = 1.0 if asset == "USDT" else prices.get(name, {}).get(asset)
+            if price is None:
+                price = next((p[asset] for p in prices.values() if asset in p), None)
+            value = amount * price if price is not None else None
+            if value is not None and value < BALANCE_DUST_USDT:
+                continue
+            out.append((asset, amount, value))
+        out.sort(key=lambda x: -1.0 if x[2] is None else x[2], reverse=True)
+        return out
+
+    def invalidate(self, *names: str):
+        """После своих ордеров балансы устарели — сбрасываем и обновляем в фоне."""
+        for name in names:
+            self.ts.pop(name, None)
+        spawn(self.refresh_all(list(names)))
+
+def asset_prices(snapshot: Dict[str, VenueQuotes]) -> Dict[str, Dict[str, float]]:
+    """Цены активов в USDT по снимку: {биржа: {актив: mid}} — по рынкам самой биржи, родные коды активов."""
+    base = symbol_table.pair_arrays()[0]
+    names = symbol_table.asset_names
+    out = {}
+    for name, vq in snapshot.items():
+        canon, factor = instrument_index.translate(name, vq)
+        hit = canon >= 0
+        mid = (vq.bid[hit] + vq.ask[hit]) / 2 * factor[hit]
+        out[name] = {names[a]: p for a, p in zip(base[vq.ids[hit]].tolist(), mid.tolist()) if p > 0}
+    return out
+
+def inventory_check(signals: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Хватает ли инвентаря под сигнал: котируемой валюты на бирже покупки и базовой монеты на бирже
+    продажи (от INVENTORY_MIN_USDT). Нет — помечаем no_inventory или выкидываем (INVENTORY_MODE).
+    Биржи, чей инвентарь ещё не получали, не судим.
+    """
+    if balances is None or INVENTORY_MODE not in ("flag", "drop"):
+        return signals
+    out = []
+    for sig in signals:
+        if sig.get("kind") == "cycle":
+            out.append(sig)
+            continue
+        (buy_venue, buy_symbol, buy_rate), (sell_venue, sell_symbol, _) = leg_markets(sig)
+        quote, base = buy_symbol.partition("/")[2], sell_symbol.partition("/")[0]
+        missing = []
+        if balances.known(buy_venue) and balances.get(buy_venue, quote) * buy_rate < INVENTORY_MIN_USDT:
+            missing.append(f"{quote} на {buy_venue.upper()}")
+        if balances.known(sell_venue) and balances.get(sell_venue, base) * sig["bid"] < INVENTORY_MIN_USDT:
+            missing.append(f"{base} на {sell_venue.upper()}")
+        if not missing:
+            out.append(sig)
+        elif INVENTORY_MODE == "flag":
+            out.append({**sig, "no_inventory": missing})
+    return out
+
+def _fill_leg(leg: Dict[str, Any], order: Mapping[str, Any]):
+    side, amount, expected = leg["side"], leg["amount"], leg["expected"]
+    leg["id"] = order.get("id")
+    leg["filled"] = safe_float(order.get("filled"), amount) if order.get("filled") is not None else None
+    leg["price"] = safe_float(order.get("average") or order.get("price")) or None
+    if leg["price"]:
+        sign = 1.0 if side == "buy" else -1.0  # хуже ожидаемой цены — положительный слиппедж
+        leg["slippage_pct"] = sign * (leg["price"] / expected - 1.0) * 100.0
+
+async def _reconcile_leg(ex: ccxt.Exchange, symbol: str, side: str, client_id: str, since_ms: int) -> Dict[str, Any] | None:
+    """Ответа на create_order нет (таймаут/сеть) — ищем ордер на бирже по clientOrderId (или side+время)."""
+    for method, cap in (("fetch_orders", "fetchOrders"), ("fetch_closed_orders", "fetchClosedOrders"),
+                        ("fetch_open_orders", "fetchOpenOrders")):
+        if not ex.has.get(cap):
+            continue
+        try:
+            orders = await api_call(ex, method, symbol, since_ms, priority=True)
+        except Exception:
+            continue
+        for o in orders or ():
+            if o.get("clientOrderId") == client_id:
+                return o
+        for o in orders or ():
+            if o.get("side") == side and (o.get("timestamp") or 0) >= since_ms:
+                return o
+    return None
+
+async def _send_leg(name: str, symbol: str, side: str, amount: float, expected: float, t0: float) -> Dict[str, Any]:
+    """Одна нога: market-ордер, время отправки/подтверждения (мс от старта сделки), цена филла."""
+    leg = {"venue": name, "side": side, "amount": amount, "expected": expected,
+           "sent_ms": (time.perf_counter() - t0) * 1000.0}
+    ex = exchanges[name]
+    since_ms = int(time.time() * 1000) - 5_000  # запас на расхождение часов с биржей
+    client_id = f"arb{since_ms}{side[0]}"
+    try:
+        order = await api_call(ex, "create_order", symbol, "market", side, amount,
+                               params={"clientOrderId": client_id}, priority=True)
+        leg["ack_ms"] = (time.perf_counter() - t0) * 1000.0
+        _fill_leg(leg, order)
+    except ccxt.NetworkError as e:
+        # ордер мог исполниться — без сверки с биржей ногу не списываем
+        leg["ack_ms"] = (time.perf_counter() - t0) * 1000.0
+        order = await _reconcile_leg(ex, symbol, side, client_id, since_ms)
+        if order is not None:
+            _fill_leg(leg, order)
+            leg["reconciled"] = True
+        else:
+            leg["error"] = str(e).split("\n")[0][:200]
+            leg["unconfirmed"] = True  # статус неизвестен — проверить на бирже вручную
+    except Exception as e:
+        leg["ack_ms"] = (time.perf_counter() - t0) * 1000.0
+        leg["error"] = str(e).split("\n")[0][:200]
+    leg["latency_ms"] = leg["ack_ms"] - leg["sent_ms"]
+    return leg
+
+def _leg_filled(leg: Dict[str, Any]) -> float:
+    if "error" in leg:
+        return 0.0
+    return leg["amount"] if leg.get("filled") is None else leg["filled"]
+
+async def execute_arbitrage(cheap: str, sell: str, symbol: str, usdt: float, ask: float, bid: float) -> Dict[str, Any]:
+    """
+    Двухногое исполнение: проверки по тёплому кэшу балансов, затем BUY и SELL уходят одновременно.
+    Бросает RuntimeError, если проверки не прошли (ничего не отправлено).
+    """
+    base = symbol.split("/")[0]
+    for name in (cheap, sell):
+        if name not in exchanges:
+            raise RuntimeError(f"{name.upper()}: биржа не подключена")
+        if scheduler_for(exchanges[name]).degraded:
+            raise RuntimeError(f"{name.upper()}: биржа в деградации")
+        backoff = scheduler_for(exchanges[name]).backoff_left
+        if backoff > 0:
+            raise RuntimeError(f"{name.upper()}: биржа в бэкоффе ещё {backoff:.0f} c — ноги ушли бы не одновременно")
+    stale = [n for n in (cheap, sell) if not balances.fresh(n)]
+    if stale:
+        await balances.refresh_all(stale)
+
+    usdt_free = balances.get(cheap, "USDT")
+    base_free = balances.get(sell, base)
+    if usdt_free <= 0:
+        raise RuntimeError(f"{cheap.upper()}: нет свободных USDT")
+    if base_free <= 0:
+        raise RuntimeError(f"{sell.upper()}: нет свободного {base}")
+    if ask <= 0 or bid <= 0:
+        raise RuntimeError("нет ask/bid")
+
+    spend = min(usdt, usdt_free)
+    amount = min(spend * (1 - taker_fee(cheap, symbol)) / ask, base_free)
+    buy_amount = safe_float(exchanges[cheap].amount_to_precision(symbol, amount), amount)
+    sell_amount = safe_float(exchanges[sell].amount_to_precision(symbol, amount), amount)
+
+    t0 = time.perf_counter()
+    leg_buy, leg_sell = await asyncio.gather(
+        _send_leg(cheap, symbol, "buy", buy_amount, ask, t0),
+        _send_leg(sell, symbol, "sell", sell_amount, bid, t0),
+    )
+    balances.invalidate(cheap, sell)
+
+    report = {
+        "ts": time.time(), "symbol": symbol, "buy": leg_buy, "sell": leg_sell,
+        "skew_ms": abs(leg_buy["ack_ms"] - leg_sell["ack_ms"]),
+        "imbalance": _leg_filled(leg_buy) - _leg_filled(leg_sell),
+    }
+    execution_log.append(report)
+    log(f"EXEC {symbol} {cheap}→{sell}: BUY {leg_buy['latency_ms']:.0f} мс, SELL {leg_sell['latency_ms']:.0f} мс, "
+        f"разрыв {report['skew_ms']:.0f} мс, дисбаланс {report['imbalance']:.8g}")
+    return report
+
+def format_leg(leg: Dict[str, Any], symbol: str) -> str:
+    head = f"• {leg['side'].upper()} {symbol} на {leg['venue'].upper()}"
+    if leg.get("unconfirmed"):
+        return f"{head}: ❓ нет ответа ({leg['error']}) — проверьте ордер на бирже"
+    if "error" in leg:
+        return f"{head}: ❌ {leg['error']}"
+    txt = f"{head} ~<code>{leg['amount']}</code>, ack {leg['latency_ms']:.0f} мс"
+    if leg.get("reconciled"):
+        txt += " (по сверке с биржей)"
+    if leg.get("price"):
+        txt += f", филл <code>{leg['price']:.8g}</code>"
+    if "slippage_pct" in leg:
+        txt += f" (слиппедж {leg['slippage_pct']:+.3f}%)"
+    return txt
 
 # ================== BUY FLOW (SINGLE BUY BUTTON) ==================
-def build_buy_keyboard(sig: Dict[str, Any]) -> InlineKeyboardMarkup:
-    # одна кнопка BUY — спрашиваем сумму после нажатия
-    data = f"{sig['cheap']}|{sig['expensive']}|{sig['symbol']}"
-    return InlineKeyboardMarkup([[
-        InlineKeyboardButton("BUY", callback_data=f"buy:{data}")
-    ]])
+def format_cycle(sig: Mapping[str, Any]) -> str:
+    trades = sum(1 for leg in sig["legs"] if leg["side"] != "move")
+    lines = [
+        f"🔺 <b>{sig['symbol']}</b> (цикл, сделок: {trades})",
+        f"Профит: <b>{sig['spread']}%</b>",
+    ]
+    n = 0
+    for leg in sig["legs"]:
+        if leg["side"] == "move":
+            lines.append(f"   ↪ {leg['asset']}: {leg['venue'].upper()} → {leg['to'].upper()}")
+            continue
+        n += 1
+        lines.append(f"{n}. {leg['venue'].upper()}: {leg['side'].upper()} {leg['symbol']} <code>{leg['price']:.8g}</code>")
+    lines.append(f"Мин. объём 1ч: <code>{sig['volume_1h']}M</code>$")
+    if sig.get("streak", 1) > 1:
+        lines.append(f"Держится: <code>{time.time() - sig['first_seen']:.0f}</code> сек ({sig['streak']} сканов подряд)")
+    return "\n".join(lines)
+
+def _native_note(sig: Mapping[str, Any], key: str) -> str:
+    native = sig.get(key, sig["symbol"])
+    return f" ({native})" if native != sig["symbol"] else ""
+
+def format_signal(sig: Mapping[str, Any]) -> str:
+    if sig.get("kind") == "cycle":
+        return format_cycle(sig)
+    txt = (
+        f"<b>{sig['symbol']}</b>\n"
+        f"Профит: <b>{sig['spread']}%</b>\n"
+        f"Купить: {sig['cheap'].upper()} <code>{sig['price_cheap']}</code>{_native_note(sig, 'symbol_buy')}\n"
+        f"Продать: {sig['expensive'].upper()} <code>{sig['price_expensive']}</code>{_native_note(sig, 'symbol_sell')}\n"
+        + (f"Объём 1ч: <code>{sig['volume_1h']}M</code>$ (24ч: {sig['volume_24h']}M$)" if "volume_24h" in sig
+           else f"Объём 24ч: <code>{sig['volume_1h']}M</code>$")
+    )
+    if sig.get("no_inventory"):
+        txt += f"\n⚠️ Нет инвентаря: {', '.join(sig['no_inventory'])}"
+    if sig.get("streak", 1) > 1:
+        txt += f"\nДержится: <code>{time.time() - sig['first_seen']:.0f}</code> сек ({sig['streak']} сканов подряд)"
+    if "max_size_usdt" in sig:
+        txt += (
+            f"\nМакс. прибыльный объём: <code>{sig['max_size_usdt']:.0f}</code>$ "
+            f"(~{sig['max_profit_usdt']:.2f}$ профита)\n"
+            f"На {sig['size_usdt']:.0f}$: ~<code>{sig['profit_usdt']:.2f}</code>$"
+        )
+    return txt
+
+def format_closed(ev: Mapping[str, Any]) -> str:
+    return (
+        f"⛔️ <b>{ev['symbol']}</b> {ev['cheap'].upper()}→{ev['expensive'].upper()} "
+        f"закрылся через <code>{ev['lifetime']:.0f}</code> сек "
+        f"(пик {ev['peak']}%, сканов: {ev['streak']})"
+    )
+
+def build_buy_keyboard(sig: Mapping[str, Any]) -> InlineKeyboardMarkup | None:
+    # одна кнопка BUY — спрашиваем сумму после нажатия; циклы — только сигнал, без исполнения
+    if not executable(sig):
+        return None
+    return InlineKeyboardMarkup([[buy_button(sig)]])
+
+def find_signal(cheap: str, expensive: str, symbol: str) -> Mapping[str, Any] | None:
+    if LAST_RESULT is None:
+        return None
+    for sig in LAST_RESULT.signals:
+        if sig["symbol"] == symbol and sig["cheap"] == cheap and sig["expensive"] == expensive:
+            return sig
+    return None
+
+async def get_exec_quote(step: Dict[str, Any]) -> Tuple[float, float, bool]:
+    """
+    (ask на бирже покупки, bid на бирже продажи, из_кэша).
+    Если котировка сигнала моложе QUOTE_FRESH_SEC — без запросов к биржам.
+    """
+    quote = step.get("quote")
+    if quote and time.time() - quote["quote_ts"] <= QUOTE_FRESH_SEC:
+        return quote["ask"], quote["bid"], True
+    t_buy, t_sell = await asyncio.gather(
+        api_call(exchanges[step["cheap"]], "fetch_ticker", step["symbol"]),
+        api_call(exchanges[step["expensive"]], "fetch_ticker", step["symbol"]),
+    )
+    return safe_float(t_buy.get("ask")), safe_float(t_sell.get("bid")), False
 
 async def on_buy_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -298,7 +2886,11 @@ async def on_buy_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, payload = q.data.split(":")
     cheap, expensive, symbol = payload.split("|")
     chat_id = q.message.chat.id
-    pending_trades[chat_id] = {"cheap": cheap, "expensive": expensive, "symbol": symbol}
+    step = {"cheap": cheap, "expensive": expensive, "symbol": symbol}
+    sig = find_signal(cheap, expensive, symbol)
+    if sig:
+        step["quote"] = {k: sig[k] for k in ("ask", "bid", "quote_ts")}
+    state.put_pending(chat_id, step)
     await q.edit_message_text(
         f"💰 Введите <b>сумму USDT</b> для сделки.\n"
         f"Сделка: <code>{symbol}</code> — BUY на <b>{cheap.upper()}</b>, SELL на <b>{expensive.upper()}</b>",
@@ -307,7 +2899,7 @@ async def on_buy_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def on_amount_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    step = pending_trades.get(chat_id)
+    step = state.get_pending(chat_id)
     if not step:
         return
     txt = (update.message.text or "").strip().replace(",", ".")
@@ -318,23 +2910,40 @@ async def on_amount_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         step["usdt"] = amt
     except Exception:
         return await update.message.reply_text("❌ Введите положительное число, например: 25")
+    state.put_pending(chat_id, step)
 
     symbol = step["symbol"]
     cheap = step["cheap"]
     sell = step["expensive"]
-    ex_buy = exchanges.get(cheap)
-    ex_sell = exchanges.get(sell)
 
     try:
-        t_buy = await ex_buy.fetch_ticker(symbol)
-        t_sell = await ex_sell.fetch_ticker(symbol)
-        ask = safe_float(t_buy.get("ask"))
-        bid = safe_float(t_sell.get("bid"))
+        ask, bid, cached = await get_exec_quote(step)
+        if ask <= 0 or bid <= 0:
+            raise RuntimeError("нет ask/bid")
     except Exception as e:
         return await update.message.reply_text(f"❌ Не смог получить цены: {e}")
 
-    profit_pct = (bid / ask - 1.0) * 100.0 - (TAKER_FEE_DEFAULT + TAKER_FEE_DEFAULT) * 100.0
+    fee_buy, fee_sell = taker_fee(cheap, symbol), taker_fee(sell, symbol)
+    profit_pct = (bid / ask - 1.0) * 100.0 - (fee_buy + fee_sell) * 100.0
     profit_usd = step["usdt"] * profit_pct / 100.0
+
+    # VWAP по стаканам на введённую сумму
+    depth_txt = ""
+    try:
+        books = await get_books(cheap, sell, symbol)
+    except Exception:
+        books = None
+    if books:
+        d = walk_books(books[0].get("asks") or [], books[1].get("bids") or [], fee_buy, fee_sell, step["usdt"])
+        if d["filled_usdt"] > 0:
+            profit_usd = d["profit_usdt"]
+            profit_pct = profit_usd / d["filled_usdt"] * 100.0
+            depth_txt = (
+                f"VWAP: BUY <code>{d['vwap_buy']:.8g}</code> / SELL <code>{d['vwap_sell']:.8g}</code>\n"
+                f"Макс. прибыльный объём: <code>{d['max_size_usdt']:.2f}</code> USDT\n"
+            )
+            if d["filled_usdt"] < step["usdt"] * 0.999:
+                depth_txt += f"⚠️ Глубины хватает только на {d['filled_usdt']:.2f} USDT\n"
     kb = InlineKeyboardMarkup([[
         InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm:{cheap}|{sell}|{symbol}|{step['usdt']}"),
         InlineKeyboardButton("❌ Отмена", callback_data="cancel")
@@ -343,8 +2952,10 @@ async def on_amount_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         f"<b>{symbol}</b>\n"
         f"BUY {cheap.upper()} @ <code>{ask}</code>\n"
-        f"SELL {sell.upper()} @ <code>{bid}</code>\n"
+        f"SELL {sell.upper()} @ <code>{bid}</code>"
+        f"{' (котировка скана)' if cached else ''}\n"
         f"Сумма: <b>{step['usdt']:.2f} USDT</b>\n"
+        f"{depth_txt}"
         f"Оценка профита: <b>{fmt_pct(profit_pct)}</b> (~{profit_usd:.2f} USDT)\n"
         f"⚠️ Балансы должны быть: USDT на {cheap.upper()} и базовая монета на {sell.upper()}.\n"
         f"Продолжить?"
@@ -359,64 +2970,353 @@ async def on_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     usdt = float(usdt_s)
     base = symbol.split("/")[0]
 
-    ex_buy = exchanges.get(cheap)
-    ex_sell = exchanges.get(sell)
-
-    # 1) BUY на дешёвой бирже (market)
-    try:
-        bal_buy = await ex_buy.fetch_balance()
-        usdt_free = safe_float((bal_buy.get("USDT") or {}).get("free"))
-        if usdt_free <= 0:
-            raise RuntimeError(f"{cheap.upper()}: нет свободных USDT")
-        t = await ex_buy.fetch_ticker(symbol)
-        ask = safe_float(t.get("ask"))
-        if ask <= 0:
-            raise RuntimeError("bad ask")
-        spend = min(usdt, usdt_free)
-        base_amount_est = (spend * (1 - TAKER_FEE_DEFAULT)) / ask
-        amount = safe_float(ex_buy.amount_to_precision(symbol, base_amount_est), base_amount_est)
-        order_buy = await ex_buy.create_order(symbol, "market", "buy", amount)
-    except Exception as e:
-        await q.edit_message_text(f"❌ BUY ошибка на {cheap.upper()}: {e}")
-        return
+    step = state.get_pending(q.message.chat.id) or {}
+    if (step.get("cheap"), step.get("expensive"), step.get("symbol")) != (cheap, sell, symbol):
+        step = {"cheap": cheap, "expensive": sell, "symbol": symbol}
 
-    # 2) SELL на дорогой бирже (market)
     try:
-        bal_sell = await ex_sell.fetch_balance()
-        base_free = safe_float((bal_sell.get(base) or {}).get("free"))
-        if base_free <= 0:
-            raise RuntimeError(f"{sell.upper()}: нет свободного {base}")
-        sell_amount = min(base_free, amount)
-        sell_amount = safe_float(ex_sell.amount_to_precision(symbol, sell_amount), sell_amount)
-        order_sell = await ex_sell.create_order(symbol, "market", "sell", sell_amount)
+        ask, bid, _ = await get_exec_quote(step)
+        report = await execute_arbitrage(cheap, sell, symbol, usdt, ask, bid)
     except Exception as e:
-        await q.edit_message_text(
-            f"⚠️ BUY выполнен, но SELL не удалось на {sell.upper()}: {e}\n"
-            f"Проверь баланс и ордера вручную."
-        )
-        pending_trades.pop(q.message.chat.id, None)
+        await q.edit_message_text(f"❌ Сделка не отправлена: {e}")
         return
-
-    await q.edit_message_text(
-        f"✅ Готово:\n"
-        f"• BUY {symbol} на {cheap.upper()} ~<code>{amount}</code>\n"
-        f"• SELL {symbol} на {sell.upper()} ~<code>{sell_amount}</code>\n"
-        f"Проверь историю ордеров на биржах.",
-        parse_mode="HTML"
-    )
-    pending_trades.pop(q.message.chat.id, None)
+    finally:
+        state.pop_pending(q.message.chat.id)
+    state.record_trade(q.message.chat.id, usdt, report)
+
+    leg_buy, leg_sell = report["buy"], report["sell"]
+    failed = [leg for leg in (leg_buy, leg_sell) if "error" in leg]
+    head = "✅ Готово:" if not failed else "⚠️ Исполнено частично — проверь балансы и ордера вручную:"
+    lines = [head, format_leg(leg_buy, symbol), format_leg(leg_sell, symbol),
+             f"Разрыв подтверждений: <code>{report['skew_ms']:.0f}</code> мс"]
+    if abs(report["imbalance"]) > 0:
+        lines.append(f"⚠️ Дисбаланс {base}: <code>{report['imbalance']:+.8g}</code>")
+    lines.append("Проверь историю ордеров на биржах.")
+    await q.edit_message_text("\n".join(lines), parse_mode="HTML")
 
 async def on_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    pending_trades.pop(q.message.chat.id, None)
+    state.pop_pending(q.message.chat.id)
     await q.edit_message_text("❌ Отменено.")
 
+# ================== STATE STORE ==================
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id  INTEGER PRIMARY KEY,
+    autoscan INTEGER NOT NULL DEFAULT 0,
+    scanlog  INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS pending (
+    chat_id INTEGER PRIMARY KEY,
+    data    TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trades (
+    id         INTEGER PRIMARY KEY,  -- ts сделки в мкс
+    ts         REAL NOT NULL,
+    chat_id    INTEGER,
+    symbol     TEXT NOT NULL,
+    buy_venue  TEXT NOT NULL,
+    sell_venue TEXT NOT NULL,
+    usdt       REAL NOT NULL,
+    skew_ms    REAL,
+    imbalance  REAL,
+    pnl_usdt   REAL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    trade_id     INTEGER NOT NULL REFERENCES trades(id),
+    venue        TEXT NOT NULL,
+    side         TEXT NOT NULL,
+    order_id     TEXT,
+    amount       REAL,
+    filled       REAL,
+    price        REAL,
+    expected     REAL,
+    slippage_pct REAL,
+    latency_ms   REAL,
+    error        TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_trade ON orders (trade_id);
+"""
+
+def realised_pnl(report: Mapping[str, Any]) -> float | None:
+    """Реализованный PnL сделки в USDT по сведённому объёму (min филлов ног) за вычетом taker-комиссий."""
+    leg_buy, leg_sell = report["buy"], report["sell"]
+    qty = min(_leg_filled(leg_buy), _leg_filled(leg_sell))
+    if qty <= 0 or not leg_buy.get("price") or not leg_sell.get("price"):
+        return None
+    symbol = report["symbol"]
+    return qty * (leg_sell["price"] * (1 - taker_fee(leg_sell["venue"], symbol))
+                  - leg_buy["price"] * (1 + taker_fee(leg_buy["venue"], symbol)))
+
+class StateStore:
+    """
+    Состояние бота, переживающее рестарт: подписки чатов, незавершённые сделки (с истечением)
+    и журнал исполнений. SQLite в WAL; чтения — только из памяти, записи копятся и раз в
+    STATE_FLUSH_SEC уходят одной транзакцией из фонового потока. Без open() — только память.
+    """
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self.autoscan: Set[int] = set()
+        self.scanlog: Set[int] = set()
+        self.pending: Dict[int, Dict[str, Any]] = {}  # chat_id -> {cheap, expensive, symbol, usdt?, expires}
+        self._ops: List[Tuple[str, tuple]] = []
+        self._db: sqlite3.Connection | None = None
+        self._flush_lock = asyncio.Lock()
+        self.writes = 0
+
+    @property
+    def queued(self) -> int:
+        """Записей, ждущих следующего flush."""
+        return len(self._ops)
+
+    def open(self):
+        """Подключение и восстановление кэша; на старте, синхронно (миллисекунды)."""
+        t0 = time.perf_counter()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")  # в WAL: транзакция не теряется при падении процесса
+        db.executescript(_STATE_SCHEMA)
+        now = time.time()
+        for chat_id, autoscan, scanlog in db.execute("SELECT chat_id, autoscan, scanlog FROM chats"):
+            if autoscan:
+                self.autoscan.add(chat_id)
+            if scanlog:
+                self.scanlog.add(chat_id)
+        for chat_id, data, expires in db.execute("SELECT chat_id, data, expires FROM pending WHERE expires > ?", (now,)):
+            self.pending[chat_id] = {**json.loads(data), "expires": expires}
+        db.execute("DELETE FROM pending WHERE expires <= ?", (now,))
+        self._db = db
+        log(f"💾 Состояние {self.path}: автоскан {len(self.autoscan)} чат(ов), scanlog {len(self.scanlog)}, "
+            f"незавершённых сделок {len(self.pending)} ({(time.perf_counter() - t0) * 1000:.1f} мс)")
+
+    # --- чаты ---
+    def set_chat(self, chat_id: int, autoscan: bool | None = None, scanlog: bool | None = None):
+        for flag, bucket in ((autoscan, self.autoscan), (scanlog, self.scanlog)):
+            if flag is True:
+                bucket.add(chat_id)
+            elif flag is False:
+                bucket.discard(chat_id)
+        self._ops.append((
+            "INSERT INTO chats (chat_id, autoscan, scanlog) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET autoscan = excluded.autoscan, scanlog = excluded.scanlog",
+            (chat_id, int(chat_id in self.autoscan), int(chat_id in self.scanlog)),
+        ))
+
+    # --- незавершённые сделки ---
+    def get_pending(self, chat_id: int) -> Dict[str, Any] | None:
+        step = self.pending.get(chat_id)
+        if step is not None and step["expires"] <= time.time():
+            self.pop_pending(chat_id)
+            return None
+        return step
+
+    def put_pending(self, chat_id: int, step: Dict[str, Any]):
+        step["expires"] = time.time() + PENDING_TTL
+        self.pending[chat_id] = step
+        data = json.dumps({k: v for k, v in step.items() if k != "expires"})
+        self._ops.append(("INSERT OR REPLACE INTO pending (chat_id, data, expires) VALUES (?, ?, ?)",
+                          (chat_id, data, step["expires"])))
+
+    def pop_pending(self, chat_id: int):
+        if self.pending.pop(chat_id, None) is not None:
+            self._ops.append(("DELETE FROM pending WHERE chat_id = ?", (chat_id,)))
+
+    # --- журнал ---
+    def record_trade(self, chat_id: int | None, usdt: float, report: Mapping[str, Any]):
+        """Сделка и её ноги — в журнал (только добавление); пишем сразу, не дожидаясь тика."""
+        leg_buy, leg_sell = report["buy"], report["sell"]
+        trade_id = int(report["ts"] * 1e6)
+        self._ops.append((
+            "INSERT INTO trades (id, ts, chat_id, symbol, buy_venue, sell_venue, usdt, skew_ms, imbalance, pnl_usdt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (trade_id, report["ts"], chat_id, report["symbol"], leg_buy["venue"], leg_sell["venue"], usdt,
+             report["skew_ms"], report["imbalance"], realised_pnl(report)),
+        ))
+        for leg in (leg_buy, leg_sell):
+            self._ops.append((
+                "INSERT INTO orders (trade_id, venue, side, order_id, amount, filled, price, expected, "
+                "slippage_pct, latency_ms, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (trade_id, leg["venue"], leg["side"], leg.get("id"), leg["amount"], leg.get("filled"), leg.get("price"),
+                 leg["expected"], leg.get("slippage_pct"), leg.get("latency_ms"), leg.get("error")),
+            ))
+        spawn(self.flush())
+
+    def pnl_summary(self, since: float = 0.0) -> Tuple[int, float]:
+        """(сделок, суммарный реализованный PnL в USDT) из журнала."""
+        if self._db is None:
+            return 0, 0.0
+        n, pnl = self._db.execute("SELECT COUNT(*), COALESCE(SUM(pnl_usdt), 0) FROM trades WHERE ts >= ?",
+                                  (since,)).fetchone()
+        return n, pnl
+
+    # --- запись ---
+    def _expire(self):
+        now = time.time()
+        for chat_id in [c for c, step in self.pending.items() if step["expires"] <= now]:
+            self.pop_pending(chat_id)
+
+    def _write(self, ops: List[Tuple[str, tuple]]):
+        db = self._db
+        db.execute("BEGIN")
+        try:
+            for sql, args in ops:
+                db.execute(sql, args)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._db is None or not self._ops:
+                return
+            ops, self._ops = self._ops, []
+            try:
+                await asyncio.to_thread(self._write, ops)
+                self.writes += len(ops)
+            except Exception as e:
+                self._ops[:0] = ops  # не потеряли — повторим на следующем тике
+                log(f"⚠️ Состояние не записано: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_SEC)
+            self._expire()
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+state = StateStore()
+
+# ================== TELEGRAM DELIVERY ==================
+class Outbox:
+    """
+    Исходящие сообщения Telegram: очередь на чат + общий и по-чатовый token bucket.
+    Чаты обслуживаются параллельно (воркер на чат), RetryAfter — пауза и повтор.
+    send() только ставит в очередь — скан и хэндлеры доставку не ждут.
+    """
+    def __init__(self, rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.paused_until = 0.0  # флуд-контроль Telegram: до этого момента не шлём никому
+        self.sent = self.retries = self.dropped = self.failed = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues.values())
+
+    def send(self, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup | None = None, **kwargs):
+        q = self.queues.get(chat_id)
+        if q is None:
+            q = self.queues[chat_id] = asyncio.Queue(TG_QUEUE_MAX)
+        if q.full():
+            # чат не успевает — выкидываем самое старое, свежие сигналы важнее
+            q.get_nowait()
+            q.task_done()
+            self.dropped += 1
+        q.put_nowait((text, reply_markup, kwargs))
+        worker = self.workers.get(chat_id)
+        if worker is None or worker.done():
+            self.workers[chat_id] = spawn(self._worker(chat_id, q))
+
+    async def _worker(self, chat_id: int, q: asyncio.Queue):
+        bucket = TokenBucket(self.chat_rate, TG_CHAT_BURST)
+        while True:
+            try:
+                text, markup, kwargs = await asyncio.wait_for(q.get(), TG_IDLE_SEC)
+            except asyncio.TimeoutError:
+                if q.empty():
+                    self.workers.pop(chat_id, None)  # чат простаивает — воркер не держим
+                    return
+                continue
+            try:
+                await self._deliver(chat_id, text, markup, kwargs, bucket)
+            finally:
+                q.task_done()
+
+    async def _deliver(self, chat_id: int, text: str, markup, kwargs: Dict[str, Any], bucket: TokenBucket):
+        for _ in range(TG_RETRIES):
+            await bucket.acquire()
+            await self.bucket.acquire()
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not app:
+                return
+            t0 = time.perf_counter()
+            try:
+                await app.bot.send_message(chat_id, text, reply_markup=markup, **kwargs)
+            except RetryAfter as e:
+                delay = getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()
+                self.paused_until = max(self.paused_until, time.monotonic() + float(delay))
+                self.retries += 1
+                metrics.count_error("telegram", "retry_after")
+                continue
+            except (TimedOut, NetworkError):
+                self.retries += 1
+                metrics.count_error("telegram", "network")
+                await asyncio.sleep(1.0)
+                continue
+            except Exception as e:
+                self.failed += 1
+                metrics.count_error("telegram", "error")
+                log(f"⚠️ Telegram {chat_id}: {e}")
+                return
+            metrics.observe_phase("telegram", time.perf_counter() - t0)
+            self.sent += 1
+            return
+        self.failed += 1
+        log(f"⚠️ Telegram {chat_id}: не доставлено после {TG_RETRIES} попыток")
+
+    async def drain(self):
+        """Дождаться доставки всего, что уже в очередях."""
+        await asyncio.gather(*(q.join() for q in list(self.queues.values())))
+
+outbox = Outbox()
+
+def buy_button(sig: Mapping[str, Any], label: str = "BUY") -> InlineKeyboardButton:
+    return InlineKeyboardButton(label, callback_data=f"buy:{sig['cheap']}|{sig['expensive']}|{sig['symbol']}")
+
+def build_digest(signals, closed=(), title: str = "") -> List[Tuple[str, InlineKeyboardMarkup | None]]:
+    """
+    Сигналы скана одним сообщением (при превышении лимита длины — несколькими):
+    пронумерованные блоки, под сообщением — по строке BUY на каждый парный сигнал.
+    """
+    blocks: List[Tuple[str, InlineKeyboardButton | None]] = []
+    for i, sig in enumerate(signals, 1):
+        button = None
+        if executable(sig):
+            button = buy_button(sig, f"BUY #{i} {sig['symbol']} {sig['cheap'].upper()}→{sig['expensive'].upper()}")
+        blocks.append((f"#{i} " + format_signal(sig), button))
+    blocks += [(format_closed(ev), None) for ev in closed]
+
+    messages: List[Tuple[str, InlineKeyboardMarkup | None]] = []
+    text, rows = title, []
+    for block, button in blocks:
+        if text and len(text) + len(block) + 2 > TG_MAX_LEN:
+            messages.append((text, InlineKeyboardMarkup(rows) if rows else None))
+            text, rows = "", []
+        text = f"{text}\n\n{block}" if text else block
+        if button is not None:
+            rows.append([button])
+    if text:
+        messages.append((text, InlineKeyboardMarkup(rows) if rows else None))
+    return messages
+
 # ================== COMMANDS ==================
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # включаем автоскан для этого чата
-    context.chat_data["chat_id"] = update.effective_chat.id
-    context.chat_data["autoscan"] = True
+    state.set_chat(update.effective_chat.id, autoscan=True)
 
     active = [k.upper() for k, v in exchange_status.items() if v["status"] == "✅"]
     total = len(exchange_status)
@@ -430,11 +3330,13 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Фильтры:\n"
         f"• Мин. профит: <code>{MIN_SPREAD:.1f}%</code>\n"
         f"• Мин. объём (1ч): <code>{MIN_VOLUME_1H/1000:.0f}k$</code>\n"
-        f"• Автоскан: каждые <code>{SCAN_INTERVAL}</code> сек\n\n"
+        f"• Автоскан: каждые <code>{SCAN_INTERVAL}</code> сек\n"
+        f"• Кэш /scan: до <code>{SCAN_CACHE_MAX_AGE}</code> сек\n\n"
         "Команды:\n"
         "/scan — разовый скан (топ-10)\n"
         "/balance — баланс по биржам\n"
         "/status — статус подключений\n"
+        "/perf — метрики производительности\n"
         "/scanlog — включить/выключить live-лог\n"
         "/stop — отключить автоскан\n"
         "/info — справка\n"
@@ -453,10 +3355,13 @@ async def info_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Мин. объём: <code>{MIN_VOLUME_1H/1000:.0f}k$</code>\n"
         f"• Автоскан: <code>{SCAN_INTERVAL} сек</code>\n\n"
         "3) <b>Логика</b>\n"
-        "— собираем топ-ликвидные пары; считаем mid-price; фильтруем по объёму; считаем спред и чистую маржу после комиссий;\n"
+        "— один bulk-запрос тикеров на биржу (все биржи параллельно); собираем топ-ликвидные пары;\n"
+        "— одним векторным проходом по всем парам бирж: покупка по ask vs продажа по bid, фильтр по объёму, чистая маржа после taker-комиссий бирж;\n"
+        "— для топ-кандидатов смотрим стаканы: макс. прибыльный объём и VWAP на типовой размер;\n"
+        f"— мульти-хоп циклы (до {CYCLE_MAX_HOPS} рёбер) по всем рынкам, включая BTC/ETH/USDC-пары, — отдельными сигналами без кнопки BUY;\n"
         "— выдаём топ сигналов; по клику — BUY/SELL на разных биржах (нужны балансы USDT и базовой монеты). \n\n"
         "4) <b>Команды</b>\n"
-        "/start, /scan, /balance, /status, /scanlog, /stop, /info, /ping, /wake\n\n"
+        "/start, /scan, /balance, /status, /perf, /scanlog, /stop, /info, /ping, /wake\n\n"
         "5) <b>Пример</b>\n"
         "<code>BTC/USDT</code>: купить на MEXC 67000.2 → продать на Bitget 67750.3 → <b>+1.12%</b>\n\n"
         "6) <b>Рекомендации</b>\n"
@@ -481,92 +3386,188 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📊 <b>Статус подключений</b>\n",
         f"Аптайм: <code>{uptime_str()}</code>",
         f"🕓 Последнее обновление: <code>{last_scan_str()}</code>",
+        f"⏱ Последний скан: <code>{scan_stats_str()}</code>",
         f"Активные биржи: 🟢 <b>{len(active)}</b> / {total}",
         f"{active_str}\n",
         "Подробности:"
     ]
     for name, st in exchange_status.items():
-        emoji = "🟢" if st["status"] == "✅" else "🔴" if st["status"] == "❌" else "⚪"
+        emoji = {"✅": "🟢", "❌": "🔴", "🟡": "🟡"}.get(st["status"], "⚪")
         msg = f"{emoji} {name.upper()} — {'OK' if st['status'] == '✅' else st['error'] or st['status']}"
         lines.append(msg)
 
     await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
+async def perf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ms = lambda sec: f"{sec * 1000:.0f}"
+    lines = ["📈 <b>Производительность</b>\n", f"⏱ Последний скан: <code>{scan_stats_str()}</code>"]
+
+    if metrics.phases:
+        lines.append("\n<b>Фазы скана</b> (посл. / p95 / max, мс):")
+        for phase, h in metrics.phases.items():
+            lines.append(f"• {phase}: <code>{ms(h.last)} / {ms(h.quantile(0.95))} / {ms(h.max)}</code>")
+
+    lines.append("\n<b>Биржи</b> (запросов, p50 / p95 мс, очередь, соединений новых / повторно, ошибки):")
+    for name in exchange_status:
+        h = metrics.venue_calls(name)
+        sch = next((x for x in schedulers.values() if x.name == name), None)
+        queue = f"{sch.waiting}+{sch.inflight}" if sch else "0+0"
+        errs = ", ".join(f"{kind} {n}" for (v, kind), n in sorted(metrics.errors.items()) if v == name) or "—"
+        lines.append(f"• {name.upper()}: <code>{h.count}</code>, <code>{ms(h.quantile(0.5))} / {ms(h.quantile(0.95))}</code>, "
+                     f"очередь <code>{queue}</code>, "
+                     f"соед. <code>{http_pool.opened.get(name, 0)} / {http_pool.reused.get(name, 0)}</code>, "
+                     f"DNS-промахов {http_pool.dns_misses.get(name, 0)}, {errs}")
+
+    lines.append(f"\n📨 Telegram: в очереди <code>{outbox.pending}</code>, отправлено <code>{outbox.sent}</code>, "
+                 f"повторов <code>{outbox.retries}</code>, выкинуто <code>{outbox.dropped}</code>, "
+                 f"ошибок <code>{outbox.failed}</code>")
+    if "total" in STARTUP:
+        lines.append(f"🚀 Старт: <code>{STARTUP['total']:.2f}</code> c ({startup_str()})")
+    trades, pnl = state.pnl_summary()
+    lines.append(f"💾 Журнал: сделок <code>{trades}</code>, PnL <code>{pnl:+.2f}</code> USDT; "
+                 f"записей в БД <code>{state.writes}</code>, в очереди <code>{state.queued}</code>")
+    lines.append(f"🕯 Объём 1ч: рынков в кэше <code>{len(volume_store.windows)}</code>, "
+                 f"свечей получено <code>{volume_store.candles}</code>")
+    if execution_log:
+        acks = [leg["latency_ms"] for r in execution_log for leg in (r["buy"], r["sell"])]
+        last = execution_log[-1]
+        lines.append(f"⚡ Исполнения: <code>{len(execution_log)}</code>, ack ног max <code>{max(acks):.0f}</code> мс; "
+                     f"последнее {last['symbol']}: разрыв <code>{last['skew_ms']:.0f}</code> мс, "
+                     f"дисбаланс <code>{last['imbalance']:.8g}</code>")
+    if poller is not None:
+        lines.append(f"🎯 Уровни: горячих <code>{len(tiers.hot)}</code>, тёплых <code>{len(tiers.warm)}</code>; "
+                     f"точечных запросов <code>{poller.calls}</code>, пропусков <code>{poller.skipped}</code>, "
+                     f"алертов <code>{poller.alerts}</code>")
+    lag = metrics.loop_lag
+    lines.append(f"\n🌀 Задержка event loop: p95 <code>{ms(lag.quantile(0.95))}</code> мс, max <code>{ms(lag.max)}</code> мс")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+
 async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lines = ["<b>Баланс (USDT):</b>"]
+    # из тёплого кэша — без запросов к биржам; оценка по ценам последнего снимка
+    prices = asset_prices(snapshot_history[-1]) if snapshot_history else {}
+    lines = ["<b>Баланс</b> (оценка в USDT по последнему снимку):"]
+    grand, stale = 0.0, []
     for name, st in exchange_status.items():
-        ex = st.get("ex")
-        if st["status"] == "✅" and ex:
-            try:
-                b = await ex.fetch_balance()
-                free = safe_float((b.get("USDT") or {}).get("free"))
-                lines.append(f"{name.upper()}: <code>{free:.2f}</code> USDT")
-            except Exception as e:
-                lines.append(f"{name.upper()}: ошибка — {e}")
-        else:
-            lines.append(f"{name.upper()}: {st['status']}")
-    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+        if st["status"] != "✅" or name not in exchanges:
+            lines.append(f"\n{name.upper()}: {st['status']}")
+            continue
+        if balances is None or not balances.known(name):
+            lines.append(f"\n{name.upper()}: данных пока нет — обновляется")
+            stale.append(name)
+            continue
+        held = balances.holdings(name, prices)
+        value = sum(v for _, _, v in held if v is not None)
+        grand += value
+        if not balances.fresh(name):
+            stale.append(name)
+        age = f"{time.time() - balances.ts[name]:.0f} c назад" if name in balances.ts else "обновляется"
+        lines.append(f"\n<b>{name.upper()}</b> ≈ <code>{value:.2f}</code> ({age})")
+        lines.append(f"• USDT: <code>{balances.get(name, 'USDT'):.2f}</code> свободно")
+        for asset, amount, val in held:
+            if asset != "USDT":
+                lines.append(f"• {asset}: <code>{amount:.8g}</code> ≈ " + (f"<code>{val:.2f}</code>" if val is not None else "—"))
+    lines.append(f"\nИтого ≈ <code>{grand:.2f}</code> USDT")
+    if balances is not None and stale:
+        spawn(balances.refresh_all(stale))
+    await update.message.reply_text("\n".join(lines)[:TG_MAX_LEN], parse_mode="HTML")
 
 async def scanlog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id in scanlog_enabled:
-        scanlog_enabled.remove(chat_id)
+    if chat_id in state.scanlog:
+        state.set_chat(chat_id, scanlog=False)
         await update.message.reply_text("🟡 Лог сканирования выключен.")
     else:
-        scanlog_enabled.add(chat_id)
+        state.set_chat(chat_id, scanlog=True)
         await update.message.reply_text("🟢 Лог сканирования включён.")
 
 async def stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.chat_data["autoscan"] = False
+    state.set_chat(update.effective_chat.id, autoscan=False)
     await update.message.reply_text("⏸️ Автоскан отключён.")
 
 async def scan_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    res = await scan_all_pairs(chat_id)
-    if not res:
+    res = await get_scan_result()
+    if not res.signals:
         return await update.message.reply_text("Сигналов нет.")
-    for sig in res:
-        txt = (
-            f"<b>{sig['symbol']}</b>\n"
-            f"Профит: <b>{sig['spread']}%</b>\n"
-            f"Купить: {sig['cheap'].upper()} <code>{sig['price_cheap']}</code>\n"
-            f"Продать: {sig['expensive'].upper()} <code>{sig['price_expensive']}</code>\n"
-            f"Объём 1ч: <code>{sig['volume_1h']}M</code>$"
-        )
-        await update.message.reply_text(txt, parse_mode="HTML", reply_markup=build_buy_keyboard(sig))
+    title = [f"🔎 <b>Топ-{len(res.signals)} сигналов</b>"]
+    if res.age > 1:
+        title.append(f"🕓 Результат скана от {res.at.strftime('%H:%M:%S')}")
+    if res.partial:
+        title.append(f"⏰ Частичный результат — не успели к дедлайну: {', '.join(res.missed)}")
+    for text, markup in build_digest(res.signals, title="\n".join(title)):
+        outbox.send(update.effective_chat.id, text, reply_markup=markup, parse_mode="HTML")
 
 # ================== AUTOSCAN ==================
 async def autoscan_tick():
     if not app:
         return
-    for data in app.chat_data.values():
-        if data.get("autoscan"):
-            chat_id = data["chat_id"]
-            try:
-                res = await scan_all_pairs(chat_id)
-                if not res:
-                    continue
-                for sig in res:
-                    txt = (
-                        f"<b>{sig['symbol']}</b>\n"
-                        f"Профит: <b>{sig['spread']}%</b>\n"
-                        f"Купить: {sig['cheap'].upper()} <code>{sig['price_cheap']}</code>\n"
-                        f"Продать: {sig['expensive'].upper()} <code>{sig['price_expensive']}</code>\n"
-                        f"Объём 1ч: <code>{sig['volume_1h']}M</code>$"
-                    )
-                    await app.bot.send_message(chat_id, txt, parse_mode="HTML", reply_markup=build_buy_keyboard(sig))
-            except Exception as e:
-                try:
-                    await app.bot.send_message(chat_id, f"⚠️ autoscan: {e}")
-                except Exception:
-                    pass
+    chats = list(state.autoscan)
+    if not chats:
+        return
+    # один скан на тик — результат общий для всех подписанных чатов
+    try:
+        res = await run_scan()
+    except Exception as e:
+        for chat_id in chats:
+            outbox.send(chat_id, f"⚠️ autoscan: {e}")
+        return
+    # шлём только новые / заметно изменившиеся сигналы и события закрытия —
+    # одним дайджестом на чат; доставка идёт в фоне и следующий скан не ждёт
+    broadcast_digest(res.opened + res.changed, res.closed, f"📡 <b>Автоскан {res.at.strftime('%H:%M:%S')}</b>")
+
+def broadcast_digest(updates: List[Mapping[str, Any]], closed: List[Mapping[str, Any]], title: str):
+    """Один дайджест на всех подписчиков автоскана; доставка идёт в фоне через outbox."""
+    if not app or not state.autoscan or (not updates and not closed):
+        return
+    digest = build_digest(updates, closed, title=title)
+    for chat_id in list(state.autoscan):
+        for text, markup in digest:
+            outbox.send(chat_id, text, reply_markup=markup, parse_mode="HTML")
 
 # ================== MAIN ==================
+def startup_str() -> str:
+    parts = [("импорт", "import"), ("биржи/рынки", "markets"), ("сервисы", "services"), ("бот+вебхук", "webhook")]
+    return " | ".join(f"{title} {STARTUP[key]:.2f} c" for title, key in parts if key in STARTUP)
+
+async def report_startup(t_bot: float):
+    """Вебхук ставится внутри run_webhook — ждём, пока приложение запустится, и пишем разбивку старта."""
+    while not (app and app.running):
+        await asyncio.sleep(0.05)
+    STARTUP["webhook"] = time.perf_counter() - t_bot
+    STARTUP["total"] = time.perf_counter() - IMPORT_T0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # Linux: KB
+    log(f"⏱ Старт за {STARTUP['total']:.2f} c: {startup_str()} | RSS {rss:.0f} MB")
+
 async def main():
+    if not BOT_TOKEN:
+        raise SystemExit("❌ Нет TELEGRAM_BOT_TOKEN")
     log("🚀 INIT START (Render + Telegram webhook)")
+    t_stage = time.perf_counter()
     await init_exchanges()
-
-    global app
+    STARTUP["markets"] = time.perf_counter() - t_stage
+    t_stage = time.perf_counter()
+
+    global app, live_stream, balances, recorder, shard_pool, poller
+    state.open()
+    spawn(state.run())
+    spawn(markets_refresh_loop())
+    balances = BalanceCache()
+    spawn(balances.run())
+    spawn(metrics.watch_loop())
+    metrics_runner = await start_metrics_server()
+    if SHARD_WORKERS > 0:
+        shard_pool = ShardPool(SHARD_WORKERS)
+        await shard_pool.start(exchange_candidates, list(exchanges))
+    if RECORD_DIR:
+        recorder = TickRecorder(RECORD_DIR)
+        log(f"📼 Запись снимков: {RECORD_DIR}")
+    if STREAM_MODE:
+        live_stream = MarketStream(exchanges)
+        await live_stream.start()
+    elif HOT_SYMBOLS > 0:
+        poller = TieredPoller(tiers)
+        spawn(poller.run())
+    STARTUP["services"] = time.perf_counter() - t_stage
+    t_stage = time.perf_counter()
     app = (
         Application.builder()
         .token(BOT_TOKEN)
@@ -579,6 +3580,7 @@ async def main():
     app.add_handler(CommandHandler("info", info_cmd))
     app.add_handler(CommandHandler("scan", scan_cmd))
     app.add_handler(CommandHandler("status", status_cmd))
+    app.add_handler(CommandHandler("perf", perf_cmd))
     app.add_handler(CommandHandler("balance", balance_cmd))
     app.add_handler(CommandHandler("scanlog", scanlog_cmd))
     app.add_handler(CommandHandler("stop", stop_cmd))
@@ -591,13 +3593,15 @@ async def main():
 
     # Второй обработчик /start (группа 1) — включает автоскан для чата
     async def on_start_autoscan(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        context.chat_data["chat_id"] = update.effective_chat.id
-        context.chat_data["autoscan"] = True
+        state.set_chat(update.effective_chat.id, autoscan=True)
     app.add_handler(CommandHandler("start", on_start_autoscan), group=1)
 
     # Scheduler
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(autoscan_tick, "interval", seconds=SCAN_INTERVAL)
+    # скан ограничен SCAN_DEADLINE < SCAN_INTERVAL, поэтому тики не наезжают друг на друга;
+    # если всё же опоздали — сливаем пропущенные тики в один, а не копим очередь
+    scheduler.add_job(autoscan_tick, "interval", seconds=SCAN_INTERVAL,
+                      max_instances=1, coalesce=True, misfire_grace_time=SCAN_INTERVAL)
     scheduler.start()
 
     # Webhook params
@@ -616,9 +3620,11 @@ async def main():
     log("===========================================================")
     log(f"✅ Arbitrage Scanner {VERSION} запущен (Render webhook mode)")
     log(f"Фильтры: профит ≥ {MIN_SPREAD}% | объём ≥ {MIN_VOLUME_1H/1000:.0f}k$/1ч | топ/биржу={TOPN_PER_EXCHANGE}")
-    log(f"Автоскан каждые {SCAN_INTERVAL} сек")
+    log(f"Автоскан каждые {SCAN_INTERVAL} сек, дедлайн скана {SCAN_DEADLINE} сек")
+    log(f"Котировки: {'стриминг' if STREAM_MODE else 'bulk-опрос'}")
     log("===========================================================")
 
+    spawn(report_startup(t_stage))
     try:
         await app.run_webhook(
             listen="0.0.0.0",
@@ -630,6 +3636,19 @@ async def main():
             allowed_updates=Update.ALL_TYPES,
         )
     finally:
+        if live_stream is not None:
+            await live_stream.stop()
+        if recorder is not None:
+            await recorder.flush()
+        if shard_pool is not None:
+            await shard_pool.stop()
+        try:
+            await asyncio.wait_for(outbox.drain(), 5)
+        except asyncio.TimeoutError:
+            log(f"⚠️ Не доставлено сообщений: {outbox.pending}")
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await state.close()
         await close_all_exchanges()
         log("🧹 Завершение — соединения закрыты.")
 